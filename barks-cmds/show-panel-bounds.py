@@ -2,8 +2,10 @@ import json
 import logging
 import os.path
 import sys
+import tempfile
 from pathlib import Path
 
+import cairosvg
 import cv2 as cv
 from barks_fantagraphics.comics_cmd_args import CmdArgNames, CmdArgs
 from barks_fantagraphics.comics_consts import PNG_FILE_EXT, RESTORABLE_PAGE_TYPES
@@ -25,19 +27,18 @@ def show_panel_bounds(title: str, out_dir: str) -> None:
     panel_segments_files = comic.get_srce_panel_segments_files(RESTORABLE_PAGE_TYPES)
 
     for svg_file, panel_segments_file in zip(svg_files, panel_segments_files):
-        png_file = svg_file + PNG_FILE_EXT
         bounds_img_file = os.path.join(out_dir, Path(svg_file).stem + "-with-bounds.png")
-        if not write_bounds_to_image_file(png_file, panel_segments_file, bounds_img_file):
+        if not write_bounds_to_image_file(svg_file, panel_segments_file, bounds_img_file):
             raise RuntimeError("There were process errors.")
 
 
 def write_bounds_to_image_file(
-    png_file: str, panel_segments_file: str, bounds_img_file: str
+    svg_file: str, panel_segments_file: str, bounds_img_file: str
 ) -> bool:
-    logging.info(f'Writing bounds for image "{get_abbrev_path(png_file)}"...')
+    logging.info(f'Writing bounds for image "{get_abbrev_path(svg_file)}"...')
 
-    if not os.path.isfile(png_file):
-        logging.error(f'Could not find image file "{png_file}".')
+    if not os.path.isfile(svg_file):
+        logging.error(f'Could not find image file "{svg_file}".')
         return False
     if not os.path.isfile(panel_segments_file):
         logging.error(f'Could not find panel segments file "{panel_segments_file}".')
@@ -50,7 +51,11 @@ def write_bounds_to_image_file(
     with open(panel_segments_file) as f:
         panel_segment_info = json.load(f)
 
-    bw_image = get_bw_image_from_alpha(png_file)
+    # The restore no longer keeps a png of the svg, so rasterize it here.
+    with tempfile.TemporaryDirectory() as temp_dir:
+        png_file = os.path.join(temp_dir, Path(svg_file).stem + PNG_FILE_EXT)
+        cairosvg.svg2png(url=svg_file, write_to=png_file)
+        bw_image = get_bw_image_from_alpha(png_file)
 
     pil_image = Image.fromarray(cv.merge([bw_image, bw_image, bw_image]))
     assert pil_image.size[0] == panel_segment_info["size"][0]
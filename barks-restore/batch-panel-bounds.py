@@ -9,6 +9,9 @@ from barks_fantagraphics.comics_consts import RESTORABLE_PAGE_TYPES
 from barks_fantagraphics.comics_utils import get_abbrev_path
 from comic_utils.comics_logging import setup_logging
 from comic_utils.panel_bounding_box_processor import BoundingBoxProcessor
+from src.atomic_output import TitleJournal, atomic_output_file, get_title_journal
+
+JOURNAL_COMMAND = "panel-bounds"
 
 
 def panel_bounds(title_list: list[str]) -> None:
@@ -27,6 +30,7 @@ def panel_bounds(title_list: list[str]) -> None:
 
         srce_files = comic.get_final_srce_story_files(RESTORABLE_PAGE_TYPES)
         dest_files = comic.get_srce_panel_segments_files(RESTORABLE_PAGE_TYPES)
+        journal = get_title_journal(JOURNAL_COMMAND, title, dest_files)
 
         if not os.path.isdir(comic.get_srce_original_fixes_image_dir()):
             msg = (
@@ -43,6 +47,7 @@ def panel_bounds(title_list: list[str]) -> None:
             for (srce_file, _), dest_file in zip(srce_files, dest_files):
                 executor.submit(
                     get_page_panel_bounds,
+                    journal,
                     bounding_box_processor,
                     srce_panels_bounds_override_dir,
                     srce_file,
@@ -57,6 +62,7 @@ def panel_bounds(title_list: list[str]) -> None:
 
 
 def get_page_panel_bounds(
+    journal: TitleJournal,
     bounding_box_processor: BoundingBoxProcessor,
     srce_panels_bounds_override_dir: str,
     srce_file: str,
@@ -66,8 +72,8 @@ def get_page_panel_bounds(
         if not os.path.isfile(srce_file):
             msg = f'Could not find srce file: "{srce_file}".'
             raise FileNotFoundError(msg)
-        if os.path.isfile(dest_file):
-            logging.warning(f'Dest file exists - skipping: "{get_abbrev_path(dest_file)}".')
+        if journal.is_done(dest_file):
+            logging.warning(f'Dest file done - skipping: "{get_abbrev_path(dest_file)}".')
             return
 
         logging.info(
@@ -80,7 +86,9 @@ def get_page_panel_bounds(
             srce_panels_bounds_override_dir,
         )
 
-        bounding_box_processor.save_panels_segment_info(dest_file, segment_info)
+        with atomic_output_file(dest_file) as temp_dest_file:
+            bounding_box_processor.save_panels_segment_info(temp_dest_file, segment_info)
+        journal.mark_done(dest_file)
 
     except Exception:
         logging.exception("Error: ")
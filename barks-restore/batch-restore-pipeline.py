@@ -1,4 +1,3 @@
-import concurrent.futures
 import logging
 import os
 import sys
@@ -12,11 +11,45 @@ from barks_fantagraphics.comics_consts import RESTORABLE_PAGE_TYPES
 from barks_fantagraphics.comics_utils import get_abbrev_path
 from comic_utils.comics_logging import setup_logging
 from comic_utils.pil_image_utils import copy_file_to_png
+from src.atomic_output import atomic_output_file, get_title_journal
+from src.memory_profile import StageRssProfile
 from src.restore_pipeline import RestorePipeline, check_for_errors
+from src.restore_scheduler import RestoreScheduler, RestoreStage, get_restore_stage_profile
+from src.roi_restore import RoiRestore, has_roi_input_changed, save_roi_input
+from src.stage_cache import StageCache
+from src.stage_profile import add_stage_profile_record, get_profile_file
 
 SCALE = 4
+
+JOURNAL_COMMAND = "restore"
+COPY_JOURNAL_COMMAND = "restore-copy"
 SMALL_RAM = 16 * 1024 * 1024 * 1024
 
+# On small RAM machines, run the memory hungry parts on all cores but have each worker
+# process its page in tiles sized to fit its share of RAM.
+USE_TILED_RESTORE = psutil.virtual_memory().total < SMALL_RAM
+TILED_RESTORE_MAX_WORKER_RSS = psutil.virtual_memory().total // (2 * (os.cpu_count() or 1))
+
+# Pages are handed between restore steps in memory. Set this to also write out the
+# intermediate work files, for debugging.
+KEEP_WORK_FILES = False
+
+# Restore part outputs are cached, keyed on their inputs and parameters, so re-running a
+# title only re-runs the parts affected by a change.
+USE_STAGE_CACHE = True
+STAGE_CACHE_DIRNAME = "restore-stage-cache"
+STAGE_CACHE_MAX_BYTES = 50 * 1024 * 1024 * 1024
+
+# A restored page whose upscayled input has since been fixed is restored by only
+# reprocessing the changed areas of the page.
+USE_ROI_RESTORE = True
+
+# A profile record of each restore part of each page is written to a jsonl file per
+# run. Use 'restore-profile-report.py' to summarize them.
+USE_STAGE_PROFILE = True
+STAGE_PROFILE_DIRNAME = "restore-profiles"
+ROI_RESTORE_STAGE = "ROI"
+
 
 def restore(title_list: list[str]) -> None:
     start = time.time()
@@ -38,18 +71,21 @@ def copy_title(title_str: str) -> None:
     comic = comics_database.get_comic_book(title_str)
     srce_files = comic.get_final_srce_original_story_files(RESTORABLE_PAGE_TYPES)
     dest_restored_files = comic.get_srce_restored_story_files(RESTORABLE_PAGE_TYPES)
+    journal = get_title_journal(COPY_JOURNAL_COMMAND, title_str, dest_restored_files)
 
     for srce_file, dest_file in zip(srce_files, dest_restored_files):
-        if Path(dest_file).is_file():
+        if journal.is_done(dest_file):
             logging.warning(
-                f'Dest file exists - skipping: "{get_abbrev_path(dest_file)}".',
+                f'Dest file done - skipping: "{get_abbrev_path(dest_file)}".',
             )
             continue
 
         logging.info(
             f'Copying "{get_abbrev_path(srce_file[0])}" to "{get_abbrev_path(dest_file)}".',
         )
-        copy_file_to_png(srce_file[0], dest_file)
+        with atomic_output_file(dest_file) as temp_dest_file:
+            copy_file_to_png(srce_file[0], temp_dest_file)
+        journal.mark_done(dest_file)
 
 
 def restore_title(title: str) -> None:
@@ -69,8 +105,10 @@ def restore_title(title: str) -> None:
         RESTORABLE_PAGE_TYPES,
     )
     dest_restored_svg_files = comic.get_srce_restored_svg_story_files(RESTORABLE_PAGE_TYPES)
+    journal = get_title_journal(JOURNAL_COMMAND, title, dest_restored_files)
 
     restore_processes: list[RestorePipeline] = []
+    roi_restore_processes: list[RestorePipeline] = []
 
     for (
         srce_file,
@@ -88,9 +126,25 @@ def restore_title(title: str) -> None:
         if not os.path.isfile(srce_upscayl_file[0]):
             logging.error(f'Could not find srce upscayl file - skipping: "{srce_upscayl_file[0]}".')
             continue
-        if os.path.isfile(dest_restored_file):
+        restore_process = RestorePipeline(
+            title_work_dir,
+            Path(srce_file[0]),
+            Path(srce_upscayl_file[0]),
+            SCALE,
+            Path(dest_restored_file),
+            Path(dest_upscayled_restored_file),
+            Path(dest_svg_restored_file),
+            TILED_RESTORE_MAX_WORKER_RSS if USE_TILED_RESTORE else None,
+            KEEP_WORK_FILES,
+            stage_cache,
+        )
+
+        if journal.is_done(dest_restored_file):
+            if USE_ROI_RESTORE and has_roi_input_changed(restore_process):
+                roi_restore_processes.append(restore_process)
+                continue
             logging.warning(
-                f'Dest file exists - skipping: "{get_abbrev_path(dest_restored_file)}".',
+                f'Dest file done - skipping: "{get_abbrev_path(dest_restored_file)}".',
             )
             continue
 
@@ -100,17 +154,15 @@ def restore_title(title: str) -> None:
             f' to dest "{get_abbrev_path(dest_restored_file)}".',
         )
 
-        restore_processes.append(
-            RestorePipeline(
-                title_work_dir,
-                Path(srce_file[0]),
-                Path(srce_upscayl_file[0]),
-                SCALE,
-                Path(dest_restored_file),
-                Path(dest_upscayled_restored_file),
-                Path(dest_svg_restored_file),
-            ),
-        )
+        restore_processes.append(restore_process)
+
+    for proc in roi_restore_processes:
+        with get_restore_stage_profile(proc, ROI_RESTORE_STAGE) as stage_profile:
+            roi_restored = RoiRestore(proc).run()
+        if not roi_restored:
+            restore_processes.append(proc)
+        elif profile_file:
+            add_stage_profile_record(profile_file, stage_profile.record)
 
     run_restore(restore_processes)
 
@@ -120,58 +172,56 @@ def restore_title(title: str) -> None:
     )
 
     check_for_errors(restore_processes)
-
-
+    check_for_errors([p for p in roi_restore_processes if p not in restore_processes])
+
+    for proc in restore_processes:
+        if not proc.errors_occurred:
+            journal.mark_done(proc.dest_restored_file)
+            if USE_ROI_RESTORE:
+                save_roi_input(proc)
+
+
+# Starting guesses for the whole page peak RSS of each part. Once a part has been run,
+# its measured peaks, saved in the work dir, are used to decide how many pages can be
+# in memory at once.
+DEFAULT_STAGE_PEAK_RSS = {
+    RestoreStage.PART1.name: 3 * 1024 * 1024 * 1024,
+    RestoreStage.PART2.name: 10 * 1024 * 1024 * 1024,
+    RestoreStage.PART3.name: 2 * 1024 * 1024 * 1024,
+    RestoreStage.PART4.name: 12 * 1024 * 1024 * 1024,
+}
+STAGE_RSS_PROFILE_FILENAME = "restore-stage-rss-profile.json"
+TILED_STAGE_RSS_PROFILE_FILENAME = "restore-stage-rss-profile-tiled.json"
+
+max_workers = None
 part1_max_workers = None
-
-
-def run_restore_part1(proc: RestorePipeline) -> None:
-    logging.info(f'Starting restore part 1 for "{proc.srce_upscale_file.name}".')
-    proc.do_part1()
-
-
-part2_max_workers = 1 if psutil.virtual_memory().total < SMALL_RAM else 6
-
-
-def run_restore_part2(proc: RestorePipeline) -> None:
-    logging.info(f'Starting restore part 2 for "{proc.srce_upscale_file.name}".')
-    proc.do_part2_memory_hungry()
-
-
+part2_max_workers = None
 part3_max_workers = None
-
-
-def run_restore_part3(proc: RestorePipeline) -> None:
-    logging.info(f'Starting restore part 3 for "{proc.srce_upscale_file.name}".')
-    proc.do_part3()
-
-
-part4_max_workers = 1 if psutil.virtual_memory().total < SMALL_RAM else 5
-
-
-def run_restore_part4(proc: RestorePipeline) -> None:
-    logging.info(f'Starting restore part 4 for "{proc.srce_upscale_file.name}".')
-    proc.do_part4_memory_hungry()
+part4_max_workers = None
 
 
 def run_restore(restore_processes: list[RestorePipeline]) -> None:
     logging.info(f"Starting restore for {len(restore_processes)} processes.")
 
-    with concurrent.futures.ProcessPoolExecutor(part1_max_workers) as executor:
-        for process in restore_processes:
-            executor.submit(run_restore_part1, process)
-
-    with concurrent.futures.ProcessPoolExecutor(part2_max_workers) as executor:
-        for process in restore_processes:
-            executor.submit(run_restore_part2, process)
-
-    with concurrent.futures.ProcessPoolExecutor(part3_max_workers) as executor:
-        for process in restore_processes:
-            executor.submit(run_restore_part3, process)
-
-    with concurrent.futures.ProcessPoolExecutor(part4_max_workers) as executor:
-        for process in restore_processes:
-            executor.submit(run_restore_part4, process)
+    if USE_TILED_RESTORE:
+        rss_profile_file = os.path.join(work_dir, TILED_STAGE_RSS_PROFILE_FILENAME)
+        default_stage_peak_rss = dict.fromkeys(DEFAULT_STAGE_PEAK_RSS, TILED_RESTORE_MAX_WORKER_RSS)
+    else:
+        rss_profile_file = os.path.join(work_dir, STAGE_RSS_PROFILE_FILENAME)
+        default_stage_peak_rss = DEFAULT_STAGE_PEAK_RSS
+
+    scheduler = RestoreScheduler(
+        max_workers,
+        {
+            RestoreStage.PART1: part1_max_workers,
+            RestoreStage.PART2: part2_max_workers,
+            RestoreStage.PART3: part3_max_workers,
+            RestoreStage.PART4: part4_max_workers,
+        },
+        StageRssProfile(rss_profile_file, default_stage_peak_rss),
+        profile_file,
+    )
+    scheduler.run(restore_processes)
 
 
 setup_logging(logging.INFO)
@@ -189,4 +239,16 @@ os.makedirs(work_dir, exist_ok=True)
 
 comics_database = cmd_args.get_comics_database()
 
+stage_cache = (
+    StageCache(os.path.join(work_dir, STAGE_CACHE_DIRNAME), STAGE_CACHE_MAX_BYTES)
+    if USE_STAGE_CACHE
+    else None
+)
+
+profile_file = (
+    get_profile_file(os.path.join(work_dir, STAGE_PROFILE_DIRNAME), JOURNAL_COMMAND)
+    if USE_STAGE_PROFILE
+    else None
+)
+
 restore(cmd_args.get_titles())
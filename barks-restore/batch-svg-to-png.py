@@ -9,10 +9,13 @@ from barks_fantagraphics.comics_cmd_args import CmdArgNames, CmdArgs
 from barks_fantagraphics.comics_consts import RESTORABLE_PAGE_TYPES
 from barks_fantagraphics.comics_utils import get_abbrev_path
 from comic_utils.comics_logging import setup_logging
+from src.atomic_output import TitleJournal, get_title_journal
 from src.image_io import svg_file_to_png
 
 SCALE = 4
 
+JOURNAL_COMMAND = "svg-to-png"
+
 
 def svgs_to_pngs(title_list: list[str]) -> None:
     start = time.time()
@@ -28,24 +31,27 @@ def svgs_to_pngs(title_list: list[str]) -> None:
         comic = comics_database.get_comic_book(title)
 
         srce_files = comic.get_srce_restored_svg_story_files(RESTORABLE_PAGE_TYPES)
+        journal = get_title_journal(
+            JOURNAL_COMMAND, title, [srce_file + ".png" for srce_file in srce_files]
+        )
 
         with concurrent.futures.ProcessPoolExecutor() as executor:
             for srce_file in srce_files:
-                executor.submit(convert_svg_to_png, srce_file)
+                executor.submit(convert_svg_to_png, journal, srce_file)
 
         num_png_files += len(srce_files)
 
     logging.info(f"\nTime taken to convert all {num_png_files} files: {int(time.time() - start)}s.")
 
 
-def convert_svg_to_png(srce_svg: str) -> None:
+def convert_svg_to_png(journal: TitleJournal, srce_svg: str) -> None:
     try:
         if not os.path.isfile(srce_svg):
             raise FileNotFoundError(f'Could not find srce file: "{srce_svg}".')
 
         png_file = srce_svg + ".png"
-        if os.path.isfile(png_file):
-            logging.warning(f'Dest png file exists - skipping: "{get_abbrev_path(png_file)}".')
+        if journal.is_done(png_file):
+            logging.warning(f'Dest png file done - skipping: "{get_abbrev_path(png_file)}".')
             return
 
         logging.info(
@@ -53,6 +59,7 @@ def convert_svg_to_png(srce_svg: str) -> None:
             f' to dest png "{get_abbrev_path(png_file)}".',
         )
         svg_file_to_png(srce_svg, png_file)
+        journal.mark_done(png_file)
 
     except Exception:
         logging.exception("Error: ")
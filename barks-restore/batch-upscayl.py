@@ -1,61 +1,74 @@
 import logging
-import os
 import sys
 import time
 
 from barks_fantagraphics.barks_titles import is_non_comic_title
 from barks_fantagraphics.comics_cmd_args import CmdArgNames, CmdArgs
 from barks_fantagraphics.comics_consts import RESTORABLE_PAGE_TYPES
-from barks_fantagraphics.comics_utils import get_abbrev_path
 from comic_utils.comics_logging import setup_logging
-from src.upscale_image import upscale_image_file
+from src.atomic_output import get_title_journal
+from src.upscale_image import get_upscaler
+from src.upscale_queue import UpscaleQueue, get_num_upscale_workers, get_pending_upscale_files
 
 SCALE = 4
 
+# Pages from all the titles go on one queue shared by a number of upscale workers. The
+# number of workers is as many as fit the cores and available memory.
+UPSCALE_CORES_PER_WORKER = 8
+UPSCALE_WORKER_RSS = 4 * 1024 * 1024 * 1024
+UPSCALE_PAGES_PER_JOB = 8
+
+JOURNAL_COMMAND = "upscayl"
+
 
 def upscayl(title_list: list[str]) -> None:
     start = time.time()
 
-    num_upscayled_files = 0
+    srce_dest_files = []
+    title_journals = {}
     for title in title_list:
         if is_non_comic_title(title):
             logging.info(f'Not a comic title - not upscayling "{title}".')
             continue
 
-        logging.info(f'Upscayling story "{title}"...')
         comic = comics_database.get_comic_book(title)
 
         srce_files = comic.get_final_srce_original_story_files(RESTORABLE_PAGE_TYPES)
         upscayl_files = comic.get_final_srce_upscayled_story_files(RESTORABLE_PAGE_TYPES)
 
-        for srce_file, (dest_file, _is_mod_file) in zip(srce_files, upscayl_files):
-            if upscayl_file(srce_file[0], dest_file):
-                num_upscayled_files += 1
-
+        title_srce_dest_files = [
+            (srce_file[0], dest_file)
+            for srce_file, (dest_file, _is_mod_file) in zip(srce_files, upscayl_files)
+        ]
+        journal = get_title_journal(
+            JOURNAL_COMMAND, title, [dest_file for _, dest_file in title_srce_dest_files]
+        )
+        title_journals.update((dest_file, journal) for _, dest_file in title_srce_dest_files)
+        srce_dest_files.extend(title_srce_dest_files)
+
+    pending_files = get_pending_upscale_files(
+        srce_dest_files, lambda dest_file: title_journals[dest_file].is_done(dest_file)
+    )
     logging.info(
-        f"\nTime taken to upscayl all {num_upscayled_files} files: {int(time.time() - start)}s.",
+        f"{len(srce_dest_files) - len(pending_files)} of {len(srce_dest_files)} files"
+        f" already upscayled for {len(title_list)} titles."
     )
 
-
-def upscayl_file(srce_file: str, dest_file: str) -> bool:
-    if not os.path.isfile(srce_file):
-        msg = f'Could not find srce file: "{srce_file}".'
-        raise FileNotFoundError(msg)
-    if os.path.isfile(dest_file):
-        logging.warning(f'Dest upscayl file exists - skipping: "{get_abbrev_path(dest_file)}".')
-        return False
-
-    start = time.time()
+    upscale_queue = UpscaleQueue(
+        get_upscaler,
+        SCALE,
+        get_num_upscale_workers(UPSCALE_CORES_PER_WORKER, UPSCALE_WORKER_RSS),
+        UPSCALE_PAGES_PER_JOB,
+        lambda dest_file: title_journals[dest_file].mark_done(dest_file),
+    )
+    num_failed = upscale_queue.run(pending_files)
+    if num_failed:
+        logging.error(f"Failed to upscayl {num_failed} files.")
 
     logging.info(
-        f'Upscayling srce file "{get_abbrev_path(srce_file)}"'
-        f' to dest upscayl file "{get_abbrev_path(dest_file)}".',
+        f"\nTime taken to upscayl all {len(pending_files) - num_failed} files:"
+        f" {int(time.time() - start)}s.",
     )
-    upscale_image_file(srce_file, dest_file, SCALE)
-
-    logging.info(f"\nTime taken to upscayl file: {int(time.time() - start)}s.")
-
-    return True
 
 
 setup_logging(logging.INFO)
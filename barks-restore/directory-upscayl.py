@@ -3,7 +3,7 @@
 import os
 import sys
 
-from src.upscale_image import upscale_image_file
+from src.upscale_image import upscale_image_files
 
 if __name__ == "__main__":
     scale = 4
@@ -18,6 +18,7 @@ if __name__ == "__main__":
         print(f'WARN: Created new output directory: "{output_image_dir}".')
         os.makedirs(output_image_dir)
 
+    in_out_files = []
     for in_filename in os.listdir(input_image_dir):
         in_file = os.path.join(input_image_dir, in_filename)
         if not os.path.isfile(in_file):
@@ -28,4 +29,6 @@ if __name__ == "__main__":
             print(f'WARN: Target file exists - skipping: "{out_file}".')
             continue
 
-        upscale_image_file(in_file, out_file, scale)
+        in_out_files.append((in_file, out_file))
+
+    upscale_image_files(in_out_files, scale)
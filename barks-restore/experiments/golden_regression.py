@@ -0,0 +1,255 @@
+# ruff: noqa: T201
+
+"""Golden output regression check of the restore pipeline and its engines.
+
+The bundled test images are upscaled 4x (with opencv, so upscayl is not needed) and
+restored part by part with each chosen engine config. Each part's outputs are
+compared with golden outputs by SSIM and perceptual hash distance, within the
+tolerance band of the output. Save golden outputs with '--save-golden', then check
+any combination of engine configs against them with '--golden'. A failed check
+gives exit code 1.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import cv2 as cv
+import numpy as np
+from skimage.metrics import structural_similarity
+
+from src.image_io import svg_file_to_image
+from src.remove_alias_artifacts import MedianFilterEngine
+from src.restore_pipeline import RestoreEngines, RestorePipeline
+
+EXPERIMENTS_DIR = Path(__file__).parent
+TEST_IMAGE_FILES = [EXPERIMENTS_DIR / f"test-image-00{i}.jpg" for i in range(1, 4)]
+SCALE = 4
+GOLDEN_FILENAME = "golden.json"
+TILED_MAX_TILE_RSS = 256 * 1024 * 1024
+
+
+@dataclass
+class EngineConfig:
+    engines: RestoreEngines
+    max_tile_rss: int | None = None
+
+
+ENGINE_CONFIGS = {
+    "default": EngineConfig(RestoreEngines()),
+    "histogram-median": EngineConfig(RestoreEngines(median_filter=MedianFilterEngine.HISTOGRAM)),
+    "no-posterize-lut": EngineConfig(RestoreEngines(posterize_lut=False)),
+    "gmic-files": EngineConfig(RestoreEngines(gmic_in_memory=False)),
+    "tiled": EngineConfig(RestoreEngines(), TILED_MAX_TILE_RSS),
+    "original": EngineConfig(
+        RestoreEngines(MedianFilterEngine.NEIGHBOURS, posterize_lut=False, gmic_in_memory=False)
+    ),
+}
+
+
+@dataclass
+class Tolerance:
+    min_ssim: float
+    max_phash_distance: int
+
+
+# The pipeline attribute names of each part's outputs, and how close they must be.
+# Inpainting is a random patch search, so the restored pages get the widest band.
+PART_OUTPUTS = {
+    "part1": {"removed_colors_file": Tolerance(0.999, 0)},
+    "part2": {"smoothed_removed_colors_file": Tolerance(0.99, 2)},
+    "part3": {"dest_svg_restored_file": Tolerance(0.99, 2)},
+    "part4": {
+        "dest_upscayled_restored_file": Tolerance(0.97, 4),
+        "dest_restored_file": Tolerance(0.97, 4),
+    },
+}
+
+
+def get_phash(image: cv.typing.MatLike) -> int:
+    """Return the 64 bit DCT perceptual hash of an image."""
+    gray_image = _get_compare_image(image).astype(np.float32)
+    small_image = cv.resize(gray_image, (32, 32), interpolation=cv.INTER_AREA)
+    low_freqs = cv.dct(small_image)[:8, :8].ravel()[1:]
+    bits = low_freqs > np.median(low_freqs)
+
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def get_phash_distance(phash1: int, phash2: int) -> int:
+    return (phash1 ^ phash2).bit_count()
+
+
+def _get_compare_image(image: cv.typing.MatLike) -> cv.typing.MatLike:
+    if image.ndim == 2:
+        return image
+    if image.shape[2] == 4:
+        # Rasterized svg - the black ink is all in the alpha channel.
+        return image[:, :, 3]
+    return cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+
+
+def read_output_image(out_file: str) -> cv.typing.MatLike:
+    if out_file.endswith(".svg"):
+        return svg_file_to_image(out_file)
+
+    image = cv.imread(out_file, cv.IMREAD_UNCHANGED)
+    if image is None:
+        msg = f'Could not read output file "{out_file}".'
+        raise FileNotFoundError(msg)
+    return image
+
+
+def get_restore_pipeline(srce_file: Path, config: EngineConfig, run_dir: str) -> RestorePipeline:
+    work_dir = os.path.join(run_dir, "work")
+    out_dir = os.path.join(run_dir, "out")
+    os.makedirs(work_dir, exist_ok=True)
+    os.makedirs(out_dir, exist_ok=True)
+
+    srce_image = cv.imread(str(srce_file))
+    upscale_file = Path(os.path.join(run_dir, f"{srce_file.stem}.png"))
+    cv.imwrite(
+        str(upscale_file),
+        cv.resize(srce_image, (0, 0), fx=SCALE, fy=SCALE, interpolation=cv.INTER_CUBIC),
+    )
+
+    return RestorePipeline(
+        work_dir,
+        srce_file,
+        upscale_file,
+        SCALE,
+        Path(os.path.join(out_dir, f"{srce_file.stem}.png")),
+        Path(os.path.join(out_dir, f"{srce_file.stem}-upscayled.png")),
+        Path(os.path.join(out_dir, f"{srce_file.stem}.svg")),
+        config.max_tile_rss,
+        engines=config.engines,
+    )
+
+
+def run_part(proc: RestorePipeline, part: str) -> float:
+    start = time.perf_counter()
+
+    if part == "part1":
+        proc.do_part1()
+    elif part == "part2":
+        proc.do_part2_memory_hungry()
+    elif part == "part3":
+        proc.do_part3()
+    else:
+        assert part == "part4"
+        proc.do_part4_memory_hungry()
+
+    return time.perf_counter() - start
+
+
+def save_golden(golden_dir: str, config_name: str, run_root: str) -> None:
+    golden_phashes: dict[str, dict[str, str]] = {}
+
+    for srce_file in TEST_IMAGE_FILES:
+        proc = get_restore_pipeline(
+            srce_file, ENGINE_CONFIGS[config_name], os.path.join(run_root, srce_file.stem)
+        )
+        image_golden_dir = os.path.join(golden_dir, srce_file.stem)
+        os.makedirs(image_golden_dir, exist_ok=True)
+        golden_phashes[srce_file.stem] = {}
+
+        for part, outputs in PART_OUTPUTS.items():
+            run_part(proc, part)
+            for output in outputs:
+                image = read_output_image(getattr(proc, output))
+                cv.imwrite(os.path.join(image_golden_dir, f"{output}.png"), image)
+                golden_phashes[srce_file.stem][output] = f"{get_phash(image):016x}"
+
+        if proc.errors_occurred:
+            print(f'ERROR: Restore of "{srce_file.name}" failed - golden outputs not saved.')
+            sys.exit(1)
+
+    with open(os.path.join(golden_dir, GOLDEN_FILENAME), "w") as f:
+        json.dump({"config": config_name, "phashes": golden_phashes}, f, indent=4)
+
+    print(f'Saved "{config_name}" golden outputs to "{golden_dir}".')
+
+
+def check_against_golden(golden_dir: str, config_names: list[str], run_root: str) -> bool:
+    with open(os.path.join(golden_dir, GOLDEN_FILENAME)) as f:
+        golden_phashes = json.load(f)["phashes"]
+
+    print(
+        f"{'image':<16} {'config':<18} {'part':<6} {'secs':>7}"
+        f"  {'output':<30} {'ssim':>7} {'phash':>6}  result"
+    )
+    all_passed = True
+
+    for srce_file in TEST_IMAGE_FILES:
+        for config_name in config_names:
+            proc = get_restore_pipeline(
+                srce_file,
+                ENGINE_CONFIGS[config_name],
+                os.path.join(run_root, config_name, srce_file.stem),
+            )
+
+            for part, outputs in PART_OUTPUTS.items():
+                part_secs = run_part(proc, part)
+                for output, tolerance in outputs.items():
+                    try:
+                        golden_image = read_output_image(
+                            os.path.join(golden_dir, srce_file.stem, f"{output}.png")
+                        )
+                        golden_phash = int(golden_phashes[srce_file.stem][output], 16)
+                        image = read_output_image(getattr(proc, output))
+                        ssim = structural_similarity(
+                            _get_compare_image(golden_image), _get_compare_image(image)
+                        )
+                        phash_distance = get_phash_distance(golden_phash, get_phash(image))
+                    except (FileNotFoundError, KeyError, ValueError) as e:
+                        logging.error(f'Could not compare "{output}": {e}')
+                        ssim, phash_distance = 0.0, 64
+
+                    passed = (
+                        ssim >= tolerance.min_ssim
+                        and phash_distance <= tolerance.max_phash_distance
+                    )
+                    all_passed = all_passed and passed
+                    print(
+                        f"{srce_file.stem:<16} {config_name:<18} {part:<6} {part_secs:>7.2f}"
+                        f"  {output:<30} {ssim:>7.4f} {phash_distance:>6}"
+                        f"  {'pass' if passed else 'FAIL'}"
+                    )
+
+    return all_passed
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.WARNING)
+
+    parser = argparse.ArgumentParser(description="Check restore outputs against golden outputs.")
+    parser.add_argument("--save-golden", help="save golden outputs to this directory")
+    parser.add_argument("--golden", help="check against the golden outputs in this directory")
+    parser.add_argument(
+        "--configs",
+        nargs="+",
+        default=["default"],
+        choices=list(ENGINE_CONFIGS),
+        help="engine configs to run - the first one is used for '--save-golden'",
+    )
+    parser.add_argument("--work-dir", help="keep the restore outputs in this directory")
+    args = parser.parse_args()
+
+    if not args.save_golden and not args.golden:
+        parser.error("one of '--save-golden' or '--golden' is needed")
+
+    with tempfile.TemporaryDirectory(prefix="golden-regression-") as temp_dir:
+        run_root_dir = args.work_dir if args.work_dir else temp_dir
+
+        if args.save_golden:
+            save_golden(args.save_golden, args.configs[0], os.path.join(run_root_dir, "golden"))
+
+        if args.golden and not check_against_golden(args.golden, args.configs, run_root_dir):
+            print("\nGolden output check failed.")
+            sys.exit(1)
@@ -0,0 +1,227 @@
+# ruff: noqa: T201
+
+"""Throughput benchmark of the restore kernels on the bundled test images.
+
+The test images are upscaled to 1x, 2x and 4x synthetic page sizes, and each kernel
+is timed on each size, best of a few repeats. Megapixels per second and the peak RSS
+over the starting RSS are reported. Save a baseline with '--save-baseline', then
+compare later runs against it with '--baseline' - a kernel slower than the baseline
+by more than the tolerance, or with a peak RSS bigger than the baseline by more than
+the RSS tolerance, is a regression, and the exit code is 1.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from collections.abc import Callable
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import cv2 as cv
+import numpy as np
+import psutil
+
+from src.image_io import resize_image_file, svg_file_to_png, write_cv_image_file
+from src.memory_profile import PeakRssMonitor
+from src.remove_alias_artifacts import get_median_filter
+from src.remove_colors import (
+    get_color_counts,
+    posterize_and_remove_colors,
+    posterize_image,
+    remove_colors,
+)
+from src.vtracer_to_svg import image_file_to_svg
+
+EXPERIMENTS_DIR = Path(__file__).parent
+TEST_IMAGE_FILES = [EXPERIMENTS_DIR / f"test-image-00{i}.jpg" for i in range(1, 4)]
+SCALES = [1, 2, 4]
+NUM_REPEATS = 3
+DEFAULT_TOLERANCE = 0.15
+DEFAULT_RSS_TOLERANCE = 0.25
+# Peak RSS growth under this is sampling noise, however small the baseline peak.
+MIN_RSS_REGRESSION_MB = 16.0
+RSS_SAMPLE_INTERVAL_SECS = 0.01
+
+
+@dataclass
+class KernelResult:
+    kernel: str
+    scale: int
+    megapixels: float
+    best_secs: float
+    megapixels_per_sec: float
+    peak_rss_mb: float
+
+
+@dataclass
+class BenchInputs:
+    image: cv.typing.MatLike
+    image_file: str
+    black_ink_file: str
+    svg_file: str
+    work_dir: str
+
+
+def get_kernels() -> dict[str, Callable[[BenchInputs], None]]:
+    return {
+        "get_median_filter": lambda inputs: get_median_filter(inputs.image),
+        "posterize_image": lambda inputs: posterize_image(inputs.image.copy()),
+        "remove_colors": lambda inputs: remove_colors(cv.cvtColor(inputs.image, cv.COLOR_BGR2BGRA)),
+        "posterize_and_remove_colors": lambda inputs: posterize_and_remove_colors(inputs.image),
+        "get_color_counts": lambda inputs: get_color_counts(inputs.image),
+        "image_file_to_svg": lambda inputs: image_file_to_svg(
+            inputs.black_ink_file, os.path.join(inputs.work_dir, "out.svg")
+        ),
+        "svg_file_to_png": lambda inputs: svg_file_to_png(
+            inputs.svg_file, os.path.join(inputs.work_dir, "out-svg.png")
+        ),
+        "write_cv_image_file": lambda inputs: write_cv_image_file(
+            os.path.join(inputs.work_dir, "out.png"), inputs.image, {"Benchmark": "1"}
+        ),
+        "resize_image_file": lambda inputs: resize_image_file(
+            inputs.image_file, 4, os.path.join(inputs.work_dir, "out-resized.png"), {}
+        ),
+    }
+
+
+def get_test_image(scale: int) -> cv.typing.MatLike:
+    # The test images side by side, so a 1x image is about a 2x page.
+    images = [cv.imread(str(f)) for f in TEST_IMAGE_FILES]
+    height = min(image.shape[0] for image in images)
+    image = np.hstack([image[:height] for image in images])
+
+    if scale == 1:
+        return image
+    return cv.resize(image, (0, 0), fx=scale, fy=scale, interpolation=cv.INTER_CUBIC)
+
+
+def get_bench_inputs(scale: int, work_dir: str) -> BenchInputs:
+    image = get_test_image(scale)
+
+    image_file = os.path.join(work_dir, "in.png")
+    cv.imwrite(image_file, image)
+
+    # Black ink only, like the smoothed color removed image the svg is traced from.
+    gray_image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+    _, black_ink_image = cv.threshold(gray_image, 100, 255, cv.THRESH_BINARY)
+    black_ink_file = os.path.join(work_dir, "black-ink.png")
+    cv.imwrite(black_ink_file, black_ink_image)
+
+    svg_file = os.path.join(work_dir, "black-ink.svg")
+    image_file_to_svg(black_ink_file, svg_file)
+
+    return BenchInputs(image, image_file, black_ink_file, svg_file, work_dir)
+
+
+def run_kernel(
+    name: str, kernel: Callable[[BenchInputs], None], inputs: BenchInputs, scale: int
+) -> KernelResult:
+    process = psutil.Process()
+    best_secs = float("inf")
+    peak_rss = 0
+
+    for _ in range(NUM_REPEATS):
+        start_rss = process.memory_info().rss
+        with PeakRssMonitor(RSS_SAMPLE_INTERVAL_SECS) as rss_monitor:
+            start = time.perf_counter()
+            kernel(inputs)
+            best_secs = min(best_secs, time.perf_counter() - start)
+        peak_rss = max(peak_rss, rss_monitor.peak_rss - start_rss)
+
+    megapixels = inputs.image.shape[0] * inputs.image.shape[1] / 1e6
+
+    return KernelResult(
+        name,
+        scale,
+        megapixels,
+        best_secs,
+        megapixels / best_secs,
+        peak_rss / (1024 * 1024),
+    )
+
+
+def get_regressions(
+    results: list[KernelResult], baseline: list[dict], tolerance: float, rss_tolerance: float
+) -> list[str]:
+    baseline_results = {(r["kernel"], r["scale"]): r for r in baseline}
+
+    regressions = []
+    for result in results:
+        baseline_result = baseline_results.get((result.kernel, result.scale))
+        if baseline_result is None:
+            continue
+        min_megapixels_per_sec = baseline_result["megapixels_per_sec"] * (1.0 - tolerance)
+        if result.megapixels_per_sec < min_megapixels_per_sec:
+            regressions.append(
+                f"{result.kernel} {result.scale}x: {result.megapixels_per_sec:.2f} MP/s,"
+                f" baseline {baseline_result['megapixels_per_sec']:.2f} MP/s."
+            )
+        max_peak_rss_mb = max(
+            baseline_result["peak_rss_mb"] * (1.0 + rss_tolerance),
+            baseline_result["peak_rss_mb"] + MIN_RSS_REGRESSION_MB,
+        )
+        if result.peak_rss_mb > max_peak_rss_mb:
+            regressions.append(
+                f"{result.kernel} {result.scale}x: {result.peak_rss_mb:.0f} peak MB,"
+                f" baseline {baseline_result['peak_rss_mb']:.0f} peak MB."
+            )
+
+    return regressions
+
+
+def print_results(results: list[KernelResult]) -> None:
+    print(f"{'kernel':<28} {'scale':>5} {'MP':>7} {'best s':>8} {'MP/s':>8} {'peak MB':>8}")
+    for r in results:
+        print(
+            f"{r.kernel:<28} {r.scale:>4}x {r.megapixels:>7.2f} {r.best_secs:>8.3f}"
+            f" {r.megapixels_per_sec:>8.2f} {r.peak_rss_mb:>8.0f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the restore kernels.")
+    parser.add_argument("--kernels", nargs="+", help="only run these kernels")
+    parser.add_argument("--scales", nargs="+", type=int, default=SCALES)
+    parser.add_argument("--baseline", help="compare against this baseline json file")
+    parser.add_argument("--save-baseline", help="save the results to this baseline json file")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--rss-tolerance", type=float, default=DEFAULT_RSS_TOLERANCE)
+    args = parser.parse_args()
+
+    kernels = get_kernels()
+    kernel_names = args.kernels if args.kernels else list(kernels)
+    for kernel_name in kernel_names:
+        if kernel_name not in kernels:
+            print(f'ERROR: Unknown kernel "{kernel_name}".')
+            sys.exit(1)
+
+    bench_results = []
+    for bench_scale in args.scales:
+        with tempfile.TemporaryDirectory(prefix="kernel-benchmark-") as bench_work_dir:
+            bench_inputs = get_bench_inputs(bench_scale, bench_work_dir)
+            for kernel_name in kernel_names:
+                bench_results.append(
+                    run_kernel(kernel_name, kernels[kernel_name], bench_inputs, bench_scale)
+                )
+
+    print_results(bench_results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump([asdict(r) for r in bench_results], f, indent=4)
+        print(f'\nSaved baseline "{args.save_baseline}".')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            bench_regressions = get_regressions(
+                bench_results, json.load(f), args.tolerance, args.rss_tolerance
+            )
+        if bench_regressions:
+            print(f"\n{len(bench_regressions)} regressions:")
+            for regression in bench_regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("\nNo regressions.")
@@ -0,0 +1,263 @@
+# ruff: noqa: T201
+
+"""Tiled versus untiled check of the restore operators that can run in tiles.
+
+Each operator is run on the whole of a crop of each bundled test image, upscaled 4x, and
+again in the smallest tiles, so there are as many tile seams as possible. The tiled output must
+match the untiled output outside the seams as well as it does at the seams. So a halo
+too small for its operator shows up as extra differences along the seams.
+
+The smoothing and the overlay are deterministic, so their tiled outputs must also be
+within a small fraction of changed pixels of the untiled ones. Inpainting is a random
+patch search, so only its seams are compared with its interior. A failed check gives
+exit code 1.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+from collections.abc import Callable
+from dataclasses import dataclass
+from pathlib import Path
+
+import cv2 as cv
+import numpy as np
+
+from src.image_io import svg_file_to_png
+from src.inpaint import INPAINT_TILE_HALO, inpaint_image_file
+from src.overlay import (
+    OVERLAY_TILE_HALO,
+    overlay_inpainted_file_with_black_ink,
+    overlay_inpainted_file_with_black_ink_in_tiles,
+)
+from src.restore_pipeline import RestorePipeline
+from src.smooth_image import get_smooth_tile_halo, smooth_image_file, smooth_image_file_in_tiles
+from src.tiling import MIN_TILE_SIZE
+
+EXPERIMENTS_DIR = Path(__file__).parent
+TEST_IMAGE_FILES = [EXPERIMENTS_DIR / f"test-image-00{i}.jpg" for i in range(1, 4)]
+SCALE = 4
+# Source crop size - big enough for a few tiles each way once upscaled.
+DEFAULT_SRCE_CROP_SIZE = 300
+# Small enough for the smallest tiles.
+MAX_TILE_RSS = 1
+TILE_SIZE = MIN_TILE_SIZE
+# Pixels either side of a tile core edge that count as the seam.
+SEAM_WIDTH = 8
+
+
+@dataclass
+class Tolerance:
+    # Most of the output pixels that may differ from the untiled output, if the
+    # operator is deterministic.
+    max_diff_fraction: float | None
+    # How much worse the mean difference at the seams may be than in the interior.
+    max_seam_to_interior_ratio: float
+    # Mean differences below this are noise, whatever their ratio.
+    min_mean_diff: float
+
+
+TOLERANCES = {
+    # The smoothing normalizes each tile, so a few pixels are off by a level or so anywhere.
+    "smooth": Tolerance(0.02, 2.0, 0.05),
+    "inpaint": Tolerance(None, 1.5, 0.05),
+    "overlay": Tolerance(0.0, 1.0, 0.0),
+}
+
+
+@dataclass
+class TileDiff:
+    diff_fraction: float
+    seam_mean_diff: float
+    interior_mean_diff: float
+
+
+def get_tile_diff(untiled_file: str, tiled_file: str) -> TileDiff:
+    untiled_image = _read_image(untiled_file).astype(np.int16)
+    tiled_image = _read_image(tiled_file).astype(np.int16)
+    diffs = np.abs(untiled_image - tiled_image)
+    if diffs.ndim == 3:
+        diffs = np.max(diffs, axis=2)
+
+    seam_mask = get_seam_mask(diffs.shape[1], diffs.shape[0])
+
+    return TileDiff(
+        float(np.count_nonzero(diffs)) / diffs.size,
+        float(np.mean(diffs[seam_mask])),
+        float(np.mean(diffs[~seam_mask])),
+    )
+
+
+def get_seam_mask(width: int, height: int) -> np.ndarray:
+    seam_mask = np.zeros((height, width), dtype=bool)
+    for x in range(TILE_SIZE, width, TILE_SIZE):
+        seam_mask[:, max(0, x - SEAM_WIDTH) : x + SEAM_WIDTH] = True
+    for y in range(TILE_SIZE, height, TILE_SIZE):
+        seam_mask[max(0, y - SEAM_WIDTH) : y + SEAM_WIDTH, :] = True
+
+    return seam_mask
+
+
+def is_within_tolerance(tile_diff: TileDiff, tolerance: Tolerance) -> bool:
+    if (
+        tolerance.max_diff_fraction is not None
+        and tile_diff.diff_fraction > tolerance.max_diff_fraction
+    ):
+        return False
+    if tile_diff.seam_mean_diff <= tolerance.min_mean_diff:
+        return True
+
+    return (
+        tile_diff.seam_mean_diff
+        <= tolerance.max_seam_to_interior_ratio * tile_diff.interior_mean_diff
+    )
+
+
+def _read_image(image_file: str) -> cv.typing.MatLike:
+    image = cv.imread(image_file, cv.IMREAD_UNCHANGED)
+    if image is None:
+        msg = f'Could not read image file "{image_file}".'
+        raise FileNotFoundError(msg)
+    return image
+
+
+def get_operator_inputs(srce_file: Path, srce_crop_size: int, run_dir: str) -> RestorePipeline:
+    """Run the untiled restore up to the svg, for the inputs of the tiled operators."""
+    work_dir = os.path.join(run_dir, "work")
+    out_dir = os.path.join(run_dir, "out")
+    os.makedirs(work_dir, exist_ok=True)
+    os.makedirs(out_dir, exist_ok=True)
+
+    srce_image = _get_centre_crop(cv.imread(str(srce_file)), srce_crop_size)
+    crop_srce_file = Path(os.path.join(run_dir, f"{srce_file.stem}-crop.png"))
+    cv.imwrite(str(crop_srce_file), srce_image)
+    upscale_file = Path(os.path.join(run_dir, f"{srce_file.stem}.png"))
+    cv.imwrite(
+        str(upscale_file),
+        cv.resize(srce_image, (0, 0), fx=SCALE, fy=SCALE, interpolation=cv.INTER_CUBIC),
+    )
+
+    proc = RestorePipeline(
+        work_dir,
+        crop_srce_file,
+        upscale_file,
+        SCALE,
+        Path(os.path.join(out_dir, f"{srce_file.stem}.png")),
+        Path(os.path.join(out_dir, f"{srce_file.stem}-upscayled.png")),
+        Path(os.path.join(out_dir, f"{srce_file.stem}.svg")),
+    )
+    proc.do_part1()
+    proc.do_part2_memory_hungry()
+    proc.do_part3()
+    svg_file_to_png(proc.dest_svg_restored_file, proc.png_of_svg_file)
+
+    if proc.errors_occurred:
+        msg = f'Could not make the operator inputs for "{srce_file.name}".'
+        raise RuntimeError(msg)
+
+    return proc
+
+
+def _get_centre_crop(image: cv.typing.MatLike, crop_size: int) -> cv.typing.MatLike:
+    top = max(0, (image.shape[0] - crop_size) // 2)
+    left = max(0, (image.shape[1] - crop_size) // 2)
+    return image[top : top + crop_size, left : left + crop_size]
+
+
+def get_operator_runs(
+    proc: RestorePipeline,
+) -> dict[str, tuple[int, Callable[[str, bool], None]]]:
+    """Return the halo of each operator, and a function to run it tiled or untiled."""
+    work_dir = proc.work_dir
+    stem = proc.srce_upscale_stem
+
+    def run_smooth(out_file: str, tiled: bool) -> None:
+        if tiled:
+            smooth_image_file_in_tiles(
+                work_dir, stem, proc.removed_colors_file, out_file, MAX_TILE_RSS
+            )
+        else:
+            smooth_image_file(proc.removed_colors_file, out_file)
+
+    def run_inpaint(out_file: str, tiled: bool) -> None:
+        inpaint_image_file(
+            work_dir,
+            stem,
+            str(proc.srce_upscale_file),
+            proc.removed_colors_file,
+            out_file,
+            MAX_TILE_RSS if tiled else None,
+        )
+
+    def run_overlay(out_file: str, tiled: bool) -> None:
+        if tiled:
+            overlay_inpainted_file_with_black_ink_in_tiles(
+                work_dir, stem, proc.inpainted_file, proc.png_of_svg_file, out_file, MAX_TILE_RSS
+            )
+        else:
+            overlay_inpainted_file_with_black_ink(
+                proc.inpainted_file, proc.png_of_svg_file, out_file
+            )
+
+    return {
+        "smooth": (get_smooth_tile_halo(), run_smooth),
+        "inpaint": (INPAINT_TILE_HALO, run_inpaint),
+        # The overlay input is the untiled inpaint output.
+        "overlay": (OVERLAY_TILE_HALO, run_overlay),
+    }
+
+
+def check_tiled_operators(srce_crop_size: int, run_root: str) -> bool:
+    print(
+        f"{'image':<16} {'operator':<9} {'halo':>5} {'changed %':>10}"
+        f" {'seam diff':>10} {'interior diff':>14}  result"
+    )
+    all_passed = True
+
+    for srce_file in TEST_IMAGE_FILES:
+        run_dir = os.path.join(run_root, srce_file.stem)
+        proc = get_operator_inputs(srce_file, srce_crop_size, run_dir)
+
+        for operator, (halo, run_operator) in get_operator_runs(proc).items():
+            untiled_file = os.path.join(run_dir, f"{operator}-untiled.png")
+            tiled_file = os.path.join(run_dir, f"{operator}-tiled.png")
+            run_operator(untiled_file, False)
+            run_operator(tiled_file, True)
+            if operator == "inpaint":
+                os.replace(untiled_file, proc.inpainted_file)
+                untiled_file = proc.inpainted_file
+
+            tile_diff = get_tile_diff(untiled_file, tiled_file)
+            passed = is_within_tolerance(tile_diff, TOLERANCES[operator])
+            all_passed = all_passed and passed
+            print(
+                f"{srce_file.stem:<16} {operator:<9} {halo:>5}"
+                f" {100 * tile_diff.diff_fraction:>10.3f}"
+                f" {tile_diff.seam_mean_diff:>10.3f} {tile_diff.interior_mean_diff:>14.3f}"
+                f"  {'pass' if passed else 'FAIL'}"
+            )
+
+    return all_passed
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.WARNING)
+
+    parser = argparse.ArgumentParser(description="Check tiled against untiled operator outputs.")
+    parser.add_argument(
+        "--srce-crop-size",
+        type=int,
+        default=DEFAULT_SRCE_CROP_SIZE,
+        help="size of the centre crop of each test image",
+    )
+    parser.add_argument("--work-dir", help="keep the operator outputs in this directory")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="tile-seam-check-") as temp_dir:
+        if not check_tiled_operators(
+            args.srce_crop_size, args.work_dir if args.work_dir else temp_dir
+        ):
+            print("\nTiled output check failed.")
+            sys.exit(1)
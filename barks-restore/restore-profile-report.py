@@ -0,0 +1,26 @@
+# ruff: noqa: T201
+
+import os
+import sys
+
+from src.stage_profile import get_stage_profile_report, read_stage_profile_records
+
+NUM_SLOWEST_PAGES = 10
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: restore-profile-report.py <profile file or dir> ...")
+        sys.exit(1)
+
+    profile_paths = sys.argv[1:]
+    for profile_path in profile_paths:
+        if not os.path.exists(profile_path):
+            print(f'ERROR: Can\'t find profile file or directory: "{profile_path}".')
+            sys.exit(1)
+
+    records = read_stage_profile_records(profile_paths)
+    if not records:
+        print("No profile records found.")
+        sys.exit(0)
+
+    print(get_stage_profile_report(records, NUM_SLOWEST_PAGES))
@@ -26,6 +26,7 @@ if __name__ == "__main__":
     dest_restored_file = Path(sys.argv[3])
     dest_upscayled_restored_file = Path(sys.argv[4])
     dest_svg_restored_file = Path(sys.argv[5])
+    keep_work_files = len(sys.argv) >= 7 and sys.argv[6] == "--keep-work-files"
 
     out_dir = os.path.dirname(dest_restored_file)
     if not os.path.isdir(out_dir):
@@ -48,6 +49,7 @@ if __name__ == "__main__":
         dest_restored_file,
         dest_upscayled_restored_file,
         dest_svg_restored_file,
+        keep_work_files=keep_work_files,
     )
     restore_process.do_part1()
     restore_process.do_part2_memory_hungry()
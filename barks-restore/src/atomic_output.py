@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+JOURNAL_DIR = os.path.join(str(Path.home()), ".local/share/barks-restore/journals")
+JOURNAL_FILE_EXT = ".journal"
+
+
+@contextmanager
+def atomic_output_file(file: str, do_fsync: bool = True) -> Iterator[str]:
+    """Yield a temp file to write instead of 'file', then rename it to 'file'.
+
+    The temp file is in the same directory and has the same extension, so writers that
+    go by the extension still work and the rename is atomic. So 'file' either does not
+    exist or is complete - a crash or kill mid write only leaves a temp file behind.
+    """
+    out_stem, out_ext = os.path.splitext(file)
+    temp_file = f"{out_stem}.tmp-{os.getpid()}{out_ext}"
+
+    try:
+        yield temp_file
+        if do_fsync:
+            _fsync_file(temp_file)
+        os.replace(temp_file, file)
+    except BaseException:
+        if os.path.isfile(temp_file):
+            os.remove(temp_file)
+        raise
+
+    if do_fsync:
+        _fsync_dir(os.path.dirname(os.path.abspath(file)))
+
+
+def _fsync_file(file: str) -> None:
+    fd = os.open(file, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_dir(dir_path: str) -> None:
+    fd = os.open(dir_path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class TitleJournal:
+    """Record of the outputs a batch command has finished for a title.
+
+    A batch run checks the journal instead of the output files, so an interrupted run
+    resumes with the first unfinished output. Done outputs are appended one per line,
+    which is safe from many worker processes. An output deleted since it was done is
+    not done, so it gets rebuilt.
+    """
+
+    def __init__(self, journal_file: str) -> None:
+        self._journal_file = journal_file
+        self._done: set[str] = set()
+
+        if os.path.isfile(self._journal_file):
+            with open(self._journal_file) as f:
+                self._done = {line.rstrip("\n") for line in f if line.strip()}
+
+    def is_done(self, out_file: str) -> bool:
+        return str(out_file) in self._done and os.path.isfile(out_file)
+
+    def mark_done(self, out_file: str) -> None:
+        out_file = str(out_file)
+        if out_file in self._done:
+            return
+
+        with open(self._journal_file, "a") as f:
+            f.write(out_file + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._done.add(out_file)
+
+
+def get_title_journal(command: str, title: str, out_files: list[str]) -> TitleJournal:
+    """Return the journal of 'command' for 'title' and the dest dir of its 'out_files'.
+
+    Any of 'out_files' that exist but are not in the journal are added to it. Outputs
+    are written atomically, so an existing output is complete, whether it was written
+    before there were journals, by hand, or restored from a backup.
+    """
+    journal_dir = os.path.join(JOURNAL_DIR, command)
+    os.makedirs(journal_dir, exist_ok=True)
+    journal_file = os.path.join(
+        journal_dir, f"{title}-{_get_out_dir_key(out_files)}{JOURNAL_FILE_EXT}"
+    )
+
+    journal = TitleJournal(journal_file)
+
+    unjournaled_out_files = [f for f in out_files if not journal.is_done(f) and os.path.isfile(f)]
+    if unjournaled_out_files:
+        logging.info(
+            f"Adding {len(unjournaled_out_files)} existing outputs to the {command}"
+            f' journal for "{title}".'
+        )
+    for out_file in unjournaled_out_files:
+        journal.mark_done(out_file)
+    if not os.path.isfile(journal_file):
+        Path(journal_file).touch()
+
+    return journal
+
+
+def _get_out_dir_key(out_files: list[str]) -> str:
+    # Titles under two volume roots, or a moved dest dir, must not share a journal.
+    out_dir = (
+        os.path.commonpath([os.path.dirname(os.path.abspath(f)) for f in out_files])
+        if out_files
+        else ""
+    )
+    return hashlib.sha256(out_dir.encode()).hexdigest()[:12]
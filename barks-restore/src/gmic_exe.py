@@ -1,8 +1,39 @@
+from __future__ import annotations
+
 import logging
 import subprocess
 
+import cv2 as cv
+import numpy as np
+
+try:
+    import gmic
+except ImportError:
+    gmic = None
+
+# With the gmic python binding, commands run in a long-lived interpreter in this
+# process instead of a new gmic process per command.
+USE_GMIC_BINDING = gmic is not None
+
+_gmic_interpreter = None
+
+
+def _get_gmic_interpreter() -> gmic.Gmic:
+    global _gmic_interpreter  # noqa: PLW0603
+
+    # One interpreter per process (so per pool worker) - the G'MIC stdlib only gets
+    # parsed the first time.
+    if _gmic_interpreter is None:
+        _gmic_interpreter = gmic.Gmic()
+
+    return _gmic_interpreter
+
 
 def run_gmic(params: list[str]) -> None:
+    if USE_GMIC_BINDING:
+        _run_gmic_binding(params)
+        return
+
     gmic_path = "gmic"
     run_args = [gmic_path, "-v", "+1"]
     run_args.extend(params)
@@ -21,3 +52,52 @@ def run_gmic(params: list[str]) -> None:
     rc = process.poll()
     if rc != 0:
         raise RuntimeError("Gmic failed.")
+
+
+def _run_gmic_binding(params: list[str]) -> None:
+    # Quote any items with spaces (e.g., file paths) so the interpreter sees the same
+    # items as the gmic command line would.
+    cmd = " ".join(f'"{param}"' if " " in param else param for param in ["-v", "+1", *params])
+
+    logging.debug(f"Running gmic binding: {cmd}.")
+
+    try:
+        _get_gmic_interpreter().run(cmd)
+    except gmic.GmicException as e:
+        msg = f"Gmic failed: {e}"
+        raise RuntimeError(msg) from e
+
+
+def run_gmic_on_images(
+    params: list[str], images: list[cv.typing.MatLike]
+) -> list[cv.typing.MatLike]:
+    """Run gmic commands on in-memory BGR or BGRA images and return the result images.
+
+    Needs the gmic python binding. Images are passed to gmic as RGB or RGBA, so color
+    arguments in 'params' are RGB, just as for 'run_gmic' with image files.
+    """
+    if not USE_GMIC_BINDING:
+        msg = "The gmic python binding is needed to run gmic on in-memory images."
+        raise RuntimeError(msg)
+
+    cmd = " ".join(params)
+    logging.debug(f"Running gmic binding on {len(images)} images: {cmd}.")
+
+    image_list = gmic.ImageList([gmic.Image.from_yxc(_swap_red_blue(image)) for image in images])
+    try:
+        out_image_list = _get_gmic_interpreter().run(cmd, image_list)
+    except gmic.GmicException as e:
+        msg = f"Gmic failed: {e}"
+        raise RuntimeError(msg) from e
+
+    return [_swap_red_blue(np.asarray(image.yxc)) for image in out_image_list]
+
+
+def _swap_red_blue(image: cv.typing.MatLike) -> cv.typing.MatLike:
+    if image.ndim == 2:
+        return image
+    if image.shape[2] == 1:
+        return image[:, :, 0]
+    if image.shape[2] == 3:
+        return cv.cvtColor(image, cv.COLOR_BGR2RGB)
+    return cv.cvtColor(image, cv.COLOR_BGRA2RGBA)
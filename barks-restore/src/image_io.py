@@ -3,11 +3,13 @@
 from __future__ import annotations
 
 import os
-from io import BytesIO
+from enum import Enum, auto
 
-import cairosvg
 import cv2 as cv
+import numpy as np
 from barks_fantagraphics.comics_consts import JPG_FILE_EXT, PNG_FILE_EXT
+from cairosvg.parser import Tree
+from cairosvg.surface import PNGSurface
 from comic_utils.pil_image_utils import (
     METADATA_PROPERTY_GROUP,
     SAVE_JPG_COMPRESS_LEVEL,
@@ -18,32 +20,101 @@ from comic_utils.pil_image_utils import (
 from PIL import Image
 from PIL.PngImagePlugin import PngInfo
 
-from .gmic_exe import run_gmic
+from .atomic_output import atomic_output_file
+from .gmic_exe import run_gmic, run_gmic_on_images
 
 Image.MAX_IMAGE_PIXELS = None
 
+SVG_DPI = 96
+
+# Scratch files are read back soon after, or only kept for debugging, so favour write
+# speed over size.
+SCRATCH_PNG_COMPRESSION = 1
+
+
+class ImageWriteProfile(Enum):
+    # Final outputs - written by PIL with full compression and metadata.
+    ARCHIVAL = auto()
+    # Work files - written by opencv with fast compression, no metadata and no color
+    # conversion copy. Single channel 0/255 masks are written as 1-bit.
+    SCRATCH = auto()
+
 
 def svg_file_to_png(svg_file: str, png_file: str) -> None:
+    write_bgra_png_file(png_file, svg_file_to_image(svg_file))
+
+
+def svg_file_to_image(svg_file: str) -> cv.typing.MatLike:
+    """Rasterize an svg file straight to a BGRA image - no png encode and decode."""
+    return _svg_tree_to_image(Tree(url=svg_file))
+
+
+def svg_to_image(svg: str) -> cv.typing.MatLike:
+    """Rasterize svg text straight to a BGRA image."""
+    return _svg_tree_to_image(Tree(bytestring=svg.encode()))
+
+
+def _svg_tree_to_image(tree: Tree) -> cv.typing.MatLike:
     # background_color = "white"
     background_color = None
-    png_image = cairosvg.svg2png(url=svg_file, scale=1, background_color=background_color)
+    # With no output, the surface is only rendered in memory.
+    surface = PNGSurface(tree, None, SVG_DPI, scale=1, background_color=background_color)
+
+    cairo_surface = surface.cairo
+    cairo_surface.flush()
+    width = cairo_surface.get_width()
+    height = cairo_surface.get_height()
+    # Cairo ARGB32 is native endian, so BGRA byte order here.
+    surface_data = np.frombuffer(cairo_surface.get_data(), dtype=np.uint8).reshape(
+        height, cairo_surface.get_stride() // 4, 4
+    )
+    image = surface_data[:, :width].copy()
+    surface.finish()
+
+    _unpremultiply_alpha(image)
+
+    return image
+
+
+def _unpremultiply_alpha(image: cv.typing.MatLike) -> None:
+    # Cairo colors are premultiplied by alpha. Undo it the same way cairo does when
+    # writing a png. Only the anti-aliased edge pixels need it - fully transparent
+    # pixels are already zero and opaque pixels are unchanged.
+    alpha = image[:, :, 3]
+    ys, xs = np.nonzero((alpha > 0) & (alpha < 255))
+    edge_alpha = alpha[ys, xs].astype(np.uint32)[:, np.newaxis]
+    edge_colors = image[ys, xs, :3].astype(np.uint32)
+    image[ys, xs, :3] = ((edge_colors * 255 + edge_alpha // 2) // edge_alpha).astype(np.uint8)
 
-    pil_image = Image.open(BytesIO(png_image))
-    pil_image.save(png_file, optimize=True, compress_level=SAVE_PNG_COMPRESSION)
+
+def write_bgra_png_file(png_file: str, image: cv.typing.MatLike) -> None:
+    pil_image = Image.fromarray(cv.cvtColor(image, cv.COLOR_BGRA2RGBA))
+    with atomic_output_file(png_file) as temp_png_file:
+        pil_image.save(temp_png_file, optimize=True, compress_level=SAVE_PNG_COMPRESSION)
 
 
 def write_cv_image_file(
-    file: str, image: cv.typing.MatLike, metadata: dict[str, str] | None = None
+    file: str,
+    image: cv.typing.MatLike,
+    metadata: dict[str, str] | None = None,
+    profile: ImageWriteProfile = ImageWriteProfile.ARCHIVAL,
 ) -> None:
-    if os.path.splitext(file)[1] == JPG_FILE_EXT:
-        _write_cv_jpeg_file(file, image, metadata)
+    if profile == ImageWriteProfile.SCRATCH:
+        _write_cv_scratch_file(file, image)
         return
 
-    if os.path.splitext(file)[1] == PNG_FILE_EXT:
-        _write_cv_png_file(file, image, metadata)
-        return
+    # Final outputs must never be left half written.
+    with atomic_output_file(file) as temp_file:
+        if os.path.splitext(file)[1] == JPG_FILE_EXT:
+            _write_cv_jpeg_file(temp_file, image, metadata)
+        elif os.path.splitext(file)[1] == PNG_FILE_EXT:
+            _write_cv_png_file(temp_file, image, metadata)
+        else:
+            cv.imwrite(temp_file, image)
 
-    cv.imwrite(file, image)
+
+def write_work_image_file(file: str, image: cv.typing.MatLike) -> None:
+    write_cv_image_file(file, image, profile=ImageWriteProfile.SCRATCH)
 
 
 def resize_image_file(
@@ -72,20 +143,65 @@ def _resize_jpeg_file(
 def _resize_png_file(
     in_file: str, srce_scale: int, resized_file: str, metadata: dict[str, str]
 ) -> None:
+    with atomic_output_file(resized_file) as temp_resized_file:
+        resize_cmd = [
+            in_file,
+            *get_gmic_resize_params(srce_scale),
+            "output[-1]",
+            temp_resized_file,
+        ]
+
+        run_gmic(resize_cmd)
+
+        add_png_metadata(temp_resized_file, metadata)
+
+
+def resize_image(image: cv.typing.MatLike, srce_scale: int) -> cv.typing.MatLike:
+    return run_gmic_on_images(get_gmic_resize_params(srce_scale), [image])[-1]
+
+
+def resize_image_to_file(
+    image: cv.typing.MatLike, srce_scale: int, resized_file: str, metadata: dict[str, str]
+) -> None:
+    """In-memory version of 'resize_image_file' - same resize methods, same output."""
+    if os.path.splitext(resized_file)[1] == JPG_FILE_EXT:
+        scale = 1.0 / srce_scale
+        image = cv.resize(image, (0, 0), fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+        write_cv_image_file(resized_file, image, metadata)
+        return
+
+    if os.path.splitext(resized_file)[1] == PNG_FILE_EXT:
+        write_cv_image_file(resized_file, resize_image(image, srce_scale), metadata)
+        return
+
+    raise AssertionError
+
+
+def get_gmic_resize_params(srce_scale: int) -> list[str]:
     assert srce_scale in [2, 4]
     scale_percent = 25 if srce_scale == 4 else 50
 
-    resize_cmd = [
-        in_file,
+    return [
         "+resize[-1]",
         f"{scale_percent}%,{scale_percent}%,1,3,2",
-        "output[-1]",
-        resized_file,
     ]
 
-    run_gmic(resize_cmd)
 
-    add_png_metadata(resized_file, metadata)
+def _write_cv_scratch_file(file: str, image: cv.typing.MatLike) -> None:
+    write_params = [cv.IMWRITE_PNG_COMPRESSION, SCRATCH_PNG_COMPRESSION]
+    if _is_binary_mask(image):
+        write_params.extend([cv.IMWRITE_PNG_BILEVEL, 1])
+
+    if not cv.imwrite(file, image, write_params):
+        msg = f'Could not write image file "{file}".'
+        raise OSError(msg)
+
+
+def _is_binary_mask(image: cv.typing.MatLike) -> bool:
+    if image.ndim != 2 or image.dtype != np.uint8:
+        return False
+
+    return cv.countNonZero(cv.inRange(image, 1, 254)) == 0
 
 
 def _write_cv_png_file(file: str, image: cv.typing.MatLike, metadata: dict[str, str]) -> None:
@@ -1,10 +1,22 @@
 import os.path
+from collections.abc import Callable
 
 import cv2 as cv
 import numpy as np
 
-from .gmic_exe import run_gmic
-from .image_io import write_cv_image_file
+from .gmic_exe import run_gmic, run_gmic_on_images
+from .image_io import write_work_image_file
+from .tiling import get_tile_size, process_image_files_in_tiles
+
+INPAINT_PATCH_SIZE = 5
+INPAINT_LOOKUP_SIZE = 26
+
+# Rough peak gmic memory per pixel for the matchpatch inpaint - float channels plus
+# the patch match offset and score maps.
+INPAINT_BYTES_PER_PIXEL = 128
+
+# Inpainted pixels are copied from patches found within the lookup window.
+INPAINT_TILE_HALO = 2 * (INPAINT_LOOKUP_SIZE + INPAINT_PATCH_SIZE)
 
 
 def inpaint_image_file(
@@ -13,6 +25,7 @@ def inpaint_image_file(
     in_file: str,
     black_ink_mask_file: str,
     out_file: str,
+    max_tile_rss: int | None = None,
 ) -> None:
     if not os.path.exists(in_file):
         msg = f'File not found: "{in_file}".'
@@ -21,9 +34,78 @@ def inpaint_image_file(
         msg = f'File not found: "{black_ink_mask_file}".'
         raise FileNotFoundError(msg)
 
+    if max_tile_rss is not None:
+        # The black ink is removed tile by tile too, so no whole page is ever needed.
+        process_image_files_in_tiles(
+            work_dir,
+            f"{work_file_stem}-inpaint",
+            [in_file, black_ink_mask_file],
+            out_file,
+            get_tile_size(max_tile_rss, INPAINT_BYTES_PER_PIXEL, INPAINT_TILE_HALO),
+            INPAINT_TILE_HALO,
+            _inpaint_tile_files,
+        )
+        return
+
     input_image = cv.imread(in_file)
-    assert input_image.shape[2] == 3
     black_ink_mask = cv.imread(black_ink_mask_file, cv.COLOR_BGR2GRAY)
+
+    out_image = _get_black_removed_image(
+        work_dir, work_file_stem, input_image, black_ink_mask, write_work_image_file
+    )
+    in_file_black_removed = _get_black_removed_file(work_dir, work_file_stem)
+    write_work_image_file(in_file_black_removed, out_image)
+
+    _inpaint_black_removed_file(in_file_black_removed, out_file)
+
+
+def _inpaint_tile_files(tile_in_files: list[str], tile_out_file: str) -> None:
+    input_image = cv.imread(tile_in_files[0])
+    black_ink_mask = cv.imread(tile_in_files[1], cv.COLOR_BGR2GRAY)
+    black_removed_file = f"{os.path.splitext(tile_out_file)[0]}-black-removed.png"
+
+    write_work_image_file(
+        black_removed_file,
+        _get_black_removed_image("", "", input_image, black_ink_mask, None),
+    )
+    try:
+        _inpaint_black_removed_file(black_removed_file, tile_out_file)
+    finally:
+        os.remove(black_removed_file)
+
+
+def get_inpainted_image(
+    work_dir: str,
+    work_file_stem: str,
+    input_image: cv.typing.MatLike,
+    black_ink_mask: cv.typing.MatLike,
+    write_work_file: Callable[[str, cv.typing.MatLike], None] | None = None,
+) -> cv.typing.MatLike:
+    """In-memory version of 'inpaint_image_file'.
+
+    The work files are only written if 'write_work_file' is given.
+    """
+    black_removed_image = _get_black_removed_image(
+        work_dir, work_file_stem, input_image, black_ink_mask, write_work_file
+    )
+    if write_work_file:
+        write_work_file(_get_black_removed_file(work_dir, work_file_stem), black_removed_image)
+
+    return inpaint_black_removed_image(black_removed_image)
+
+
+def _get_black_removed_file(work_dir: str, work_file_stem: str) -> str:
+    return os.path.join(work_dir, f"{work_file_stem}-input-black-removed.png")
+
+
+def _get_black_removed_image(
+    work_dir: str,
+    work_file_stem: str,
+    input_image: cv.typing.MatLike,
+    black_ink_mask: cv.typing.MatLike,
+    write_work_file: Callable[[str, cv.typing.MatLike], None] | None,
+) -> cv.typing.MatLike:
+    assert input_image.shape[2] == 3
     assert black_ink_mask.shape[2] == 3
 
     _, remove_mask = cv.threshold(black_ink_mask, 100, 255, cv.THRESH_BINARY_INV)
@@ -32,24 +114,31 @@ def inpaint_image_file(
     _, _, r_remove_mask = cv.split(remove_mask)
 
     remove_mask = np.uint8(r_remove_mask)
-    remove_mask_file = os.path.join(work_dir, f"{work_file_stem}-remove-mask.png")
-    write_cv_image_file(remove_mask_file, remove_mask)
+    if write_work_file:
+        remove_mask_file = os.path.join(work_dir, f"{work_file_stem}-remove-mask.png")
+        write_work_file(remove_mask_file, remove_mask)
 
     # gmic blend/remove - pipeline??
     b, g, r = cv.split(input_image)
     b = np.where(remove_mask == 255, 0, b)
     g = np.where(remove_mask == 255, 0, g)
     r = np.where(remove_mask == 255, 255, r)
-    out_image = cv.merge([b, g, r])
-    in_file_black_removed = os.path.join(work_dir, f"{work_file_stem}-input-black-removed.png")
-    write_cv_image_file(in_file_black_removed, out_image)
+    return cv.merge([b, g, r])
 
-    inpaint_cmd = [
-        in_file_black_removed,
-        "-fx_inpaint_matchpatch",
-        '"1","5","26","5","1","255","0","0","255","1","0"',
-        "output",
-        out_file,
-    ]
+
+def _inpaint_black_removed_file(in_file: str, out_file: str) -> None:
+    inpaint_cmd = [in_file, *get_gmic_inpaint_params(), "output", out_file]
 
     run_gmic(inpaint_cmd)
+
+
+def inpaint_black_removed_image(image: cv.typing.MatLike) -> cv.typing.MatLike:
+    return run_gmic_on_images(get_gmic_inpaint_params(), [image])[-1]
+
+
+def get_gmic_inpaint_params() -> list[str]:
+    # The pixels to inpaint are the pure red (RGB) ones.
+    return [
+        "-fx_inpaint_matchpatch",
+        f'"1","{INPAINT_PATCH_SIZE}","{INPAINT_LOOKUP_SIZE}","5","1","255","0","0","255","1","0"',
+    ]
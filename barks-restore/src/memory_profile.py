@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+
+import psutil
+
+RSS_SAMPLE_INTERVAL_SECS = 0.2
+NUM_RECENT_PEAK_RSS = 20
+
+
+class PeakRssMonitor:
+    """Sample the RSS of this process plus all its children (e.g., gmic) in the background.
+
+    Use as a context manager around a stage. The peak is the largest total seen, which
+    is what has to fit in memory if the stage runs alongside others.
+    """
+
+    def __init__(self, sample_interval_secs: float = RSS_SAMPLE_INTERVAL_SECS) -> None:
+        self._sample_interval_secs = sample_interval_secs
+        self._process = psutil.Process()
+        self._stop_event = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.peak_rss = 0
+
+    def __enter__(self) -> PeakRssMonitor:
+        self.peak_rss = self._get_total_rss()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_args: object) -> None:
+        self._stop_event.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, self._get_total_rss())
+
+    def _sample(self) -> None:
+        while not self._stop_event.wait(self._sample_interval_secs):
+            self.peak_rss = max(self.peak_rss, self._get_total_rss())
+
+    def _get_total_rss(self) -> int:
+        total_rss = self._process.memory_info().rss
+        for child in self._process.children(recursive=True):
+            try:
+                total_rss += child.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        return total_rss
+
+
+class StageRssProfile:
+    """Measured peak RSS per stage, kept in a small json file between runs.
+
+    The predicted footprint of a stage is the largest of its recent peaks, or the
+    given default until the stage has been measured.
+    """
+
+    def __init__(self, profile_file: str, default_peak_rss: dict[str, int]) -> None:
+        self._profile_file = profile_file
+        self._default_peak_rss = default_peak_rss
+        self._recent_peak_rss: dict[str, list[int]] = {}
+
+        if os.path.isfile(self._profile_file):
+            with open(self._profile_file) as f:
+                self._recent_peak_rss = json.load(f)
+
+    def get_predicted_rss(self, stage: str) -> int:
+        recent_peak_rss = self._recent_peak_rss.get(stage)
+        if not recent_peak_rss:
+            return self._default_peak_rss[stage]
+
+        return max(recent_peak_rss)
+
+    def add_peak_rss(self, stage: str, peak_rss: int) -> None:
+        recent_peak_rss = self._recent_peak_rss.setdefault(stage, [])
+        recent_peak_rss.append(peak_rss)
+        del recent_peak_rss[:-NUM_RECENT_PEAK_RSS]
+
+    def save(self) -> None:
+        logging.debug(f'Saving stage rss profile "{self._profile_file}".')
+
+        with open(self._profile_file, "w") as f:
+            json.dump(self._recent_peak_rss, f, indent=4)
@@ -1,6 +1,16 @@
 import os.path
 
-from .gmic_exe import run_gmic
+import cv2 as cv
+
+from .gmic_exe import run_gmic, run_gmic_on_images
+from .tiling import get_tile_size, process_image_files_in_tiles
+
+# Rough peak gmic memory per pixel for the overlay - the inpainted and black ink
+# images, the extracted alpha channel and the blended copy, all as floats.
+OVERLAY_BYTES_PER_PIXEL = 64
+
+# The overlay is a per-pixel blend so tiles need no halo.
+OVERLAY_TILE_HALO = 0
 
 
 def overlay_inpainted_file_with_black_ink(
@@ -8,6 +18,35 @@ def overlay_inpainted_file_with_black_ink(
     black_ink_file: str,
     out_file: str,
 ) -> None:
+    _check_overlay_files_exist(inpaint_file, black_ink_file)
+
+    _overlay_files(inpaint_file, black_ink_file, out_file)
+
+
+def overlay_inpainted_file_with_black_ink_in_tiles(
+    work_dir: str,
+    work_file_stem: str,
+    inpaint_file: str,
+    black_ink_file: str,
+    out_file: str,
+    max_tile_rss: int,
+) -> None:
+    _check_overlay_files_exist(inpaint_file, black_ink_file)
+
+    process_image_files_in_tiles(
+        work_dir,
+        f"{work_file_stem}-overlay",
+        [inpaint_file, black_ink_file],
+        out_file,
+        get_tile_size(max_tile_rss, OVERLAY_BYTES_PER_PIXEL, OVERLAY_TILE_HALO),
+        OVERLAY_TILE_HALO,
+        lambda tile_in_files, tile_out_file: _overlay_files(
+            tile_in_files[0], tile_in_files[1], tile_out_file
+        ),
+    )
+
+
+def _check_overlay_files_exist(inpaint_file: str, black_ink_file: str) -> None:
     if not os.path.exists(inpaint_file):
         msg = f'File not found: "{inpaint_file}".'
         raise FileNotFoundError(msg)
@@ -15,15 +54,31 @@ def overlay_inpainted_file_with_black_ink(
         msg = f'File not found: "{black_ink_file}".'
         raise FileNotFoundError(msg)
 
+
+def overlay_inpainted_image_with_black_ink(
+    inpaint_image: cv.typing.MatLike, black_ink_image: cv.typing.MatLike
+) -> cv.typing.MatLike:
+    return run_gmic_on_images(get_gmic_overlay_params(), [inpaint_image, black_ink_image])[-1]
+
+
+def _overlay_files(inpaint_file: str, black_ink_file: str, out_file: str) -> None:
     overlay_cmd = [
         inpaint_file,
         black_ink_file,
-        "+channels[-1]",
-        "100%",
-        "+image[0]",
-        "[1],0%,0%,0,0,1,[2],255",
+        *get_gmic_overlay_params(),
         "output[-1]",
         out_file,
     ]
 
     run_gmic(overlay_cmd)
+
+
+def get_gmic_overlay_params() -> list[str]:
+    # Draw the inpainted image with the black ink image on top, using the black ink
+    # alpha channel as the opacity mask.
+    return [
+        "+channels[-1]",
+        "100%",
+        "+image[0]",
+        "[1],0%,0%,0,0,1,[2],255",
+    ]
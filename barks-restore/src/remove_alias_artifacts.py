@@ -1,10 +1,11 @@
 # ruff: noqa: ERA001
 
 import os
+from enum import Enum, auto
 
 import cv2 as cv
 import numpy as np
-from numba import jit
+from numba import get_num_threads, jit, prange
 
 DEBUG = False
 DEBUG_OUTPUT_DIR = "/tmp"
@@ -13,9 +14,26 @@ MEDIAN_BLUR_APERTURE_SIZE = 7
 ADAPTIVE_THRESHOLD_BLOCK_SIZE = 21
 ADAPTIVE_THRESHOLD_CONST_SUBTRACT = 12  # Careful here with including alias artifacts
 
+NUM_HIST_BINS = 256
+NUM_HIST_COARSE_BINS = 16
+HIST_FINE_BINS_PER_COARSE_BIN = NUM_HIST_BINS // NUM_HIST_COARSE_BINS
+NUM_ROW_BANDS_PER_THREAD = 4
+
+# Rough peak memory per pixel for 'get_median_filter' - the bordered image and masks,
+# the filtered image and the numba histogram work arrays.
+MEDIAN_FILTER_BYTES_PER_PIXEL = 24
+
+
+class MedianFilterEngine(Enum):
+    NEIGHBOURS = auto()
+    HISTOGRAM = auto()
+
 
 def _median_filter(
-    original_image: cv.typing.MatLike, mask: cv.typing.MatLike, kernel_size: int
+    original_image: cv.typing.MatLike,
+    mask: cv.typing.MatLike,
+    kernel_size: int,
+    engine: MedianFilterEngine,
 ) -> cv.typing.MatLike:
     filtered_image = np.zeros_like(original_image)
     w = kernel_size // 2
@@ -37,7 +55,13 @@ def _median_filter(
             wrapped_mask,
         )
 
-    _median_filter_core(wrapped_image, wrapped_mask, kernel_size, filtered_image)
+    if engine == MedianFilterEngine.HISTOGRAM:
+        num_bands = min(filtered_image.shape[0], get_num_threads() * NUM_ROW_BANDS_PER_THREAD)
+        _median_filter_hist_core(
+            wrapped_image, wrapped_mask, kernel_size, filtered_image, num_bands
+        )
+    else:
+        _median_filter_core(wrapped_image, wrapped_mask, kernel_size, filtered_image)
 
     #    median_filter_core.parallel_diagnostics(level=4)
 
@@ -91,7 +115,159 @@ def _get_median(num_nbrs: int, nbrs0, nbrs1, nbrs2):
     )
 
 
-def get_median_filter(input_image: cv.typing.MatLike) -> cv.typing.MatLike:
+# The histogram engine gives the same result as '_median_filter_core' but the cost per
+# pixel does not depend on the kernel size. Rows are split into bands which are filtered
+# in parallel. Within a band, each column keeps a histogram of the unmasked pixels in
+# its 'kernel_size' rows (slid down one row at a time), and the kernel histogram is slid
+# along a row by adding the entering column and subtracting the leaving column
+# (Perreault and Hebert). Coarse histograms make the median search 32 steps at most.
+@jit(nopython=True, parallel=True)
+def _median_filter_hist_core(
+    wrapped_image: cv.typing.MatLike,
+    wrapped_mask: cv.typing.MatLike,
+    kernel_size: int,
+    filtered_image: cv.typing.MatLike,
+    num_bands: int,
+) -> None:
+    image_h = filtered_image.shape[0]
+    band_h = (image_h + num_bands - 1) // num_bands
+
+    for band in prange(num_bands):
+        row_start = band * band_h
+        row_end = min(image_h, row_start + band_h)
+        if row_start < row_end:
+            _median_filter_hist_band(
+                wrapped_image, wrapped_mask, kernel_size, filtered_image, row_start, row_end
+            )
+
+
+@jit(nopython=True, parallel=False)
+def _median_filter_hist_band(
+    wrapped_image: cv.typing.MatLike,
+    wrapped_mask: cv.typing.MatLike,
+    kernel_size: int,
+    filtered_image: cv.typing.MatLike,
+    row_start: int,
+    row_end: int,
+) -> None:
+    image_w = filtered_image.shape[1]
+    wrapped_w = wrapped_image.shape[1]
+    w: int = kernel_size // 2
+
+    col_hists = np.zeros((wrapped_w, 3, NUM_HIST_BINS), dtype=np.int32)
+    col_coarse_hists = np.zeros((wrapped_w, 3, NUM_HIST_COARSE_BINS), dtype=np.int32)
+    col_counts = np.zeros(wrapped_w, dtype=np.int32)
+
+    kernel_hist = np.empty((3, NUM_HIST_BINS), dtype=np.int32)
+    kernel_coarse_hist = np.empty((3, NUM_HIST_COARSE_BINS), dtype=np.int32)
+
+    for x in range(row_start, row_start + 2 * w):
+        _update_col_hists(
+            wrapped_image, wrapped_mask, x, 1, col_hists, col_coarse_hists, col_counts
+        )
+
+    for i in range(row_start, row_end):
+        # Wrapped rows i to i + 2w are the kernel rows for output row i.
+        _update_col_hists(
+            wrapped_image, wrapped_mask, i + 2 * w, 1, col_hists, col_coarse_hists, col_counts
+        )
+
+        kernel_hist[:] = 0
+        kernel_coarse_hist[:] = 0
+        num_nbrs = 0
+        for y in range(2 * w + 1):
+            _add_col_hist(kernel_hist, kernel_coarse_hist, col_hists, col_coarse_hists, y, 1)
+            num_nbrs += col_counts[y]
+
+        for j in range(image_w):
+            if j > 0:
+                y_in = j + 2 * w
+                y_out = j - 1
+                _add_col_hist(kernel_hist, kernel_coarse_hist, col_hists, col_coarse_hists, y_in, 1)
+                _add_col_hist(
+                    kernel_hist, kernel_coarse_hist, col_hists, col_coarse_hists, y_out, -1
+                )
+                num_nbrs += col_counts[y_in] - col_counts[y_out]
+
+            if wrapped_mask[i + w, j + w] > 0:
+                filtered_image[i, j] = wrapped_image[i + w, j + w]
+            elif num_nbrs == 0:
+                filtered_image[i, j] = (0, 100, 0)
+            else:
+                for c in range(3):
+                    filtered_image[i, j, c] = _get_hist_median(
+                        kernel_hist[c], kernel_coarse_hist[c], num_nbrs
+                    )
+
+        _update_col_hists(
+            wrapped_image, wrapped_mask, i, -1, col_hists, col_coarse_hists, col_counts
+        )
+
+
+@jit(nopython=True, parallel=False)
+def _update_col_hists(
+    wrapped_image: cv.typing.MatLike,
+    wrapped_mask: cv.typing.MatLike,
+    x: int,
+    delta: int,
+    col_hists,
+    col_coarse_hists,
+    col_counts,
+) -> None:
+    for y in range(wrapped_image.shape[1]):
+        if wrapped_mask[x, y] > 0:
+            continue
+        for c in range(3):
+            value = wrapped_image[x, y, c]
+            col_hists[y, c, value] += delta
+            col_coarse_hists[y, c, value // HIST_FINE_BINS_PER_COARSE_BIN] += delta
+        col_counts[y] += delta
+
+
+@jit(nopython=True, parallel=False)
+def _add_col_hist(
+    kernel_hist, kernel_coarse_hist, col_hists, col_coarse_hists, y: int, sign: int
+) -> None:
+    for c in range(3):
+        for b in range(NUM_HIST_BINS):
+            kernel_hist[c, b] += sign * col_hists[y, c, b]
+        for b in range(NUM_HIST_COARSE_BINS):
+            kernel_coarse_hist[c, b] += sign * col_coarse_hists[y, c, b]
+
+
+@jit(nopython=True, parallel=False)
+def _get_hist_median(hist, coarse_hist, num_values: int) -> int:
+    # Match 'np.median' - the mean of the two middle values for an even count,
+    # truncated back to an integer.
+    if num_values % 2 == 1:
+        return _get_hist_kth_value(hist, coarse_hist, num_values // 2)
+
+    lower = _get_hist_kth_value(hist, coarse_hist, num_values // 2 - 1)
+    upper = _get_hist_kth_value(hist, coarse_hist, num_values // 2)
+
+    return (lower + upper) // 2
+
+
+@jit(nopython=True, parallel=False)
+def _get_hist_kth_value(hist, coarse_hist, k: int) -> int:
+    total = 0
+    coarse_bin = 0
+    while total + coarse_hist[coarse_bin] <= k:
+        total += coarse_hist[coarse_bin]
+        coarse_bin += 1
+
+    value = coarse_bin * HIST_FINE_BINS_PER_COARSE_BIN
+    while total + hist[value] <= k:
+        total += hist[value]
+        value += 1
+
+    return value
+
+
+def get_median_filter(
+    input_image: cv.typing.MatLike,
+    engine: MedianFilterEngine = MedianFilterEngine.NEIGHBOURS,
+) -> cv.typing.MatLike:
     black_ink_mask = _get_black_ink_mask(input_image)
     if DEBUG:
         cv.imwrite(
@@ -110,7 +286,9 @@ def get_median_filter(input_image: cv.typing.MatLike) -> cv.typing.MatLike:
             enlarged_black_ink_mask,
         )
 
-    filtered_image = _median_filter(input_image, enlarged_black_ink_mask, MEDIAN_BLUR_APERTURE_SIZE)
+    filtered_image = _median_filter(
+        input_image, enlarged_black_ink_mask, MEDIAN_BLUR_APERTURE_SIZE, engine
+    )
     if DEBUG:
         cv.imwrite(
             os.path.join(DEBUG_OUTPUT_DIR, "median-filtered-image.jpg"),
@@ -120,6 +298,12 @@ def get_median_filter(input_image: cv.typing.MatLike) -> cv.typing.MatLike:
     return filtered_image
 
 
+def get_median_filter_halo() -> int:
+    # An output pixel depends on the median window, whose mask values come from a 3x3
+    # blur of the adaptive threshold block.
+    return MEDIAN_BLUR_APERTURE_SIZE // 2 + 1 + ADAPTIVE_THRESHOLD_BLOCK_SIZE // 2
+
+
 def _get_black_ink_mask(image: cv.typing.MatLike) -> cv.typing.MatLike:
     gray_image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
 
@@ -1,17 +1,20 @@
 import os
-from collections import OrderedDict
+from collections.abc import Callable
 
 import cv2 as cv
 import numpy as np
 
-from .image_io import write_cv_image_file
+from .image_io import write_cv_image_file, write_work_image_file
 
 DEBUG_WRITE_COLOR_COUNTS = True
+DEBUG_COLOR_COUNTS_TOP_N: int | None = None  # None means write all colors
 
 NUM_POSTERIZE_LEVELS = 5
 NUM_POSTERIZE_EXCEPTION_LEVELS = 2
 FIRST_LEVEL = int(255 / (NUM_POSTERIZE_LEVELS - 1))
 
+NUM_PACKED_COLORS = 256 * 256 * 256
+
 
 def posterize_image(image: cv.typing.MatLike) -> None:
     for i in range(NUM_POSTERIZE_LEVELS):
@@ -33,63 +36,126 @@ def remove_colors(image: cv.typing.MatLike) -> None:
     image[colors_to_remove] = (255, 255, 255, 0)
 
 
-def get_color_counts(image: cv.typing.MatLike) -> dict[tuple[int, int, int], int]:
-    image_h, image_w = image.shape[0], image.shape[1]
-
-    all_colors = {}
+def _get_posterize_lut() -> cv.typing.MatLike:
+    lut = np.arange(256, dtype=np.uint8).reshape(1, 256)
+    posterize_image(lut)
+    return lut
 
-    for i in range(image_h):  ## traverse image row
-        for j in range(image_w):  ## traverse image col
-            pixel = image[i][j]
-            red = int(pixel[2])
-            green = int(pixel[1])
-            blue = int(pixel[0])
 
-            color = (red, green, blue)
+_POSTERIZE_LUT = _get_posterize_lut()
+_REMOVE_COLOR_LUT = np.where(_POSTERIZE_LUT > FIRST_LEVEL, 255, 0).astype(np.uint8)
 
-            if color in all_colors:
-                all_colors[color] += 1
-            else:
-                all_colors[color] = 1
 
-    return all_colors
+def posterize_and_remove_colors(
+    image: cv.typing.MatLike,
+) -> tuple[cv.typing.MatLike, cv.typing.MatLike]:
+    """Posterize a BGR image and strip its colors using lookup tables.
 
+    Gives the same result as 'posterize_image' followed by 'remove_colors' but with
+    two full-image passes instead of one boolean mask per posterize level. Returns
+    the posterized BGR image and the color removed BGRA image.
+    """
+    posterized_image = cv.LUT(image, _POSTERIZE_LUT)
 
-def write_color_counts(filename: str, image: cv.typing.MatLike) -> None:
-    color_counts = get_color_counts(image)
-    color_counts_descending = OrderedDict(
-        sorted(color_counts.items(), key=lambda kv: kv[1], reverse=True)
+    # The posterize lut is monotonic, so the max channel decides if a pixel is removed.
+    remove_mask = cv.LUT(image.max(axis=2), _REMOVE_COLOR_LUT)
+    blue, green, red = cv.split(posterized_image)
+    out_image = cv.merge(
+        [
+            cv.max(blue, remove_mask),
+            cv.max(green, remove_mask),
+            cv.max(red, remove_mask),
+            cv.bitwise_not(remove_mask),
+        ]
     )
+
+    return posterized_image, out_image
+
+
+def get_color_counts(
+    image: cv.typing.MatLike, top_n: int | None = None
+) -> dict[tuple[int, int, int], int]:
+    """Return (red, green, blue) color counts in descending count order.
+
+    Each BGR pixel is packed into a single 24-bit key so the counting is done by
+    'np.bincount' rather than a per-pixel Python loop. Equal counts are ordered by
+    color. If 'top_n' is given, only the 'top_n' most frequent colors are returned.
+    """
+    pixels = image[:, :, :3]
+    keys = (
+        (pixels[:, :, 2].astype(np.uint32) << 16)
+        | (pixels[:, :, 1].astype(np.uint32) << 8)
+        | pixels[:, :, 0]
+    ).ravel()
+
+    counts = np.bincount(keys, minlength=NUM_PACKED_COLORS)
+    colors = np.flatnonzero(counts)
+    color_counts = counts[colors]
+
+    order = np.lexsort((colors, -color_counts))[:top_n]
+
+    return {
+        (int(color >> 16), int((color >> 8) & 0xFF), int(color & 0xFF)): int(count)
+        for color, count in zip(colors[order], color_counts[order])
+    }
+
+
+def write_color_counts(filename: str, image: cv.typing.MatLike, top_n: int | None = None) -> None:
+    color_counts_descending = get_color_counts(image, top_n)
     with open(filename, "w") as f:
-        f.writelines(
-            f"{color}: {color_counts_descending[color]}\n" for color in color_counts_descending
-        )
+        f.writelines(f"{color}: {count}\n" for color, count in color_counts_descending.items())
 
 
 def remove_colors_from_image(
-    work_dir: str, work_file_stem: str, in_file: str, out_file: str
+    work_dir: str, work_file_stem: str, in_file: str, out_file: str, use_lut: bool = True
 ) -> None:
-    out_image = cv.imread(in_file)
-
-    posterize_image(out_image)
-    posterized_image_file = os.path.join(
-        work_dir, work_file_stem + "-posterized-pre-remove-colors.png"
+    out_image = get_color_removed_image(
+        work_dir, work_file_stem, cv.imread(in_file), use_lut, write_work_image_file
     )
-    write_cv_image_file(posterized_image_file, out_image)
+
+    write_cv_image_file(out_file, out_image)
+
+
+def get_color_removed_image(
+    work_dir: str,
+    work_file_stem: str,
+    image: cv.typing.MatLike,
+    use_lut: bool = True,
+    write_work_file: Callable[[str, cv.typing.MatLike], None] | None = None,
+) -> cv.typing.MatLike:
+    """In-memory version of 'remove_colors_from_image'.
+
+    The posterized work file is only written if 'write_work_file' is given.
+    """
+    if use_lut:
+        out_image, removed_colors_image = posterize_and_remove_colors(image)
+    else:
+        # Posterize a copy - the caller may still be writing 'image' out.
+        out_image = image.copy()
+        posterize_image(out_image)
+
+    if write_work_file:
+        posterized_image_file = os.path.join(
+            work_dir, work_file_stem + "-posterized-pre-remove-colors.png"
+        )
+        write_work_file(posterized_image_file, out_image)
 
     if DEBUG_WRITE_COLOR_COUNTS:
         posterized_counts_file = os.path.join(
             work_dir, work_file_stem + "-posterized-color-counts-pre-remove-colors.txt"
         )
-        write_color_counts(posterized_counts_file, out_image)
+        write_color_counts(posterized_counts_file, out_image, DEBUG_COLOR_COUNTS_TOP_N)
 
-    out_image = cv.cvtColor(out_image, cv.COLOR_RGB2RGBA)
-    remove_colors(out_image)
+    if use_lut:
+        out_image = removed_colors_image
+    else:
+        out_image = cv.cvtColor(out_image, cv.COLOR_RGB2RGBA)
+        remove_colors(out_image)
 
     if DEBUG_WRITE_COLOR_COUNTS:
         remaining_color_counts_file = os.path.join(
             work_dir, work_file_stem + "-remaining-color-counts-post-remove-colors.txt"
         )
-        write_color_counts(remaining_color_counts_file, out_image)
+        write_color_counts(remaining_color_counts_file, out_image, DEBUG_COLOR_COUNTS_TOP_N)
 
-    write_cv_image_file(out_file, out_image)
+    return out_image
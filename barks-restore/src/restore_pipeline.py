@@ -1,25 +1,69 @@
 from __future__ import annotations
 
+import concurrent.futures
 import logging
 import os
 import time
+from dataclasses import asdict, dataclass
 from typing import TYPE_CHECKING
 
 import cv2 as cv
 from barks_fantagraphics.comics_utils import get_clean_path
 
-from .image_io import resize_image_file, svg_file_to_png, write_cv_image_file
-from .inpaint import inpaint_image_file
-from .overlay import overlay_inpainted_file_with_black_ink
-from .remove_alias_artifacts import get_median_filter
-from .remove_colors import remove_colors_from_image
-from .smooth_image import smooth_image_file
-from .vtracer_to_svg import image_file_to_svg
+from .atomic_output import atomic_output_file
+from .gmic_exe import USE_GMIC_BINDING
+from .image_io import (
+    get_gmic_resize_params,
+    resize_image_file,
+    resize_image_to_file,
+    svg_file_to_image,
+    svg_file_to_png,
+    write_cv_image_file,
+    write_work_image_file,
+)
+from .inpaint import get_gmic_inpaint_params, get_inpainted_image, inpaint_image_file
+from .overlay import (
+    get_gmic_overlay_params,
+    overlay_inpainted_file_with_black_ink,
+    overlay_inpainted_file_with_black_ink_in_tiles,
+    overlay_inpainted_image_with_black_ink,
+)
+from .remove_alias_artifacts import (
+    ADAPTIVE_THRESHOLD_BLOCK_SIZE,
+    ADAPTIVE_THRESHOLD_CONST_SUBTRACT,
+    MEDIAN_BLUR_APERTURE_SIZE,
+    MEDIAN_FILTER_BYTES_PER_PIXEL,
+    MedianFilterEngine,
+    get_median_filter,
+    get_median_filter_halo,
+)
+from .remove_colors import (
+    NUM_POSTERIZE_EXCEPTION_LEVELS,
+    NUM_POSTERIZE_LEVELS,
+    get_color_removed_image,
+)
+from .smooth_image import get_gmic_smooth_params, smooth_image_file, smooth_image_file_in_tiles
+from .tiling import get_tile_size, process_image_in_tiles
+from .vtracer_to_svg import VTRACER_SETTINGS, image_to_traced_paths
 
 if TYPE_CHECKING:
+    from collections.abc import Callable
     from pathlib import Path
+    from typing import Any
 
-USE_EXISTING_WORK_FILES = False  # Use with care
+    from .stage_cache import StageCache
+
+
+@dataclass
+class RestoreEngines:
+    """Which implementation each restore step uses - they should give the same pages."""
+
+    # The histogram engine only wins with threads to spare, and the batch restore runs
+    # one page per core.
+    median_filter: MedianFilterEngine = MedianFilterEngine.NEIGHBOURS
+    posterize_lut: bool = True
+    # If False, part 4 always goes through files, even with the gmic binding.
+    gmic_in_memory: bool = USE_GMIC_BINDING
 
 
 class RestorePipeline:
@@ -32,6 +76,10 @@ class RestorePipeline:
         dest_restored_file: Path,
         dest_upscayled_restored_file: Path,
         dest_svg_restored_file: Path,
+        max_tile_rss: int | None = None,
+        keep_work_files: bool = False,
+        stage_cache: StageCache | None = None,
+        engines: RestoreEngines | None = None,
     ) -> None:
         self.work_dir = work_dir
         self.out_dir = os.path.dirname(dest_restored_file)
@@ -42,6 +90,23 @@ class RestorePipeline:
         self.dest_upscayled_restored_file = str(dest_upscayled_restored_file)
         self.dest_svg_restored_file = str(dest_svg_restored_file)
 
+        # If set, the full size stages work on overlapping tiles sized so each
+        # operator stays within this many bytes, instead of on whole pages.
+        self.max_tile_rss = max_tile_rss
+
+        # Images are handed from step to step in memory. Only the files a later part
+        # needs are written, unless the intermediate work files are wanted for
+        # debugging, in which case they are written in the background.
+        self.keep_work_files = keep_work_files
+        self._work_file_writer: concurrent.futures.ThreadPoolExecutor | None = None
+        self._work_file_writes: list[concurrent.futures.Future] = []
+
+        # If set, a part is skipped, and its outputs copied from the cache, when its
+        # inputs and parameters are the same as for a cached run.
+        self.stage_cache = stage_cache
+
+        self.engines = engines if engines else RestoreEngines()
+
         self.errors_occurred = False
 
         if not os.path.isdir(self.work_dir):
@@ -68,38 +133,168 @@ class RestorePipeline:
         self.png_of_svg_file = self.dest_svg_restored_file + ".png"
         self.inpainted_file = os.path.join(work_dir, f"{self.srce_upscale_stem}-inpainted.png")
 
+    def __getstate__(self) -> dict:
+        # The pipeline gets sent to pool workers - the work file writer is per process.
+        state = self.__dict__.copy()
+        state["_work_file_writer"] = None
+        state["_work_file_writes"] = []
+        return state
+
     def do_part1(self) -> None:
-        self.do_remove_jpg_artifacts()
-        self.do_remove_colors()
+        self._run_stage(
+            "part1",
+            [str(self.srce_upscale_file)],
+            {
+                "median_blur_aperture_size": MEDIAN_BLUR_APERTURE_SIZE,
+                "adaptive_threshold_block_size": ADAPTIVE_THRESHOLD_BLOCK_SIZE,
+                "adaptive_threshold_const_subtract": ADAPTIVE_THRESHOLD_CONST_SUBTRACT,
+                "num_posterize_levels": NUM_POSTERIZE_LEVELS,
+                "num_posterize_exception_levels": NUM_POSTERIZE_EXCEPTION_LEVELS,
+                "engines": asdict(self.engines),
+            },
+            [self.removed_colors_file],
+            self._do_part1,
+        )
 
     def do_part2_memory_hungry(self) -> None:
-        self.do_smooth_removed_colors()
+        self._run_stage(
+            "part2",
+            [self.removed_colors_file],
+            {
+                "smooth_params": get_gmic_smooth_params(),
+                "tiled": self.max_tile_rss is not None,
+            },
+            [self.smoothed_removed_colors_file],
+            self.do_smooth_removed_colors,
+        )
 
     def do_part3(self) -> None:
-        self.do_generate_svg()
+        self._run_stage(
+            "part3",
+            [self.smoothed_removed_colors_file],
+            {"vtracer_settings": VTRACER_SETTINGS},
+            [self.dest_svg_restored_file],
+            self.do_generate_svg,
+        )
 
     def do_part4_memory_hungry(self) -> None:
-        self.do_inpaint()
-        self.do_overlay_inpaint_with_black_ink()
-        self.do_resize_restored_file()
-
-    def do_remove_jpg_artifacts(self) -> None:
-        if USE_EXISTING_WORK_FILES and os.path.isfile(self.removed_artifacts_file):
-            logging.warning(
-                f"Removed artifacts file already exists - skipping:"
-                f' "{self.removed_artifacts_file}".'
+        self._run_stage(
+            "part4",
+            [str(self.srce_upscale_file), self.removed_colors_file, self.dest_svg_restored_file],
+            {
+                "inpaint_params": get_gmic_inpaint_params(),
+                "overlay_params": get_gmic_overlay_params(),
+                "resize_params": get_gmic_resize_params(self.scale),
+                "tiled": self.max_tile_rss is not None,
+                "metadata": self.get_restored_file_metadata(),
+            },
+            [self.dest_upscayled_restored_file, self.dest_restored_file],
+            self._do_part4,
+        )
+
+    def _do_part1(self) -> None:
+        removed_artifacts_image = self.do_remove_jpg_artifacts()
+        if removed_artifacts_image is not None:
+            self.do_remove_colors(removed_artifacts_image)
+        self.wait_for_work_files()
+
+    def _do_part4(self) -> None:
+        if self.uses_in_memory_part4():
+            self.do_inpaint_overlay_and_resize_in_memory()
+        else:
+            self.do_inpaint()
+            self.do_svg_to_png()
+            self.do_overlay_inpaint_with_black_ink()
+            self.do_resize_restored_file()
+        self.wait_for_work_files()
+
+    def uses_in_memory_part4(self) -> bool:
+        # Otherwise part 4 goes through the inpainted file and the png of the svg.
+        return self.engines.gmic_in_memory and self.max_tile_rss is None
+
+    def _run_stage(
+        self,
+        stage: str,
+        in_files: list[str],
+        params: dict[str, Any],
+        out_files: list[str],
+        run_stage: Callable[[], None],
+    ) -> None:
+        # Work files only get written when a stage is run, so skip the cache if they
+        # are wanted.
+        if self.stage_cache is None or self.keep_work_files:
+            run_stage()
+            return
+
+        try:
+            key = self.stage_cache.get_key(f"{type(self).__name__}.{stage}", in_files, params)
+        except FileNotFoundError:
+            # A previous part failed - let the stage report the missing input.
+            run_stage()
+            return
+
+        if self.stage_cache.restore(key, out_files):
+            logging.info(
+                f'Restored {stage} outputs for "{self.srce_upscale_file.name}" from the'
+                f" stage cache."
             )
             return
 
+        # Stale outputs of an earlier run must not be cached if the stage fails quietly.
+        for out_file in out_files:
+            if os.path.isfile(out_file):
+                os.remove(out_file)
+
+        errors_occurred = self.errors_occurred
+        self.errors_occurred = False
+        run_stage()
+        if not self.errors_occurred and all(os.path.isfile(f) for f in out_files):
+            self.stage_cache.add(key, out_files)
+        self.errors_occurred = self.errors_occurred or errors_occurred
+
+    def write_work_file(self, file: str, image: cv.typing.MatLike) -> None:
+        if self._work_file_writer is None:
+            self._work_file_writer = concurrent.futures.ThreadPoolExecutor(1)
+        self._work_file_writes.append(
+            self._work_file_writer.submit(write_work_image_file, file, image)
+        )
+
+    def wait_for_work_files(self) -> None:
+        for future in self._work_file_writes:
+            try:
+                future.result()
+            except Exception:
+                self.errors_occurred = True
+                logging.exception("Error writing work file: ")
+        self._work_file_writes = []
+
+        if self._work_file_writer is not None:
+            self._work_file_writer.shutdown()
+            self._work_file_writer = None
+
+    def _get_work_file_writer(self) -> Callable[[str, cv.typing.MatLike], None] | None:
+        return self.write_work_file if self.keep_work_files else None
+
+    def do_remove_jpg_artifacts(self) -> cv.typing.MatLike | None:
         try:
             start = time.time()
             logging.info(
-                f'\nGenerating file with jpeg artifacts removed: "{self.removed_artifacts_file}"...'
+                f'\nRemoving jpeg artifacts from "{os.path.basename(self.srce_upscale_file)}"...'
             )
 
             upscale_image = cv.imread(str(self.srce_upscale_file))
-            out_image = get_median_filter(upscale_image)
-            write_cv_image_file(self.removed_artifacts_file, out_image)
+            if self.max_tile_rss is None:
+                out_image = get_median_filter(upscale_image, self.engines.median_filter)
+            else:
+                halo = get_median_filter_halo()
+                out_image = process_image_in_tiles(
+                    upscale_image,
+                    get_tile_size(self.max_tile_rss, MEDIAN_FILTER_BYTES_PER_PIXEL, halo),
+                    halo,
+                    lambda tile_image: get_median_filter(tile_image, self.engines.median_filter),
+                )
+            if self.keep_work_files:
+                self.write_work_file(self.removed_artifacts_file, out_image)
 
             logging.info(
                 f"Time taken to remove jpeg artifacts for"
@@ -109,23 +304,25 @@ class RestorePipeline:
         except Exception:
             self.errors_occurred = True
             logging.exception("Error removing jpg artifacts: ")
+            return None
+        else:
+            return out_image
 
-    def do_remove_colors(self) -> None:
-        if USE_EXISTING_WORK_FILES and os.path.isfile(self.removed_colors_file):
-            logging.warning(
-                f'Removed colors file already exists - skipping: "{self.removed_colors_file}".'
-            )
-            return
-
+    def do_remove_colors(self, removed_artifacts_image: cv.typing.MatLike) -> None:
         try:
             start = time.time()
             logging.info(f'\nGenerating color removed file "{self.removed_colors_file}"...')
 
-            remove_colors_from_image(
+            out_image = get_color_removed_image(
                 self.work_dir,
                 self.srce_upscale_stem,
-                self.removed_artifacts_file,
-                self.removed_colors_file,
+                removed_artifacts_image,
+                self.engines.posterize_lut,
+                self._get_work_file_writer(),
+            )
+            # Parts 2 and 4 need this file. Only the color channels were ever kept.
+            write_work_image_file(
+                self.removed_colors_file, cv.cvtColor(out_image, cv.COLOR_BGRA2BGR)
             )
 
             logging.info(
@@ -137,24 +334,27 @@ class RestorePipeline:
             logging.exception("Error removing colors: ")
 
     def do_smooth_removed_colors(self) -> None:
-        if USE_EXISTING_WORK_FILES and os.path.isfile(self.smoothed_removed_colors_file):
-            logging.warning(
-                f"Smoothed removed colors file already exists - skipping:"
-                f' "{self.smoothed_removed_colors_file}".'
-            )
-            return
-
         try:
             start = time.time()
             logging.info(f'\nGenerating smoothed file "{self.smoothed_removed_colors_file}"...')
 
-            smooth_image_file(self.removed_colors_file, self.smoothed_removed_colors_file)
+            if self.max_tile_rss is None:
+                smooth_image_file(self.removed_colors_file, self.smoothed_removed_colors_file)
+            else:
+                smooth_image_file_in_tiles(
+                    self.work_dir,
+                    self.srce_upscale_stem,
+                    self.removed_colors_file,
+                    self.smoothed_removed_colors_file,
+                    self.max_tile_rss,
+                )
 
             logging.info(
                 f'Time taken to smooth "{os.path.basename(self.smoothed_removed_colors_file)}":'
                 f" {int(time.time() - start)}s."
             )
         except Exception:
+            self.errors_occurred = True
             logging.exception("Error smoothing removed colors: ")
 
     def do_generate_svg(self) -> None:
@@ -162,24 +362,79 @@ class RestorePipeline:
             start = time.time()
             logging.info(f'\nGenerating svg file "{self.dest_svg_restored_file}"...')
 
-            image_file_to_svg(self.smoothed_removed_colors_file, self.dest_svg_restored_file)
+            smoothed_image = cv.imread(self.smoothed_removed_colors_file)
+            if smoothed_image is None:
+                msg = f'Could not read smoothed file "{self.smoothed_removed_colors_file}".'
+                raise FileNotFoundError(msg)
+            traced_paths = image_to_traced_paths(smoothed_image)
+            traced_paths.write_svg(self.dest_svg_restored_file)
 
             logging.info(
-                f'Time taken to generate svg "{os.path.basename(self.dest_svg_restored_file)}":'
+                f'Time taken to generate svg "{os.path.basename(self.dest_svg_restored_file)}"'
+                f" with {traced_paths.get_num_segments()} cubic segments:"
                 f" {int(time.time() - start)}s."
             )
+        except Exception:
+            self.errors_occurred = True
+            logging.exception("Error generating svg: ")
 
+    def do_svg_to_png(self) -> None:
+        try:
             logging.info(f'\nSaving svg file to png file "{self.png_of_svg_file}"...')
             svg_file_to_png(self.dest_svg_restored_file, self.png_of_svg_file)
         except Exception:
             self.errors_occurred = True
-            logging.exception("Error generating svg: ")
+            logging.exception("Error saving svg to png: ")
 
-    def do_inpaint(self) -> None:
-        if USE_EXISTING_WORK_FILES and os.path.isfile(self.inpainted_file):
-            logging.warning(f'Inpainted file already exists - skipping: "{self.inpainted_file}".')
-            return
+    def do_inpaint_overlay_and_resize_in_memory(self) -> None:
+        try:
+            start = time.time()
+            logging.info(
+                f"\nInpainting, overlaying and resizing"
+                f' "{os.path.basename(self.srce_upscale_file)}" in memory...'
+            )
 
+            input_image = cv.imread(str(self.srce_upscale_file))
+            black_ink_mask = cv.imread(self.removed_colors_file, cv.COLOR_BGR2GRAY)
+            if input_image is None or black_ink_mask is None:
+                msg = f'Could not read part 4 input files for "{self.srce_upscale_file}".'
+                raise FileNotFoundError(msg)
+            # The svg is rasterized straight into the black ink image - no png needed.
+            black_ink_image = svg_file_to_image(self.dest_svg_restored_file)
+            if self.keep_work_files:
+                self.write_work_file(self.png_of_svg_file, black_ink_image)
+
+            inpainted_image = get_inpainted_image(
+                self.work_dir,
+                self.srce_upscale_stem,
+                input_image,
+                black_ink_mask,
+                self._get_work_file_writer(),
+            )
+            if self.keep_work_files:
+                self.write_work_file(self.inpainted_file, inpainted_image)
+
+            restored_image = overlay_inpainted_image_with_black_ink(
+                inpainted_image, black_ink_image
+            )
+            write_cv_image_file(self.dest_upscayled_restored_file, restored_image)
+
+            resize_image_to_file(
+                restored_image,
+                self.scale,
+                self.dest_restored_file,
+                self.get_restored_file_metadata(),
+            )
+
+            logging.info(
+                f"Time taken to inpaint, overlay and resize"
+                f' "{os.path.basename(self.dest_restored_file)}": {int(time.time() - start)}s.'
+            )
+        except Exception:
+            self.errors_occurred = True
+            logging.exception("Error inpainting, overlaying and resizing: ")
+
+    def do_inpaint(self) -> None:
         try:
             start = time.time()
             logging.info(f'\nInpainting upscayled file to "{self.inpainted_file}"...')
@@ -190,6 +445,7 @@ class RestorePipeline:
                 str(self.srce_upscale_file),
                 self.removed_colors_file,
                 self.inpainted_file,
+                self.max_tile_rss,
             )
 
             logging.info(
@@ -208,9 +464,20 @@ class RestorePipeline:
                 f' with black ink file "{self.png_of_svg_file}"...'
             )
 
-            overlay_inpainted_file_with_black_ink(
-                self.inpainted_file, self.png_of_svg_file, self.dest_upscayled_restored_file
-            )
+            with atomic_output_file(self.dest_upscayled_restored_file) as temp_out_file:
+                if self.max_tile_rss is None:
+                    overlay_inpainted_file_with_black_ink(
+                        self.inpainted_file, self.png_of_svg_file, temp_out_file
+                    )
+                else:
+                    overlay_inpainted_file_with_black_ink_in_tiles(
+                        self.work_dir,
+                        self.srce_upscale_stem,
+                        self.inpainted_file,
+                        self.png_of_svg_file,
+                        temp_out_file,
+                        self.max_tile_rss,
+                    )
 
             logging.info(
                 f'Time taken to overlay inpainted file "{os.path.basename(self.inpainted_file)}":'
@@ -224,27 +491,26 @@ class RestorePipeline:
         try:
             logging.info(f'\nResizing restored file to "{self.dest_restored_file}"...')
 
-            srce_file = (
-                "N/A" if not os.path.isfile(self.srce_file) else get_clean_path(self.srce_file)
-            )
-
-            # TODO: Save other params used in process.
-            restored_file_metadata = {
-                "Source file": f'"{srce_file}"',
-                "Upscayl file": f'"{get_clean_path(self.srce_upscale_file)}"',
-                "Upscayl scale": str(self.scale),
-            }
-
             resize_image_file(
                 self.dest_upscayled_restored_file,
                 self.scale,
                 self.dest_restored_file,
-                restored_file_metadata,
+                self.get_restored_file_metadata(),
             )
         except Exception:
             self.errors_occurred = True
             logging.exception("Error resizing file: ")
 
+    def get_restored_file_metadata(self) -> dict[str, str]:
+        srce_file = "N/A" if not os.path.isfile(self.srce_file) else get_clean_path(self.srce_file)
+
+        # TODO: Save other params used in process.
+        return {
+            "Source file": f'"{srce_file}"',
+            "Upscayl file": f'"{get_clean_path(self.srce_upscale_file)}"',
+            "Upscayl scale": str(self.scale),
+        }
+
 
 def check_file_exists(proc: RestorePipeline, file: str | Path) -> None:
     if not os.path.exists(file):
@@ -254,12 +520,14 @@ def check_file_exists(proc: RestorePipeline, file: str | Path) -> None:
 
 def check_for_errors(restore_procs: list[RestorePipeline]) -> None:
     for proc in restore_procs:
-        check_file_exists(proc, proc.removed_artifacts_file)
+        if proc.keep_work_files:
+            check_file_exists(proc, proc.removed_artifacts_file)
         check_file_exists(proc, proc.removed_colors_file)
         check_file_exists(proc, proc.smoothed_removed_colors_file)
         check_file_exists(proc, proc.dest_svg_restored_file)
-        check_file_exists(proc, proc.png_of_svg_file)
-        check_file_exists(proc, proc.inpainted_file)
+        if proc.keep_work_files or not proc.uses_in_memory_part4():
+            check_file_exists(proc, proc.png_of_svg_file)
+            check_file_exists(proc, proc.inpainted_file)
         check_file_exists(proc, proc.dest_upscayled_restored_file)
         check_file_exists(proc, proc.dest_restored_file)
 
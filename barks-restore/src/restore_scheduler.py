@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+import concurrent.futures
+import logging
+import os
+from collections import deque
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import TYPE_CHECKING
+
+import psutil
+
+from .stage_profile import StageProfile, add_stage_profile_record
+
+if TYPE_CHECKING:
+    from .memory_profile import StageRssProfile
+    from .restore_pipeline import RestorePipeline
+
+
+class RestoreStage(IntEnum):
+    PART1 = 0
+    PART2 = 1
+    PART3 = 2
+    PART4 = 3
+
+
+@dataclass
+class RestoreStageResult:
+    peak_rss: int
+    # The pipeline steps catch their own errors, and the worker's copy of the pipeline
+    # is not sent back, so its error flag is returned here.
+    errors_occurred: bool
+
+
+def run_restore_stage(
+    proc: RestorePipeline, stage: RestoreStage, profile_file: str | None = None
+) -> RestoreStageResult:
+    logging.info(f'Starting restore part {stage + 1} for "{proc.srce_upscale_file.name}".')
+
+    with get_restore_stage_profile(proc, stage.name) as stage_profile:
+        if stage == RestoreStage.PART1:
+            proc.do_part1()
+        elif stage == RestoreStage.PART2:
+            proc.do_part2_memory_hungry()
+        elif stage == RestoreStage.PART3:
+            proc.do_part3()
+        else:
+            assert stage == RestoreStage.PART4
+            proc.do_part4_memory_hungry()
+
+    record = stage_profile.record
+    logging.info(
+        f"Restore part {stage + 1} of"
+        f' "{proc.srce_upscale_file.name}": wall {record.wall_secs:.1f}s,'
+        f" cpu {record.user_cpu_secs + record.sys_cpu_secs:.1f}s,"
+        f" peak RSS {record.peak_rss // (1024 * 1024)}MB."
+    )
+    if profile_file:
+        add_stage_profile_record(profile_file, record)
+
+    return RestoreStageResult(record.peak_rss, proc.errors_occurred)
+
+
+def get_restore_stage_profile(proc: RestorePipeline, stage: str) -> StageProfile:
+    # Pages of a title share the title work dir.
+    return StageProfile(
+        os.path.basename(proc.work_dir),
+        proc.srce_upscale_file.name,
+        stage,
+        str(proc.srce_upscale_file),
+    )
+
+
+class RestoreScheduler:
+    """Run the restore stages of many pages on one shared process pool.
+
+    Each page moves on to its next stage as soon as its previous stage is done, so
+    there is no barrier between stages. 'stage_max_workers' caps how many pages can be
+    in a stage at once (None means no cap beyond the pool size), which is how the
+    memory hungry stages are kept within RAM.
+
+    With an 'rss_profile', a stage is only started if its predicted peak RSS fits in
+    memory along with the predicted peaks of the stages already running. The measured
+    peaks are added back to the profile.
+
+    With a 'profile_file', a profile record of each stage run is added to the file.
+    """
+
+    def __init__(
+        self,
+        max_workers: int | None,
+        stage_max_workers: dict[RestoreStage, int | None],
+        rss_profile: StageRssProfile | None = None,
+        profile_file: str | None = None,
+    ) -> None:
+        self._max_workers = max_workers if max_workers else (os.cpu_count() or 1)
+        self._stage_max_workers = stage_max_workers
+        self._rss_profile = rss_profile
+        self._profile_file = profile_file
+        self._memory_budget = 0
+        self._committed_rss = 0
+
+    def run(self, restore_procs: list[RestorePipeline]) -> None:
+        ready: dict[RestoreStage, deque[int]] = {stage: deque() for stage in RestoreStage}
+        ready[RestoreStage.PART1].extend(range(len(restore_procs)))
+        num_running = dict.fromkeys(RestoreStage, 0)
+        running: dict[concurrent.futures.Future, tuple[int, RestoreStage, int]] = {}
+        self._memory_budget = psutil.virtual_memory().available
+        self._committed_rss = 0
+
+        with concurrent.futures.ProcessPoolExecutor(self._max_workers) as executor:
+            while True:
+                while len(running) < self._max_workers:
+                    stage = self._get_next_stage_to_run(ready, num_running)
+                    if stage is None:
+                        break
+                    proc_index = ready[stage].popleft()
+                    predicted_rss = self._get_predicted_rss(stage)
+                    future = executor.submit(
+                        run_restore_stage, restore_procs[proc_index], stage, self._profile_file
+                    )
+                    running[future] = (proc_index, stage, predicted_rss)
+                    num_running[stage] += 1
+                    self._committed_rss += predicted_rss
+
+                if not running:
+                    break
+
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    proc_index, stage, predicted_rss = running.pop(future)
+                    num_running[stage] -= 1
+                    self._committed_rss -= predicted_rss
+                    self._stage_done(restore_procs[proc_index], proc_index, stage, future, ready)
+
+        if self._rss_profile:
+            self._rss_profile.save()
+
+    def _get_next_stage_to_run(
+        self, ready: dict[RestoreStage, deque[int]], num_running: dict[RestoreStage, int]
+    ) -> RestoreStage | None:
+        # Prefer the latest stages so pages finish, and free their work files, early.
+        for stage in reversed(RestoreStage):
+            if not ready[stage]:
+                continue
+            max_workers = self._stage_max_workers.get(stage)
+            if max_workers is not None and num_running[stage] >= max_workers:
+                continue
+            if not self._fits_in_memory(stage, num_running):
+                continue
+            return stage
+
+        return None
+
+    def _get_predicted_rss(self, stage: RestoreStage) -> int:
+        if not self._rss_profile:
+            return 0
+        return self._rss_profile.get_predicted_rss(stage.name)
+
+    def _fits_in_memory(self, stage: RestoreStage, num_running: dict[RestoreStage, int]) -> bool:
+        if not self._rss_profile or sum(num_running.values()) == 0:
+            # Always let one stage run, even if it looks too big.
+            return True
+
+        # Recently started stages may not have grown yet, so as well as fitting in what
+        # is available now, the total predicted for all running stages must fit in what
+        # was available at the start.
+        predicted_rss = self._get_predicted_rss(stage)
+        if self._committed_rss + predicted_rss > self._memory_budget:
+            return False
+
+        return predicted_rss <= psutil.virtual_memory().available
+
+    def _stage_done(
+        self,
+        proc: RestorePipeline,
+        proc_index: int,
+        stage: RestoreStage,
+        future: concurrent.futures.Future,
+        ready: dict[RestoreStage, deque[int]],
+    ) -> None:
+        if future.exception() is not None:
+            proc.errors_occurred = True
+            logging.error(
+                f'Restore part {stage + 1} failed for "{proc.srce_upscale_file.name}":'
+                f" {future.exception()}."
+            )
+            return
+
+        stage_result = future.result()
+        if self._rss_profile:
+            self._rss_profile.add_peak_rss(stage.name, stage_result.peak_rss)
+
+        if stage_result.errors_occurred:
+            proc.errors_occurred = True
+            logging.error(
+                f'Restore part {stage + 1} had errors for "{proc.srce_upscale_file.name}"'
+                f" - not running its later parts."
+            )
+            return
+
+        if stage != RestoreStage.PART4:
+            ready[RestoreStage(stage + 1)].append(proc_index)
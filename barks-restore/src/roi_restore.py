@@ -0,0 +1,354 @@
+from __future__ import annotations
+
+import logging
+import os
+import shutil
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+import cv2 as cv
+import numpy as np
+
+from .gmic_exe import USE_GMIC_BINDING
+from .image_io import (
+    resize_image_to_file,
+    svg_file_to_image,
+    svg_to_image,
+    write_cv_image_file,
+    write_work_image_file,
+)
+from .inpaint import INPAINT_TILE_HALO, get_inpainted_image
+from .overlay import OVERLAY_TILE_HALO, overlay_inpainted_image_with_black_ink
+from .remove_alias_artifacts import get_median_filter, get_median_filter_halo
+from .remove_colors import get_color_removed_image
+from .smooth_image import get_smooth_tile_halo, smooth_image
+from .vtracer_to_svg import image_to_svg, write_svg_file
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from .restore_pipeline import RestorePipeline
+
+# If more than this fraction of a page has changed, a full restore is just as quick.
+ROI_MAX_DIRTY_FRACTION = 0.5
+
+ROI_PREV_INPUT_SUFFIX = "-roi-prev-input"
+
+
+@dataclass
+class Rect:
+    x_min: int
+    y_min: int
+    x_max: int
+    y_max: int
+
+    def get_area(self) -> int:
+        return (self.x_max - self.x_min) * (self.y_max - self.y_min)
+
+    def get_expanded(self, halo: int, width: int, height: int) -> Rect:
+        return Rect(
+            max(0, self.x_min - halo),
+            max(0, self.y_min - halo),
+            min(width, self.x_max + halo),
+            min(height, self.y_max + halo),
+        )
+
+    def get_crop(self, image: cv.typing.MatLike) -> cv.typing.MatLike:
+        return image[self.y_min : self.y_max, self.x_min : self.x_max]
+
+    def is_near(self, other: Rect, gap: int) -> bool:
+        return (
+            self.x_min <= other.x_max + gap
+            and other.x_min <= self.x_max + gap
+            and self.y_min <= other.y_max + gap
+            and other.y_min <= self.y_max + gap
+        )
+
+    def get_union(self, other: Rect) -> Rect:
+        return Rect(
+            min(self.x_min, other.x_min),
+            min(self.y_min, other.y_min),
+            max(self.x_max, other.x_max),
+            max(self.y_max, other.y_max),
+        )
+
+
+def get_merged_rects(rects: list[Rect], gap: int) -> list[Rect]:
+    """Merge rects closer than 'gap' - their halos overlap, so it is less work."""
+    merged_rects = list(rects)
+
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(merged_rects)):
+            for j in range(i + 1, len(merged_rects)):
+                if merged_rects[i].is_near(merged_rects[j], gap):
+                    merged_rects[i] = merged_rects[i].get_union(merged_rects.pop(j))
+                    merged = True
+                    break
+            if merged:
+                break
+
+    return merged_rects
+
+
+def _get_changed_pixel_rects(image1: cv.typing.MatLike, image2: cv.typing.MatLike) -> list[Rect]:
+    """Return the bounding rects of every pixel that differs between two images.
+
+    This is an exact diff, not the SSIM diff of 'show-fixes-diffs', which ignores
+    diff areas up to 40 pixels - any missed pixel would leave a stale restored area.
+    """
+    changed = cv.absdiff(image1, image2)
+    if changed.ndim == 3:
+        changed = np.max(changed, axis=2)
+
+    return _get_contour_rects(np.where(changed > 0, 255, 0).astype(np.uint8), -1, 1)
+
+
+def _get_contour_rects(mask: cv.typing.MatLike, min_area: float, scale: int) -> list[Rect]:
+    contours = cv.findContours(mask, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
+    contours = contours[0] if len(contours) == 2 else contours[1]
+
+    rects = []
+    for c in contours:
+        if cv.contourArea(c) < min_area:
+            continue
+        x, y, w, h = cv.boundingRect(c)
+        rects.append(Rect(x * scale, y * scale, (x + w) * scale, (y + h) * scale))
+
+    return rects
+
+
+def get_roi_prev_input_file(proc: RestorePipeline) -> str:
+    return os.path.join(
+        proc.work_dir,
+        f"{proc.srce_upscale_stem}{ROI_PREV_INPUT_SUFFIX}{proc.srce_upscale_file.suffix}",
+    )
+
+
+def save_roi_input(proc: RestorePipeline) -> None:
+    """Keep the input of a finished restore to diff a later fixed input against.
+
+    The input is hard linked where possible. Upscaled files are replaced, never
+    rewritten in place, so the link keeps the old contents at no cost until then.
+    """
+    prev_input_file = get_roi_prev_input_file(proc)
+    temp_prev_input_file = f"{prev_input_file}.tmp-{os.getpid()}"
+
+    try:
+        os.link(proc.srce_upscale_file, temp_prev_input_file)
+    except OSError:
+        shutil.copyfile(proc.srce_upscale_file, temp_prev_input_file)
+    os.replace(temp_prev_input_file, prev_input_file)
+
+
+def has_roi_input_changed(proc: RestorePipeline) -> bool:
+    prev_input_file = get_roi_prev_input_file(proc)
+    if not os.path.isfile(prev_input_file):
+        return False
+
+    return not os.path.samefile(prev_input_file, proc.srce_upscale_file)
+
+
+class RoiRestore:
+    """Restore a fixed page by only reprocessing the areas that the fix changed.
+
+    The fixed input is diffed against the input of the last restore. Each restore step
+    then recomputes its changed rects, grown by the halo of the step's operator, and
+    splices them into the outputs of the last restore. Only vectorizing is done for
+    the whole page, but the black ink is only updated where the svg raster changed.
+    """
+
+    def __init__(self, proc: RestorePipeline) -> None:
+        self._proc = proc
+        self._roi_stem = f"{proc.srce_upscale_stem}-roi"
+
+    def can_run(self) -> bool:
+        proc = self._proc
+        return (
+            USE_GMIC_BINDING
+            and os.path.isfile(get_roi_prev_input_file(proc))
+            and all(
+                os.path.isfile(f)
+                for f in [
+                    proc.removed_colors_file,
+                    proc.smoothed_removed_colors_file,
+                    proc.dest_svg_restored_file,
+                    proc.dest_upscayled_restored_file,
+                ]
+            )
+        )
+
+    def run(self) -> bool:
+        """Return False if the page needs a full restore instead."""
+        if not self.can_run():
+            return False
+
+        proc = self._proc
+        try:
+            start = time.time()
+            logging.info(f'\nRestoring changed areas of "{proc.srce_upscale_file.name}"...')
+
+            input_image = cv.imread(str(proc.srce_upscale_file))
+            prev_input_image = cv.imread(get_roi_prev_input_file(proc))
+            if input_image is None or prev_input_image is None:
+                msg = f'Could not read roi input files for "{proc.srce_upscale_file}".'
+                raise FileNotFoundError(msg)
+            if input_image.shape != prev_input_image.shape:
+                logging.info("Fixed page size has changed - doing a full restore.")
+                return False
+
+            dirty_rects = _get_changed_pixel_rects(prev_input_image, input_image)
+            del prev_input_image
+
+            page_area = input_image.shape[0] * input_image.shape[1]
+            dirty_area = sum(rect.get_area() for rect in dirty_rects)
+            if dirty_area > ROI_MAX_DIRTY_FRACTION * page_area:
+                logging.info(
+                    f"{100 * dirty_area // page_area}% of the page has changed"
+                    f" - doing a full restore."
+                )
+                return False
+
+            if dirty_rects:
+                self._restore_rects(input_image, dirty_rects)
+            else:
+                logging.info("No changed areas found.")
+            save_roi_input(proc)
+
+            logging.info(
+                f"Time taken to restore {len(dirty_rects)} changed areas of"
+                f' "{os.path.basename(proc.dest_restored_file)}": {int(time.time() - start)}s.'
+            )
+        except Exception:
+            logging.exception("Error restoring changed areas - doing a full restore: ")
+            # The outputs may be part updated, so only a full restore can fix them.
+            prev_input_file = get_roi_prev_input_file(proc)
+            if os.path.isfile(prev_input_file):
+                os.remove(prev_input_file)
+            return False
+
+        return True
+
+    def _restore_rects(self, input_image: cv.typing.MatLike, dirty_rects: list[Rect]) -> None:
+        proc = self._proc
+        height, width = input_image.shape[0], input_image.shape[1]
+
+        median_halo = get_median_filter_halo()
+        removed_colors_rects = [r.get_expanded(median_halo, width, height) for r in dirty_rects]
+        removed_colors_image = self._splice_rects(
+            proc.removed_colors_file,
+            [input_image],
+            removed_colors_rects,
+            median_halo,
+            self._get_color_removed_image,
+        )
+        write_work_image_file(proc.removed_colors_file, removed_colors_image)
+
+        smooth_halo = get_smooth_tile_halo()
+        smoothed_rects = [r.get_expanded(smooth_halo, width, height) for r in removed_colors_rects]
+        smoothed_image = self._splice_rects(
+            proc.smoothed_removed_colors_file,
+            [removed_colors_image],
+            smoothed_rects,
+            smooth_halo,
+            lambda images: smooth_image(images[0]),
+        )
+        write_work_image_file(proc.smoothed_removed_colors_file, smoothed_image)
+
+        prev_black_ink_image = svg_file_to_image(proc.dest_svg_restored_file)
+        svg = image_to_svg(smoothed_image)
+        del smoothed_image
+        write_svg_file(proc.dest_svg_restored_file, svg)
+        black_ink_image = svg_to_image(svg)
+        black_ink_rects = _get_changed_pixel_rects(prev_black_ink_image, black_ink_image)
+        del prev_black_ink_image
+
+        # The overlay is per pixel, so it needs no more halo than the inpainting.
+        assert OVERLAY_TILE_HALO == 0
+        restored_rects = [
+            *(r.get_expanded(INPAINT_TILE_HALO, width, height) for r in removed_colors_rects),
+            *black_ink_rects,
+        ]
+        restored_image = self._splice_rects(
+            proc.dest_upscayled_restored_file,
+            [input_image, removed_colors_image, black_ink_image],
+            restored_rects,
+            INPAINT_TILE_HALO,
+            self._get_restored_image,
+        )
+        write_cv_image_file(proc.dest_upscayled_restored_file, restored_image)
+
+        resize_image_to_file(
+            restored_image,
+            proc.scale,
+            proc.dest_restored_file,
+            proc.get_restored_file_metadata(),
+        )
+
+    def _get_color_removed_image(self, images: list[cv.typing.MatLike]) -> cv.typing.MatLike:
+        engines = self._proc.engines
+        color_removed_image = get_color_removed_image(
+            self._proc.work_dir,
+            self._roi_stem,
+            get_median_filter(images[0], engines.median_filter),
+            engines.posterize_lut,
+        )
+        return cv.cvtColor(color_removed_image, cv.COLOR_BGRA2BGR)
+
+    def _get_restored_image(self, images: list[cv.typing.MatLike]) -> cv.typing.MatLike:
+        input_image, black_ink_mask, black_ink_image = images
+        inpainted_image = get_inpainted_image(
+            self._proc.work_dir, self._roi_stem, input_image, black_ink_mask
+        )
+        return overlay_inpainted_image_with_black_ink(inpainted_image, black_ink_image)
+
+    @staticmethod
+    def _splice_rects(
+        out_file: str,
+        in_images: list[cv.typing.MatLike],
+        rects: list[Rect],
+        halo: int,
+        process_rect: Callable[[list[cv.typing.MatLike]], cv.typing.MatLike],
+    ) -> cv.typing.MatLike:
+        out_image = cv.imread(out_file, cv.IMREAD_UNCHANGED)
+        if out_image is None:
+            msg = f'Could not read roi output file "{out_file}".'
+            raise FileNotFoundError(msg)
+
+        height, width = in_images[0].shape[0], in_images[0].shape[1]
+        for rect in get_merged_rects(rects, 2 * halo):
+            outer_rect = rect.get_expanded(halo, width, height)
+            rect_image = process_rect([outer_rect.get_crop(image) for image in in_images])
+            rect_image = rect_image[
+                rect.y_min - outer_rect.y_min : rect.y_max - outer_rect.y_min,
+                rect.x_min - outer_rect.x_min : rect.x_max - outer_rect.x_min,
+            ]
+            out_image[rect.y_min : rect.y_max, rect.x_min : rect.x_max] = _to_uint8(
+                _get_matching_channels(rect_image, out_image)
+            )
+
+        return out_image
+
+
+def _get_matching_channels(
+    image: cv.typing.MatLike, like_image: cv.typing.MatLike
+) -> cv.typing.MatLike:
+    num_channels = 1 if image.ndim == 2 else image.shape[2]
+    like_num_channels = 1 if like_image.ndim == 2 else like_image.shape[2]
+    if num_channels == like_num_channels:
+        return image
+    if like_num_channels == 1:
+        return image[:, :, 0]
+    if num_channels == 1:
+        return cv.cvtColor(
+            image, cv.COLOR_GRAY2BGR if like_num_channels == 3 else cv.COLOR_GRAY2BGRA
+        )
+    return image[:, :, :3] if like_num_channels == 3 else cv.cvtColor(image, cv.COLOR_BGR2BGRA)
+
+
+def _to_uint8(image: cv.typing.MatLike) -> cv.typing.MatLike:
+    if image.dtype == np.uint8:
+        return image
+    return np.clip(np.rint(image), 0, 255).astype(np.uint8)
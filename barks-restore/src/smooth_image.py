@@ -1,47 +1,86 @@
-from .gmic_exe import run_gmic
+import math
+
+import cv2 as cv
+
+from .gmic_exe import run_gmic, run_gmic_on_images
+from .tiling import get_tile_size, process_image_files_in_tiles
+
+SMOOTH_AMPLITUDE = 420
+SMOOTH_SHARPNESS = 0.5
+SMOOTH_ANISOTROPY = 0.6
+SMOOTH_ALPHA = 2.5
+SMOOTH_SIGMA = 5.0
+SMOOTH_DL = 0.8
+SMOOTH_DA = 30
+SMOOTH_PRECISION = 2
+SMOOTH_INTERPOLATION = 0  # nearest
+SMOOTH_FAST_APPROX = 1
+SMOOTH_REPEAT = 2
+SMOOTH_CHANNELS = 0
+
+# Rough peak gmic memory per pixel for the smooth command - float channels plus the
+# structure tensor and work copies.
+SMOOTH_BYTES_PER_PIXEL = 96
 
 
 def smooth_image_file(in_file: str, out_file: str) -> None:
-    smooth_cmd = [
-        in_file,
+    smooth_cmd = [in_file, *get_gmic_smooth_params(), "-output[-1]", out_file]
+
+    run_gmic(smooth_cmd)
+
+
+def smooth_image(image: cv.typing.MatLike) -> cv.typing.MatLike:
+    return run_gmic_on_images(get_gmic_smooth_params(), [image])[-1]
+
+
+def smooth_image_file_in_tiles(
+    work_dir: str, work_file_stem: str, in_file: str, out_file: str, max_tile_rss: int
+) -> None:
+    halo = get_smooth_tile_halo()
+
+    process_image_files_in_tiles(
+        work_dir,
+        f"{work_file_stem}-smooth",
+        [in_file],
+        out_file,
+        get_tile_size(max_tile_rss, SMOOTH_BYTES_PER_PIXEL, halo),
+        halo,
+        lambda tile_in_files, tile_out_file: smooth_image_file(tile_in_files[0], tile_out_file),
+    )
+
+
+def get_smooth_tile_halo() -> int:
+    # Each iteration blurs the structure tensor (alpha, sigma) and then integrates
+    # along the flow for about 'precision * sqrt(2 * amplitude)' pixels.
+    tensor_radius = math.ceil(3 * (SMOOTH_ALPHA + SMOOTH_SIGMA))
+    integration_length = math.ceil(SMOOTH_PRECISION * math.sqrt(2 * SMOOTH_AMPLITUDE))
+
+    return SMOOTH_REPEAT * (tensor_radius + integration_length)
+
+
+def get_gmic_smooth_params() -> list[str]:
+    return [
         "fx_smooth_anisotropic",
         _get_gmic_smooth_anisotropic_params(),
         "-threshold[-1]",
         "100,1",
         "normalize[-1]",
         "0,255",
-        "-output[-1]",
-        out_file,
     ]
 
-    run_gmic(smooth_cmd)
-
 
 def _get_gmic_smooth_anisotropic_params() -> str:
-    amplitude = 420
-    sharpness = 0.5
-    anisotropy = 0.6
-    alpha = 2.5
-    sigma = 5.0
-    dl = 0.8
-    da = 30
-    precision = 2
-    interpolation = 0  # nearest
-    fast_approx = 1
-    repeat = 2
-    channels = 0
-
     return (
-        f"{amplitude},"
-        f"{sharpness},"
-        f"{anisotropy},"
-        f"{alpha},"
-        f"{sigma},"
-        f"{dl},"
-        f"{da},"
-        f"{precision},"
-        f"{interpolation},"
-        f"{fast_approx},"
-        f"{repeat},"
-        f"{channels}"
+        f"{SMOOTH_AMPLITUDE},"
+        f"{SMOOTH_SHARPNESS},"
+        f"{SMOOTH_ANISOTROPY},"
+        f"{SMOOTH_ALPHA},"
+        f"{SMOOTH_SIGMA},"
+        f"{SMOOTH_DL},"
+        f"{SMOOTH_DA},"
+        f"{SMOOTH_PRECISION},"
+        f"{SMOOTH_INTERPOLATION},"
+        f"{SMOOTH_FAST_APPROX},"
+        f"{SMOOTH_REPEAT},"
+        f"{SMOOTH_CHANNELS}"
     )
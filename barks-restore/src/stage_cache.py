@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from typing import Any
+
+from .atomic_output import atomic_output_file
+
+STAGE_CACHE_VERSION = 1
+
+
+class StageCache:
+    """Content addressed store of restore stage outputs.
+
+    An entry is keyed on the stage name, the stage parameters and the bytes of the stage
+    input files, so it can only be reused if none of these have changed. Entries are
+    directories in 'cache_dir', and the least recently used ones are evicted once the
+    cache is bigger than 'max_bytes'.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int) -> None:
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+
+        os.makedirs(self._cache_dir, exist_ok=True)
+
+    def get_key(self, stage: str, in_files: list[str], params: dict[str, Any]) -> str:
+        key_data = {
+            "version": STAGE_CACHE_VERSION,
+            "stage": stage,
+            "params": params,
+            "inputs": [_get_file_digest(in_file) for in_file in in_files],
+        }
+        key_str = json.dumps(key_data, sort_keys=True, default=str)
+
+        return hashlib.sha256(key_str.encode()).hexdigest()
+
+    def restore(self, key: str, out_files: list[str]) -> bool:
+        entry_dir = self._get_entry_dir(key)
+        if not os.path.isdir(entry_dir):
+            return False
+
+        try:
+            for i, out_file in enumerate(out_files):
+                with atomic_output_file(out_file) as temp_out_file:
+                    shutil.copyfile(_get_entry_file(entry_dir, i, out_file), temp_out_file)
+            # Directory mtimes are the LRU order.
+            os.utime(entry_dir)
+        except FileNotFoundError:
+            # Evicted by another process while being restored.
+            return False
+
+        return True
+
+    def add(self, key: str, out_files: list[str]) -> None:
+        entry_dir = self._get_entry_dir(key)
+        if os.path.isdir(entry_dir):
+            return
+
+        # Build the entry under a temp name so other processes never see a partial entry.
+        temp_entry_dir = f"{entry_dir}.tmp-{os.getpid()}"
+        os.makedirs(temp_entry_dir, exist_ok=True)
+        for i, out_file in enumerate(out_files):
+            shutil.copyfile(out_file, _get_entry_file(temp_entry_dir, i, out_file))
+
+        try:
+            os.rename(temp_entry_dir, entry_dir)
+        except OSError:
+            # Another process added the same entry first.
+            shutil.rmtree(temp_entry_dir, ignore_errors=True)
+
+        self._evict()
+
+    def _get_entry_dir(self, key: str) -> str:
+        return os.path.join(self._cache_dir, key)
+
+    def _evict(self) -> None:
+        entries = []
+        total_bytes = 0
+        for entry in os.scandir(self._cache_dir):
+            if not entry.is_dir() or ".tmp-" in entry.name:
+                continue
+            try:
+                entry_bytes = sum(f.stat().st_size for f in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, entry_bytes, entry.path))
+            except FileNotFoundError:
+                continue
+            total_bytes += entry_bytes
+
+        for _mtime, entry_bytes, entry_dir in sorted(entries):
+            if total_bytes <= self._max_bytes:
+                break
+            logging.debug(f'Evicting stage cache entry "{entry_dir}".')
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_bytes -= entry_bytes
+
+
+def _get_entry_file(entry_dir: str, index: int, out_file: str) -> str:
+    return os.path.join(entry_dir, f"{index:02d}-{os.path.basename(out_file)}")
+
+
+def _get_file_digest(file: str) -> str:
+    with open(file, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import json
+import os
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime
+
+import numpy as np
+import psutil
+from PIL import Image
+
+from .memory_profile import PeakRssMonitor
+
+PROFILE_FILE_EXT = ".jsonl"
+
+
+@dataclass
+class StageProfileRecord:
+    title: str
+    page: str
+    stage: str
+    start_time: float
+    wall_secs: float
+    # CPU times include waited for children, such as gmic processes.
+    user_cpu_secs: float
+    sys_cpu_secs: float
+    # Peak RSS of this process plus its children.
+    peak_rss: int
+    # All bytes read and written by this process and its waited for children, whether
+    # or not they came from the page cache.
+    read_bytes: int
+    write_bytes: int
+    width: int
+    height: int
+    # The profile file the record was read from - one per run, so it is not written.
+    run: str = ""
+
+
+class StageProfile:
+    """Measure a restore stage - use as a context manager around the stage.
+
+    The measurements are deltas of this process's counters, so stages must not overlap
+    in the same process.
+    """
+
+    def __init__(self, title: str, page: str, stage: str, image_file: str) -> None:
+        self._title = title
+        self._page = page
+        self._stage = stage
+        self._image_file = image_file
+        self._process = psutil.Process()
+        self._rss_monitor = PeakRssMonitor()
+        self._start_time = 0.0
+        self._start_wall = 0.0
+        self._start_cpu_times = None
+        self._start_io_counters = None
+        self.record: StageProfileRecord | None = None
+
+    def __enter__(self) -> StageProfile:
+        self._start_time = time.time()
+        self._start_wall = time.perf_counter()
+        self._start_cpu_times = self._process.cpu_times()
+        self._start_io_counters = self._process.io_counters()
+        self._rss_monitor.__enter__()
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self._rss_monitor.__exit__(*args)
+        wall_secs = time.perf_counter() - self._start_wall
+        cpu_times = self._process.cpu_times()
+        io_counters = self._process.io_counters()
+
+        user_cpu_secs = (cpu_times.user + cpu_times.children_user) - (
+            self._start_cpu_times.user + self._start_cpu_times.children_user
+        )
+        sys_cpu_secs = (cpu_times.system + cpu_times.children_system) - (
+            self._start_cpu_times.system + self._start_cpu_times.children_system
+        )
+        width, height = _get_image_size(self._image_file)
+
+        self.record = StageProfileRecord(
+            self._title,
+            self._page,
+            self._stage,
+            self._start_time,
+            wall_secs,
+            user_cpu_secs,
+            sys_cpu_secs,
+            self._rss_monitor.peak_rss,
+            io_counters.read_chars - self._start_io_counters.read_chars,
+            io_counters.write_chars - self._start_io_counters.write_chars,
+            width,
+            height,
+        )
+
+
+def _get_image_size(image_file: str) -> tuple[int, int]:
+    # Only the header is read.
+    try:
+        with Image.open(image_file) as image:
+            return image.size
+    except OSError:
+        return 0, 0
+
+
+def get_profile_file(profile_dir: str, command: str) -> str:
+    """Return a new profile file for one run of 'command'."""
+    os.makedirs(profile_dir, exist_ok=True)
+    run_id = datetime.now().astimezone().strftime("%Y%m%d-%H%M%S")
+
+    return os.path.join(profile_dir, f"{command}-{run_id}-{os.getpid()}{PROFILE_FILE_EXT}")
+
+
+def add_stage_profile_record(profile_file: str, record: StageProfileRecord) -> None:
+    # One short line per append, so records from many worker processes don't mix.
+    record_dict = asdict(record)
+    del record_dict["run"]
+    with open(profile_file, "a") as f:
+        f.write(json.dumps(record_dict) + "\n")
+
+
+def read_stage_profile_records(profile_paths: list[str]) -> list[StageProfileRecord]:
+    """Read the records in the given profile files and directories of profile files."""
+    profile_files = []
+    for profile_path in profile_paths:
+        if os.path.isdir(profile_path):
+            profile_files.extend(
+                os.path.join(profile_path, f)
+                for f in sorted(os.listdir(profile_path))
+                if f.endswith(PROFILE_FILE_EXT)
+            )
+        else:
+            profile_files.append(profile_path)
+
+    records = []
+    for profile_file in profile_files:
+        run = os.path.splitext(os.path.basename(profile_file))[0]
+        with open(profile_file) as f:
+            records.extend(
+                StageProfileRecord(**json.loads(line), run=run) for line in f if line.strip()
+            )
+
+    return records
+
+
+def get_stage_profile_report(records: list[StageProfileRecord], num_slowest_pages: int) -> str:
+    mb = 1024 * 1024
+    report_lines = [
+        f"{'stage':<10} {'count':>6}"
+        f" {'wall p50':>9} {'wall p95':>9} {'cpu p50':>9} {'cpu p95':>9}"
+        f" {'rss p95 MB':>11} {'read p50 MB':>12} {'write p50 MB':>13} {'MP/s p50':>9}"
+    ]
+
+    for stage in sorted({record.stage for record in records}):
+        stage_records = [record for record in records if record.stage == stage]
+        wall_secs = np.array([r.wall_secs for r in stage_records])
+        cpu_secs = np.array([r.user_cpu_secs + r.sys_cpu_secs for r in stage_records])
+        peak_rss = np.array([r.peak_rss for r in stage_records])
+        read_bytes = np.array([r.read_bytes for r in stage_records])
+        write_bytes = np.array([r.write_bytes for r in stage_records])
+        megapixels_per_sec = np.array(
+            [r.width * r.height / 1e6 / max(r.wall_secs, 1e-6) for r in stage_records]
+        )
+
+        report_lines.append(
+            f"{stage:<10} {len(stage_records):>6}"
+            f" {np.percentile(wall_secs, 50):>8.1f}s {np.percentile(wall_secs, 95):>8.1f}s"
+            f" {np.percentile(cpu_secs, 50):>8.1f}s {np.percentile(cpu_secs, 95):>8.1f}s"
+            f" {np.percentile(peak_rss, 95) / mb:>11.0f}"
+            f" {np.percentile(read_bytes, 50) / mb:>12.0f}"
+            f" {np.percentile(write_bytes, 50) / mb:>13.0f}"
+            f" {np.percentile(megapixels_per_sec, 50):>9.2f}"
+        )
+
+    # A page restored in several runs is a separate page per run - summing its runs
+    # would rank pages by how often they were restored.
+    page_wall_secs: dict[tuple[str, str, str], float] = {}
+    for record in records:
+        page_key = (record.run, record.title, record.page)
+        page_wall_secs[page_key] = page_wall_secs.get(page_key, 0.0) + record.wall_secs
+
+    report_lines.append("")
+    report_lines.append(f"Slowest {num_slowest_pages} pages:")
+    slowest_pages = sorted(page_wall_secs.items(), key=lambda item: item[1], reverse=True)
+    for (run, title, page), wall_secs in slowest_pages[:num_slowest_pages]:
+        stage_secs = ", ".join(
+            f"{r.stage}: {r.wall_secs:.1f}s"
+            for r in records
+            if r.run == run and r.title == title and r.page == page
+        )
+        report_lines.append(f'{wall_secs:>8.1f}s  "{title}" "{page}" [{run}] ({stage_secs})')
+
+    return "\n".join(report_lines)
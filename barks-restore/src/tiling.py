@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+import logging
+import math
+import os
+from collections.abc import Callable
+from dataclasses import dataclass
+
+import cv2 as cv
+import numpy as np
+
+from .image_io import write_work_image_file
+
+MIN_TILE_SIZE = 256
+
+
+@dataclass
+class Tile:
+    # The core is the part of the tile that is kept. The outer box is the core plus
+    # a halo, clipped to the image, that gets processed.
+    core_x_min: int
+    core_y_min: int
+    core_x_max: int
+    core_y_max: int
+    x_min: int
+    y_min: int
+    x_max: int
+    y_max: int
+
+
+def get_tile_size(max_rss: int, bytes_per_pixel: int, halo: int) -> int:
+    """Return the largest square tile core that fits the per-worker memory budget.
+
+    'bytes_per_pixel' is the peak memory an operator needs per pixel it is given, so
+    the processed tile, core plus halo, has to fit in 'max_rss'.
+    """
+    max_tile_pixels = max_rss // bytes_per_pixel
+    return max(MIN_TILE_SIZE, math.isqrt(max_tile_pixels) - 2 * halo)
+
+
+def get_tiles(width: int, height: int, tile_size: int, halo: int) -> list[Tile]:
+    tiles = []
+
+    for core_y_min in range(0, height, tile_size):
+        core_y_max = min(height, core_y_min + tile_size)
+        for core_x_min in range(0, width, tile_size):
+            core_x_max = min(width, core_x_min + tile_size)
+            tiles.append(
+                Tile(
+                    core_x_min,
+                    core_y_min,
+                    core_x_max,
+                    core_y_max,
+                    max(0, core_x_min - halo),
+                    max(0, core_y_min - halo),
+                    min(width, core_x_max + halo),
+                    min(height, core_y_max + halo),
+                )
+            )
+
+    return tiles
+
+
+def _get_tile_core(tile: Tile, tile_image: cv.typing.MatLike) -> cv.typing.MatLike:
+    return tile_image[
+        tile.core_y_min - tile.y_min : tile.core_y_max - tile.y_min,
+        tile.core_x_min - tile.x_min : tile.core_x_max - tile.x_min,
+    ]
+
+
+def process_image_in_tiles(
+    image: cv.typing.MatLike,
+    tile_size: int,
+    halo: int,
+    process_tile: Callable[[cv.typing.MatLike], cv.typing.MatLike],
+) -> cv.typing.MatLike:
+    """Apply an in-memory image operator tile by tile and stitch the results.
+
+    The result is the same as applying 'process_tile' to the whole image provided
+    'halo' covers every pixel the operator looks at to compute an output pixel.
+    """
+    height, width = image.shape[0], image.shape[1]
+    out_image = None
+
+    for tile in get_tiles(width, height, tile_size, halo):
+        tile_image = process_tile(image[tile.y_min : tile.y_max, tile.x_min : tile.x_max])
+        if out_image is None:
+            out_image = np.empty((height, width, *tile_image.shape[2:]), dtype=tile_image.dtype)
+        out_image[tile.core_y_min : tile.core_y_max, tile.core_x_min : tile.core_x_max] = (
+            _get_tile_core(tile, tile_image)
+        )
+
+    return out_image
+
+
+def process_image_files_in_tiles(
+    work_dir: str,
+    work_file_stem: str,
+    in_files: list[str],
+    out_file: str,
+    tile_size: int,
+    halo: int,
+    process_tile_files: Callable[[list[str], str], None],
+) -> None:
+    """Apply a file based image operator tile by tile and stitch the results.
+
+    Each input file is cut into the same overlapping tiles, and 'process_tile_files'
+    is called with the tile input files and a tile output file. Only the core of each
+    output tile is kept.
+
+    Png and jpeg files can't be decoded by region, so each input page is decoded once,
+    on its own, to a raw work file. Each tile then only reads its region of the raw
+    files, and writes its core to a raw output file, which is encoded at the end. So
+    no two whole pages are ever in memory at once, and none while the operator runs.
+    """
+    raw_in_images: list[_RawImage] = []
+    raw_out_image = None
+
+    try:
+        for in_num, in_file in enumerate(in_files):
+            raw_in_file = os.path.join(work_dir, f"{work_file_stem}-in-{in_num}.raw")
+            raw_in_images.append(_write_raw_image(in_file, raw_in_file))
+        height, width = raw_in_images[0].shape[0], raw_in_images[0].shape[1]
+        tiles = get_tiles(width, height, tile_size, halo)
+
+        for tile_num, tile in enumerate(tiles):
+            logging.debug(f'Processing tile {tile_num + 1} of {len(tiles)} for "{out_file}".')
+
+            tile_in_files = []
+            for in_num, raw_in_image in enumerate(raw_in_images):
+                tile_in_file = os.path.join(
+                    work_dir, f"{work_file_stem}-tile-{tile_num:03d}-in-{in_num}.png"
+                )
+                write_work_image_file(tile_in_file, raw_in_image.read_region(tile))
+                tile_in_files.append(tile_in_file)
+            tile_out_file = os.path.join(work_dir, f"{work_file_stem}-tile-{tile_num:03d}-out.png")
+
+            process_tile_files(tile_in_files, tile_out_file)
+
+            tile_image = cv.imread(tile_out_file, cv.IMREAD_UNCHANGED)
+            if tile_image is None:
+                msg = f'Could not read tile output file "{tile_out_file}".'
+                raise FileNotFoundError(msg)
+            if raw_out_image is None:
+                raw_out_image = _RawImage.create(
+                    os.path.join(work_dir, f"{work_file_stem}-out.raw"),
+                    (height, width, *tile_image.shape[2:]),
+                    tile_image.dtype,
+                )
+            raw_out_image.write_core(tile, _get_tile_core(tile, tile_image))
+            del tile_image
+
+            for tile_file in [*tile_in_files, tile_out_file]:
+                os.remove(tile_file)
+
+        cv.imwrite(out_file, raw_out_image.read())
+    finally:
+        for raw_image in [*raw_in_images, raw_out_image]:
+            if raw_image is not None and os.path.isfile(raw_image.file):
+                os.remove(raw_image.file)
+
+
+@dataclass
+class _RawImage:
+    """An uncompressed image work file - regions are read and written by memory map.
+
+    A map is only open for one region access, so the mapped pages are dropped again
+    and don't add up to a whole page of RSS.
+    """
+
+    file: str
+    shape: tuple[int, ...]
+    dtype: np.dtype
+
+    @staticmethod
+    def create(file: str, shape: tuple[int, ...], dtype: np.dtype) -> _RawImage:
+        with open(file, "wb") as f:
+            f.truncate(math.prod(shape) * np.dtype(dtype).itemsize)
+        return _RawImage(file, shape, dtype)
+
+    def read_region(self, tile: Tile) -> cv.typing.MatLike:
+        image_map = np.memmap(self.file, self.dtype, "r", shape=self.shape)
+        try:
+            return np.array(image_map[tile.y_min : tile.y_max, tile.x_min : tile.x_max])
+        finally:
+            del image_map
+
+    def write_core(self, tile: Tile, core_image: cv.typing.MatLike) -> None:
+        image_map = np.memmap(self.file, self.dtype, "r+", shape=self.shape)
+        try:
+            image_map[tile.core_y_min : tile.core_y_max, tile.core_x_min : tile.core_x_max] = (
+                core_image
+            )
+            image_map.flush()
+        finally:
+            del image_map
+
+    def read(self) -> cv.typing.MatLike:
+        return np.fromfile(self.file, self.dtype).reshape(self.shape)
+
+
+def _write_raw_image(in_file: str, raw_file: str) -> _RawImage:
+    in_image = cv.imread(in_file, cv.IMREAD_UNCHANGED)
+    if in_image is None:
+        msg = f'Could not read image file "{in_file}".'
+        raise FileNotFoundError(msg)
+
+    in_image.tofile(raw_file)
+
+    return _RawImage(raw_file, in_image.shape, in_image.dtype)
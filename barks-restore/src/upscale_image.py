@@ -1,27 +1,313 @@
+from __future__ import annotations
+
+import concurrent.futures
 import logging
 import os
+import shutil
 import subprocess
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from enum import Enum, auto
 from pathlib import Path
 
+import cv2 as cv
+import numpy as np
 from barks_fantagraphics.comics_utils import get_clean_path
 from comic_utils.pil_image_utils import add_png_metadata
 
+from .atomic_output import atomic_output_file
+from .image_io import write_cv_image_file
+from .tiling import get_tiles
+
 UPSCAYL_BIN = os.path.join(str(Path.home()), ".local/share/upscayl/bin/upscayl-bin")
 UPSCAYL_MODELS_DIR = os.path.join(str(Path.home()), ".local/share/upscayl/models")
 UPSCAYL_MODEL = "ultramix_balanced"
 UPSCAYL_OUTPUT_FORMAT = "png"
 UPSCAYL_OUTPUT_EXTENSION = ".png"
 
+# An ESRGAN class model exported to onnx, NCHW RGB float input in [0, 1].
+DNN_UPSCALER_MODEL_FILE = os.path.join(
+    str(Path.home()), ".local/share/barks-restore/models/realesrgan-x4plus.onnx"
+)
+DNN_UPSCALER_MODEL_SCALE = 4
+DNN_UPSCALER_TILE_SIZE = 256
+# Enough context for the model's receptive field so tile seams don't show.
+DNN_UPSCALER_TILE_OVERLAP = 16
+
+
+class UpscalerBackend(Enum):
+    UPSCAYL = auto()
+    DNN = auto()
+
+
+UPSCALER_BACKEND = UpscalerBackend.UPSCAYL
+
+
+class UpscaleFilesError(RuntimeError):
+    """Some of the files of a multi file upscale failed."""
+
+    def __init__(self, msg: str, done_out_files: list[str]) -> None:
+        super().__init__(msg)
+        # The out files that were upscaled before, or despite, the failures.
+        self.done_out_files = done_out_files
+
+
+class Upscaler(ABC):
+    @abstractmethod
+    def upscale_image_files(self, in_out_files: list[tuple[str, str]], scale: int) -> None:
+        pass
+
+    def upscale_image_file(self, in_file: str, out_file: str, scale: int) -> None:
+        self.upscale_image_files([(in_file, out_file)], scale)
+
+
+def get_upscaler(backend: UpscalerBackend = UPSCALER_BACKEND) -> Upscaler:
+    if backend == UpscalerBackend.UPSCAYL:
+        return UpscaylUpscaler()
+
+    assert backend == UpscalerBackend.DNN
+    return DnnUpscaler()
+
 
 def upscale_image_file(in_file: str, out_file: str, scale: int = 2) -> None:
-    assert os.path.splitext(out_file)[1] == UPSCAYL_OUTPUT_EXTENSION
+    get_upscaler().upscale_image_file(in_file, out_file, scale)
+
+
+def upscale_image_files(
+    in_out_files: list[tuple[str, str]],
+    scale: int = 2,
+) -> None:
+    get_upscaler().upscale_image_files(in_out_files, scale)
+
+
+class UpscaylUpscaler(Upscaler):
+    """Upscale with the external 'upscayl-bin'.
+
+    Many images are upscaled with one upscayl run, so the model is only loaded once.
+    The input files are symlinked into a staging directory which is given to upscayl
+    as a whole. The outputs are then moved to their out files and the metadata added.
+    The staging directory is in 'work_dir', or else next to the first out file.
+    """
+
+    def __init__(
+        self, work_dir: str | None = None, max_metadata_workers: int | None = None
+    ) -> None:
+        self._work_dir = work_dir
+        self._max_metadata_workers = max_metadata_workers
+
+    def upscale_image_file(self, in_file: str, out_file: str, scale: int) -> None:
+        assert os.path.splitext(out_file)[1] == UPSCAYL_OUTPUT_EXTENSION
+
+        with atomic_output_file(out_file) as temp_out_file:
+            _run_upscayl(in_file, temp_out_file, scale)
+
+            add_png_metadata(temp_out_file, _get_upscayl_metadata(in_file, scale))
+
+    def upscale_image_files(self, in_out_files: list[tuple[str, str]], scale: int) -> None:
+        if not in_out_files:
+            return
+
+        _check_upscale_files(in_out_files)
+
+        # Stage next to the out files by default, so the multi GB outputs are moved by a
+        # rename on the same filesystem, and can't fill up the system temp dir.
+        staging_parent_dir = self._work_dir or os.path.dirname(os.path.abspath(in_out_files[0][1]))
+        with tempfile.TemporaryDirectory(
+            prefix=".upscayl-staging-", dir=staging_parent_dir
+        ) as staging_dir:
+            staging_in_dir = os.path.join(staging_dir, "in")
+            staging_out_dir = os.path.join(staging_dir, "out")
+            os.makedirs(staging_in_dir)
+            os.makedirs(staging_out_dir)
+
+            # Staged files are numbered as the input files may come from different
+            # directories with clashing names.
+            staged_out_files = []
+            for i, (in_file, _out_file) in enumerate(in_out_files):
+                staged_stem = f"{i:04d}"
+                os.symlink(
+                    os.path.abspath(in_file),
+                    os.path.join(staging_in_dir, staged_stem + os.path.splitext(in_file)[1]),
+                )
+                staged_out_files.append(
+                    os.path.join(staging_out_dir, staged_stem + UPSCAYL_OUTPUT_EXTENSION)
+                )
+
+            logging.info(f"Upscayling {len(in_out_files)} files in one upscayl run.")
+            _run_upscayl(staging_in_dir, staging_out_dir, scale)
+
+            with concurrent.futures.ThreadPoolExecutor(self._max_metadata_workers) as executor:
+                futures = [
+                    executor.submit(_move_upscayled_file, staged_out_file, in_file, out_file, scale)
+                    for staged_out_file, (in_file, out_file) in zip(staged_out_files, in_out_files)
+                ]
+                errors = [
+                    (in_file, future.exception())
+                    for (in_file, _out_file), future in zip(in_out_files, futures)
+                    if future.exception()
+                ]
+                done_out_files = [
+                    out_file
+                    for (_in_file, out_file), future in zip(in_out_files, futures)
+                    if not future.exception()
+                ]
+
+        for in_file, error in errors:
+            logging.error(f'Upscayl failed for "{in_file}": {error}.')
+        if errors:
+            msg = f"Upscayl failed for {len(errors)} of {len(in_out_files)} files."
+            raise UpscaleFilesError(msg, done_out_files)
+
+
+class DnnUpscaler(Upscaler):
+    """Upscale in process with an onnx ESRGAN class model run by the OpenCV DNN module.
+
+    Images are upscaled in overlapping tiles, so memory use only depends on the tile
+    size. Set 'num_threads' to the cores per worker when running in a process pool.
+    """
 
+    def __init__(
+        self,
+        model_file: str = DNN_UPSCALER_MODEL_FILE,
+        model_scale: int = DNN_UPSCALER_MODEL_SCALE,
+        tile_size: int = DNN_UPSCALER_TILE_SIZE,
+        tile_overlap: int = DNN_UPSCALER_TILE_OVERLAP,
+        num_threads: int | None = None,
+    ) -> None:
+        self._model_file = model_file
+        self._model_scale = model_scale
+        self._tile_size = tile_size
+        self._tile_overlap = tile_overlap
+        self._num_threads = num_threads
+        self._net: cv.dnn.Net | None = None
+
+        # Seconds taken by each tile of the last upscaled image.
+        self.tile_times: list[float] = []
+
+    def __getstate__(self) -> dict:
+        # The net is loaded per process.
+        state = self.__dict__.copy()
+        state["_net"] = None
+        return state
+
+    def upscale_image_files(self, in_out_files: list[tuple[str, str]], scale: int) -> None:
+        _check_upscale_files(in_out_files)
+
+        done_out_files = []
+        for in_file, out_file in in_out_files:
+            start = time.time()
+
+            try:
+                image = cv.imread(in_file)
+                if image is None:
+                    msg = f'Could not read image file "{in_file}".'
+                    raise FileNotFoundError(msg)
+
+                write_cv_image_file(
+                    out_file,
+                    self.upscale_image(image, scale),
+                    _get_upscale_metadata(in_file, scale, Path(self._model_file).stem),
+                )
+            except Exception as e:
+                msg = f'Upscale failed for "{in_file}": {e}'
+                raise UpscaleFilesError(msg, done_out_files) from e
+            done_out_files.append(out_file)
+
+            logging.info(
+                f'Upscaled "{os.path.basename(in_file)}" in {len(self.tile_times)} tiles:'
+                f" {int(time.time() - start)}s."
+            )
+
+    def upscale_image(self, image: cv.typing.MatLike, scale: int) -> cv.typing.MatLike:
+        height, width = image.shape[0], image.shape[1]
+        model_scale = self._model_scale
+        out_image = np.empty((height * model_scale, width * model_scale, 3), dtype=np.uint8)
+        self.tile_times = []
+
+        for tile in get_tiles(width, height, self._tile_size, self._tile_overlap):
+            start = time.time()
+            tile_image = self._upscale_tile(image[tile.y_min : tile.y_max, tile.x_min : tile.x_max])
+            # Only keep the upscaled core of the tile.
+            core_y_min = (tile.core_y_min - tile.y_min) * model_scale
+            core_x_min = (tile.core_x_min - tile.x_min) * model_scale
+            core_height = (tile.core_y_max - tile.core_y_min) * model_scale
+            core_width = (tile.core_x_max - tile.core_x_min) * model_scale
+            out_image[
+                tile.core_y_min * model_scale : tile.core_y_max * model_scale,
+                tile.core_x_min * model_scale : tile.core_x_max * model_scale,
+            ] = tile_image[
+                core_y_min : core_y_min + core_height, core_x_min : core_x_min + core_width
+            ]
+            self.tile_times.append(time.time() - start)
+
+        if scale == model_scale:
+            return out_image
+
+        return cv.resize(out_image, (width * scale, height * scale), interpolation=cv.INTER_AREA)
+
+    def _upscale_tile(self, tile_image: cv.typing.MatLike) -> cv.typing.MatLike:
+        blob = cv.dnn.blobFromImage(tile_image, scalefactor=1.0 / 255.0, swapRB=True)
+
+        net = self._get_net()
+        net.setInput(blob)
+        out_blob = net.forward()
+
+        out_image = np.clip(out_blob[0].transpose(1, 2, 0) * 255.0, 0, 255)
+        return cv.cvtColor(np.rint(out_image).astype(np.uint8), cv.COLOR_RGB2BGR)
+
+    def _get_net(self) -> cv.dnn.Net:
+        if self._net is None:
+            if not os.path.isfile(self._model_file):
+                msg = f'Could not find upscale model file "{self._model_file}".'
+                raise FileNotFoundError(msg)
+            if self._num_threads:
+                cv.setNumThreads(self._num_threads)
+            self._net = cv.dnn.readNet(self._model_file)
+            self._net.setPreferableBackend(cv.dnn.DNN_BACKEND_OPENCV)
+            self._net.setPreferableTarget(cv.dnn.DNN_TARGET_CPU)
+
+        return self._net
+
+
+def _check_upscale_files(in_out_files: list[tuple[str, str]]) -> None:
+    for in_file, out_file in in_out_files:
+        assert os.path.splitext(out_file)[1] == UPSCAYL_OUTPUT_EXTENSION
+        if not os.path.isfile(in_file):
+            msg = f'Could not find upscale input file: "{in_file}".'
+            raise FileNotFoundError(msg)
+
+
+def _move_upscayled_file(staged_out_file: str, in_file: str, out_file: str, scale: int) -> None:
+    if not os.path.isfile(staged_out_file):
+        msg = f'Upscayl did not write "{staged_out_file}".'
+        raise FileNotFoundError(msg)
+
+    add_png_metadata(staged_out_file, _get_upscayl_metadata(in_file, scale))
+    with atomic_output_file(out_file) as temp_out_file:
+        shutil.move(staged_out_file, temp_out_file)
+
+
+def _get_upscayl_metadata(in_file: str, scale: int) -> dict[str, str]:
+    return _get_upscale_metadata(in_file, scale, UPSCAYL_MODEL)
+
+
+def _get_upscale_metadata(in_file: str, scale: int, model: str) -> dict[str, str]:
+    return {
+        "Srce file": f'"{get_clean_path(in_file)}"',
+        "Scale": str(scale),
+        "Upscayl model": model,
+    }
+
+
+def _run_upscayl(in_path: str, out_path: str, scale: int) -> None:
+    # 'in_path' and 'out_path' are either both files or both directories.
     run_args = [
         UPSCAYL_BIN,
         "-i",
-        in_file,
+        in_path,
         "-o",
-        out_file,
+        out_path,
         "-s",
         str(scale),
         "-n",
@@ -47,10 +333,3 @@ def upscale_image_file(in_file: str, out_file: str, scale: int = 2) -> None:
     rc = process.poll()
     if rc != 0:
         raise RuntimeError("Upscayl failed.")
-
-    metadata = {
-        "Srce file": f'"{get_clean_path(in_file)}"',
-        "Scale": str(scale),
-        "Upscayl model": UPSCAYL_MODEL,
-    }
-    add_png_metadata(out_file, metadata)
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import concurrent.futures
+import datetime
+import logging
+import os
+import threading
+import time
+from typing import TYPE_CHECKING
+
+import psutil
+
+from .upscale_image import UpscaleFilesError
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from .upscale_image import Upscaler
+
+
+def get_num_upscale_workers(cores_per_worker: int, worker_rss: int) -> int:
+    max_workers_for_cores = (os.cpu_count() or 1) // cores_per_worker
+    max_workers_for_memory = psutil.virtual_memory().available // worker_rss
+
+    return max(1, min(max_workers_for_cores, max_workers_for_memory))
+
+
+def get_pending_upscale_files(
+    in_out_files: list[tuple[str, str]], is_done: Callable[[str], bool]
+) -> list[tuple[str, str]]:
+    pending_files = []
+    for in_file, out_file in in_out_files:
+        if not os.path.isfile(in_file):
+            msg = f'Could not find srce file: "{in_file}".'
+            raise FileNotFoundError(msg)
+        if is_done(out_file):
+            logging.debug(f'Upscale file already done - skipping: "{out_file}".')
+            continue
+        pending_files.append((in_file, out_file))
+
+    return pending_files
+
+
+class UpscaleQueue:
+    """Upscale pages from any number of titles on a fixed number of upscale workers.
+
+    Pages are taken from one global queue in jobs of 'pages_per_job', so backends that
+    load a model per run only load it once per job. Each worker thread gets its own
+    upscaler from 'get_upscaler'. The upscalers write their out files atomically, and
+    'mark_done' is called for each out file that a job upscaled, even if others failed.
+    """
+
+    def __init__(
+        self,
+        get_upscaler: Callable[[], Upscaler],
+        scale: int,
+        num_workers: int,
+        pages_per_job: int,
+        mark_done: Callable[[str], None] | None = None,
+    ) -> None:
+        self._get_upscaler = get_upscaler
+        self._scale = scale
+        self._num_workers = num_workers
+        self._pages_per_job = pages_per_job
+        self._mark_done = mark_done
+        self._worker_state = threading.local()
+
+    def run(self, in_out_files: list[tuple[str, str]]) -> int:
+        """Upscale all the given pages and return the number that failed."""
+        jobs = [
+            in_out_files[i : i + self._pages_per_job]
+            for i in range(0, len(in_out_files), self._pages_per_job)
+        ]
+        logging.info(
+            f"Upscaling {len(in_out_files)} pages in {len(jobs)} jobs"
+            f" on {self._num_workers} workers."
+        )
+
+        start = time.time()
+        num_done = 0
+        num_failed = 0
+
+        with concurrent.futures.ThreadPoolExecutor(self._num_workers) as executor:
+            futures = {executor.submit(self._run_job, job): job for job in jobs}
+            for future in concurrent.futures.as_completed(futures):
+                job = futures[future]
+                num_done += len(job)
+                error = future.exception()
+                if error is None:
+                    done_out_files = [out_file for _in_file, out_file in job]
+                else:
+                    # Journal the pages of a part failed job that were upscaled anyway.
+                    done_out_files = (
+                        error.done_out_files if isinstance(error, UpscaleFilesError) else []
+                    )
+                    num_failed += len(job) - len(done_out_files)
+                    logging.error(f'Upscale job starting at "{job[0][0]}" failed: {error}.')
+                if self._mark_done:
+                    for out_file in done_out_files:
+                        self._mark_done(out_file)
+
+                elapsed = time.time() - start
+                eta = elapsed * (len(in_out_files) - num_done) / num_done
+                logging.info(
+                    f"Upscaled {num_done} of {len(in_out_files)} pages"
+                    f" in {datetime.timedelta(seconds=int(elapsed))},"
+                    f" ETA {datetime.timedelta(seconds=int(eta))}."
+                )
+
+        return num_failed
+
+    def _run_job(self, job: list[tuple[str, str]]) -> None:
+        if not hasattr(self._worker_state, "upscaler"):
+            self._worker_state.upscaler = self._get_upscaler()
+
+        self._worker_state.upscaler.upscale_image_files(job, self._scale)
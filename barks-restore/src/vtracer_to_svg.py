@@ -1,6 +1,26 @@
+from __future__ import annotations
+
 import os.path
+import re
+from dataclasses import dataclass
+
+import cv2 as cv
+import numpy as np
+from vtracer import convert_image_to_svg_py, convert_raw_image_to_svg
+
+from .atomic_output import atomic_output_file
+from .image_io import svg_to_image
 
-from vtracer import convert_image_to_svg_py
+VTRACER_SETTINGS = {
+    "colormode": "binary",
+    "path_precision": 3,
+    "mode": "spline",
+    "filter_speckle": 2,
+    "corner_threshold": 60,
+    "length_threshold": 10.0,
+    "max_iterations": 10,
+    "splice_threshold": 45,  # higher than this is not so good
+}
 
 
 def image_file_to_svg(in_file: str, out_file: str) -> None:
@@ -29,15 +49,169 @@ def image_file_to_svg(in_file: str, out_file: str) -> None:
         msg = f'Could not find file "{in_file}".'
         raise FileNotFoundError(msg)
 
-    convert_image_to_svg_py(
-        in_file,
-        out_file,
-        colormode="binary",
-        path_precision=3,
-        mode="spline",
-        filter_speckle=2,
-        corner_threshold=60,
-        length_threshold=10.0,
-        max_iterations=10,
-        splice_threshold=45,  # higher than this is not so good
+    with atomic_output_file(out_file) as temp_out_file:
+        convert_image_to_svg_py(in_file, temp_out_file, **VTRACER_SETTINGS)
+
+
+def image_to_svg(image: cv.typing.MatLike) -> str:
+    """In-memory version of 'image_file_to_svg' - returns the same svg text.
+
+    The image goes to vtracer as an uncompressed bmp, which costs next to nothing
+    to encode and decode compared to a png.
+    """
+    ok, bmp_bytes = cv.imencode(".bmp", image)
+    if not ok:
+        msg = "Could not encode image for vtracer."
+        raise RuntimeError(msg)
+
+    return convert_raw_image_to_svg(bmp_bytes.tobytes(), "bmp", **VTRACER_SETTINGS)
+
+
+def image_to_traced_paths(image: cv.typing.MatLike) -> TracedPaths:
+    """Trace an image to the compact cubic segment form of its vtracer svg."""
+    return get_traced_paths(image_to_svg(image))
+
+
+@dataclass
+class TracedPath:
+    fill: str
+    x_offset: float
+    y_offset: float
+    # Each sub path is a start point followed by the two control points and end point
+    # of each of its cubic segments, as rows of x, y.
+    sub_paths: list[np.ndarray]
+
+
+@dataclass
+class TracedPaths:
+    """Compact form of a vtracer svg - arrays of cubic segments instead of svg text.
+
+    'to_svg' gives back the same bytes as the vtracer svg the paths were read from.
+    """
+
+    width: int
+    height: int
+    paths: list[TracedPath]
+    # The text of vtracer's generator comment, if the svg had one.
+    generator: str | None = None
+
+    def get_num_segments(self) -> int:
+        return sum((len(sub_path) - 1) // 3 for path in self.paths for sub_path in path.sub_paths)
+
+    def to_svg(self) -> str:
+        path_precision = VTRACER_SETTINGS["path_precision"]
+
+        svg_lines = ['<?xml version="1.0" encoding="UTF-8"?>']
+        if self.generator is not None:
+            svg_lines.append(f"<!--{self.generator}-->")
+        svg_lines.append(
+            f'<svg version="1.1" xmlns="http://www.w3.org/2000/svg"'
+            f' width="{self.width}" height="{self.height}">'
+        )
+        for path in self.paths:
+            path_data = ""
+            for sub_path in path.sub_paths:
+                points = [
+                    f"{_format_number(x, path_precision)} {_format_number(y, path_precision)}"
+                    for x, y in sub_path
+                ]
+                path_data += f"M{points[0]} "
+                for i in range(1, len(points), 3):
+                    path_data += f"C{points[i]} {points[i + 1]} {points[i + 2]} "
+                path_data += "Z "
+            transform = (
+                f"translate({_format_offset(path.x_offset)},{_format_offset(path.y_offset)})"
+            )
+            svg_lines.append(f'<path d="{path_data}" fill="{path.fill}" transform="{transform}"/>')
+        svg_lines.append("</svg>")
+
+        return "\n".join(svg_lines) + "\n"
+
+    def write_svg(self, svg_file: str) -> None:
+        write_svg_file(svg_file, self.to_svg())
+
+    def to_image(self) -> cv.typing.MatLike:
+        """Rasterize the paths to a BGRA image."""
+        return svg_to_image(self.to_svg())
+
+
+def write_svg_file(svg_file: str, svg: str) -> None:
+    with atomic_output_file(svg_file) as temp_svg_file, open(temp_svg_file, "w") as f:
+        f.write(svg)
+
+
+_SVG_GENERATOR_REGEX = re.compile(r"<!--(.*?)-->")
+_SVG_SIZE_REGEX = re.compile(r'<svg [^>]*width="(\d+)" height="(\d+)"')
+_SVG_PATH_REGEX = re.compile(
+    r'<path d="([^"]*)" fill="([^"]*)"(?: transform="translate\(([^,]+),([^)]+)\)")?'
+)
+_SVG_PATH_TOKEN_REGEX = re.compile(r"[MCLZ]|-?[\d.]+(?:e-?\d+)?")
+
+
+def get_traced_paths(svg: str) -> TracedPaths:
+    size_match = _SVG_SIZE_REGEX.search(svg)
+    if not size_match:
+        msg = "Could not find the size of the svg."
+        raise ValueError(msg)
+
+    paths = [
+        TracedPath(
+            fill,
+            float(x_offset) if x_offset else 0.0,
+            float(y_offset) if y_offset else 0.0,
+            _get_sub_paths(path_data),
+        )
+        for path_data, fill, x_offset, y_offset in _SVG_PATH_REGEX.findall(svg)
+    ]
+
+    generator_match = _SVG_GENERATOR_REGEX.search(svg, 0, size_match.start())
+
+    return TracedPaths(
+        int(size_match.group(1)),
+        int(size_match.group(2)),
+        paths,
+        generator_match.group(1) if generator_match else None,
     )
+
+
+def _get_sub_paths(path_data: str) -> list[np.ndarray]:
+    sub_paths = []
+    points: list[tuple[float, float]] = []
+    command = ""
+    values: list[float] = []
+
+    for token in _SVG_PATH_TOKEN_REGEX.findall(path_data):
+        if token in "MCLZ":
+            command = token
+            if command == "Z" and points:
+                sub_paths.append(np.array(points, dtype=np.float64))
+                points = []
+            continue
+
+        values.append(float(token))
+        if command == "M" and len(values) == 2:
+            points = [(values[0], values[1])]
+            values = []
+        elif command == "C" and len(values) == 6:
+            points.extend([(values[0], values[1]), (values[2], values[3]), (values[4], values[5])])
+            values = []
+        elif command == "L" and len(values) == 2:
+            # A line is a cubic with its control points at its ends.
+            points.extend([points[-1], (values[0], values[1]), (values[0], values[1])])
+            values = []
+
+    if points:
+        sub_paths.append(np.array(points, dtype=np.float64))
+
+    return sub_paths
+
+
+def _format_number(value: float, precision: int) -> str:
+    # Same as vtracer - rounded to 'precision' places with trailing zeros dropped. A
+    # rounded small negative keeps its sign, as "-0".
+    return f"{value:.{precision}f}".rstrip("0").rstrip(".")
+
+
+def _format_offset(value: float) -> str:
+    # vtracer writes the offsets at full precision, as the shortest round trip number.
+    return np.format_float_positional(value, trim="-")
@@ -1,5 +1,7 @@
 import argparse
+import concurrent.futures
 import logging
+import multiprocessing
 import sys
 import traceback
 from datetime import UTC, datetime
@@ -13,31 +15,93 @@ from build_comics import ComicBookBuilder
 from comic_utils.comics_logging import setup_logging
 from comics_integrity import check_comics_integrity
 from intspan import intspan
+from log_capture import capture_logs, replay_logs, set_root_log_level
 from timing import Timing
 
 
 def process_comic_book_titles(
     comics_db: ComicsDatabase,
     titles: list[str],
+    jobs: int = 1,
+    incremental: bool = False,
 ) -> int:
     assert len(titles) > 0
 
+    if jobs > 1:
+        return process_comic_book_titles_concurrently(comics_db, titles, jobs, incremental)
+
     ret_code = 0
 
     for title in titles:
         comic = comics_db.get_comic_book(title)
-        ret = process_comic_book(comic)
+        ret = process_comic_book(comic, incremental=incremental)
         if ret != 0:
             ret_code = ret
 
     return ret_code
 
 
-def process_comic_book(comic: ComicBook) -> int:
+def process_comic_book_titles_concurrently(
+    comics_db: ComicsDatabase,
+    titles: list[str],
+    jobs: int,
+    incremental: bool,
+) -> int:
+    """Build up to 'jobs' titles at once, with all their pages on one shared process pool.
+
+    The straggler pages and zipping of one title then overlap with the pages of the
+    next titles. Each title's logs are held back, and logged in title order once the
+    title and all titles before it are done.
+    """
+    ret_code = 0
+
+    # The page workers are started on demand from the title threads. Forking then could
+    # copy a lock, such as a logging lock, held by another title thread into the worker.
+    with (
+        concurrent.futures.ProcessPoolExecutor(
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=set_root_log_level,
+            initargs=(logging.getLogger().getEffectiveLevel(),),
+        ) as page_executor,
+        concurrent.futures.ThreadPoolExecutor(jobs) as title_executor,
+    ):
+        title_futures = [
+            title_executor.submit(
+                process_comic_book_with_captured_logs,
+                comics_db.get_comic_book(title),
+                page_executor,
+                incremental,
+            )
+            for title in titles
+        ]
+
+        for title_future in title_futures:
+            ret, log_records = title_future.result()
+            replay_logs(log_records)
+            if ret != 0:
+                ret_code = ret
+
+    return ret_code
+
+
+def process_comic_book_with_captured_logs(
+    comic: ComicBook, page_executor: concurrent.futures.Executor, incremental: bool
+) -> tuple[int, list[logging.LogRecord]]:
+    with capture_logs() as log_records:
+        ret = process_comic_book(comic, page_executor, incremental)
+
+    return ret, log_records
+
+
+def process_comic_book(
+    comic: ComicBook,
+    page_executor: concurrent.futures.Executor | None = None,
+    incremental: bool = False,
+) -> int:
     process_timing = Timing(datetime.now(UTC))
 
     try:
-        comic_book_builder = ComicBookBuilder(comic)
+        comic_book_builder = ComicBookBuilder(comic, page_executor, incremental)
 
         comic_book_builder.build()
 
@@ -77,6 +141,8 @@ LOG_LEVEL_ARG = "--log-level"
 COMICS_DATABASE_DIR_ARG = "--comics-database-dir"
 VOLUME_ARG = "--volume"
 TITLE_ARG = "--title"
+JOBS_ARG = "--jobs"
+INCREMENTAL_ARG = "--incremental"
 
 BUILD_ARG = "build"
 CHECK_INTEGRITY_ARG = "check-integrity"
@@ -104,6 +170,14 @@ def get_args():
     )
     build_comics_parser.add_argument(VOLUME_ARG, action="store", type=str, required=False)
     build_comics_parser.add_argument(TITLE_ARG, action="store", type=str, required=False)
+    build_comics_parser.add_argument(
+        JOBS_ARG,
+        action="store",
+        type=int,
+        required=False,
+        default=1,
+    )
+    build_comics_parser.add_argument(INCREMENTAL_ARG, action="store_true", default=False)
     build_comics_parser.add_argument(
         LOG_LEVEL_ARG,
         action="store",
@@ -169,7 +243,12 @@ if __name__ == "__main__":
     if cmd_args.cmd_name == CHECK_INTEGRITY_ARG:
         exit_code = check_comics_integrity(comics_database, get_titles(cmd_args))
     elif cmd_args.cmd_name == BUILD_ARG:
-        exit_code = process_comic_book_titles(comics_database, get_titles(cmd_args))
+        exit_code = process_comic_book_titles(
+            comics_database,
+            get_titles(cmd_args),
+            cmd_args.jobs,
+            incremental=cmd_args.incremental,
+        )
     else:
         msg = f'ERROR: Unknown cmd_arg "{cmd_args.cmd_name}".'
         raise ValueError(msg)
@@ -3,6 +3,7 @@
 import logging
 import os
 from enum import Enum, auto
+from functools import cache
 
 from barks_fantagraphics.comic_book import ComicBook
 from barks_fantagraphics.comic_issues import ISSUE_NAME, Issues
@@ -53,6 +54,12 @@ SPLASH_BORDER_WIDTH = 10
 SPLASH_MARGIN = DEST_TARGET_X_MARGIN
 
 
+@cache
+def _get_font(font_file: str, font_size: int) -> ImageFont.FreeTypeFont:
+    # Fonts are reused across the pages an image builder renders.
+    return ImageFont.truetype(font_file, font_size)
+
+
 class BasePageType(Enum):
     EMPTY_PAGE = auto()
     BLACK_PAGE = auto()
@@ -322,7 +329,7 @@ class ComicBookImageBuilder:
         )
         draw.rectangle(shape, fill=page_blank_color)
 
-        font = ImageFont.truetype(get_font_path(PAGE_NUM_FONT_FILE), PAGE_NUM_FONT_SIZE)
+        font = _get_font(get_font_path(PAGE_NUM_FONT_FILE), PAGE_NUM_FONT_SIZE)
         text = get_page_num_str(dest_page)
         self._draw_centered_text(
             text,
@@ -386,19 +393,19 @@ class ComicBookImageBuilder:
         top += INTRO_TITLE_AUTHOR_GAP
         text = "by"
         by_font_size = int(0.6 * self._comic.author_font_size)
-        by_font = ImageFont.truetype(self._comic.title_font_file, by_font_size)
+        by_font = _get_font(self._comic.title_font_file, by_font_size)
         text_height = self._get_intro_text_height(draw, text, by_font)
         self._draw_centered_text(text, dest_page_image, draw, by_font, INTRO_AUTHOR_COLOR, top)
         top += text_height
 
         top += INTRO_TITLE_AUTHOR_BY_GAP
         text = f"{BARKS}"
-        author_font = ImageFont.truetype(self._comic.title_font_file, self._comic.author_font_size)
+        author_font = _get_font(self._comic.title_font_file, self._comic.author_font_size)
         text_height = self._get_intro_text_height(draw, text, author_font)
         self._draw_centered_text(text, dest_page_image, draw, author_font, INTRO_AUTHOR_COLOR, top)
         top += text_height + INTRO_AUTHOR_INSET_GAP
 
-        pub_text_font = ImageFont.truetype(
+        pub_text_font = _get_font(
             get_font_path(INTRO_TEXT_FONT_FILE),
             INTRO_PUB_TEXT_FONT_SIZE,
         )
@@ -487,7 +494,7 @@ class ComicBookImageBuilder:
                 add_footnote,
             )
 
-        title_font = ImageFont.truetype(font_file, font_size)
+        title_font = _get_font(font_file, font_size)
         text_height = self._get_intro_text_height(draw, title, title_font)
         return [title], [title_font], text_height
 
@@ -507,9 +514,9 @@ class ComicBookImageBuilder:
 
         title_split = ["Comics", "and Stories", comic_num]
         title_fonts = [
-            ImageFont.truetype(font_file, font_size),
-            ImageFont.truetype(font_file, int(0.5 * font_size)),
-            ImageFont.truetype(font_file, font_size),
+            _get_font(font_file, font_size),
+            _get_font(font_file, int(0.5 * font_size)),
+            _get_font(font_file, font_size),
         ]
 
         text_height = self._get_intro_text_height(draw, title, title_fonts[0])
@@ -628,7 +635,7 @@ class ComicBookImageBuilder:
         draw: ImageDraw,
     ) -> None:
         superscript_font_size = int(0.7 * self._comic.title_font_size)
-        superscript_font = ImageFont.truetype(self._comic.title_font_file, superscript_font_size)
+        superscript_font = _get_font(self._comic.title_font_file, superscript_font_size)
         draw.multiline_text(
             (
                 left - int(0.75 * superscript_font_size),
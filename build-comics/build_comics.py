@@ -3,11 +3,14 @@
 from __future__ import annotations
 
 import concurrent.futures
+import io
 import logging
 import os
 import shutil
 import sys
 import traceback
+import zlib
+from dataclasses import dataclass
 from datetime import datetime
 from typing import TYPE_CHECKING
 
@@ -45,9 +48,20 @@ from consts import (
     MIN_HD_SRCE_HEIGHT,
 )
 from image_io import open_image_for_reading
-from zipping import create_symlinks_to_comic_zip, zip_comic_book
+from log_capture import capture_logs, replay_logs
+from page_fingerprints import (
+    PageFingerprinter,
+    PageRecord,
+    get_page_fingerprint_key,
+    prune_stale_dest_image_files,
+    read_page_fingerprints,
+    write_page_fingerprints,
+)
+from zipping import ComicZipWriter, create_symlinks_to_comic_zip, zip_comic_book
 
 if TYPE_CHECKING:
+    from collections.abc import Iterator
+
     from barks_fantagraphics.comic_book import (
         ComicBook,
     )
@@ -60,12 +74,33 @@ if TYPE_CHECKING:
     from PIL import Image
 
 USE_CONCURRENT_PROCESSES = True
-_process_page_error = False
+# PIL holds the GIL for most of a page render, so threads barely scale past a few cores.
+USE_PROCESS_POOL = True
+# Rendered pages go straight into the comic zip, instead of the zip being made from
+# the dest dir once all pages are done.
+USE_STREAMED_COMIC_ZIP = True
+# If False, pages are only written to the streamed comic zip, not to the dest image
+# dir as well. Incremental builds need the dest image files, so always write them.
+WRITE_LOOSE_DEST_IMAGES = True
 
 
 class ComicBookBuilder:
-    def __init__(self, comic: ComicBook) -> None:
+    def __init__(
+        self,
+        comic: ComicBook,
+        page_executor: concurrent.futures.Executor | None = None,
+        incremental: bool = False,
+    ) -> None:
         self._comic = comic
+        # If set, pages are rendered on this process pool, which is shared with other
+        # comics being built at the same time. Page logs are sent back and logged here.
+        self._page_executor = page_executor
+        # If set, only pages whose fingerprint has changed since the last build are
+        # rendered, instead of all pages.
+        self._incremental = incremental
+        self._write_loose_dest_images = (
+            WRITE_LOOSE_DEST_IMAGES or incremental or not USE_STREAMED_COMIC_ZIP
+        )
         self._image_builder = ComicBookImageBuilder(comic, EMPTY_IMAGE_FILEPATH)
 
         self._srce_dim: ComicDimensions | None = None
@@ -83,16 +118,27 @@ class ComicBookBuilder:
         return self._srce_and_dest_pages
 
     def get_max_dest_page_timestamp(self) -> float:
+        if not self._write_loose_dest_images:
+            # The pages are only in the comic zip.
+            return os.path.getmtime(self._comic.get_dest_comic_zip())
         return get_max_timestamp(self._srce_and_dest_pages.dest_pages)
 
     def build(self) -> None:
         self._init_pages()
 
-        self._create_comic_book()
+        if USE_STREAMED_COMIC_ZIP:
+            with ComicZipWriter(self._comic) as zip_writer:
+                self._create_comic_book(zip_writer)
+
+            self._log_comic_book_params()
+
+            create_symlinks_to_comic_zip(self._comic)
+        else:
+            self._create_comic_book()
 
-        self._log_comic_book_params()
+            self._log_comic_book_params()
 
-        self._zip_and_symlink_comic_book()
+            self._zip_and_symlink_comic_book()
 
     def _init_pages(self) -> None:
         logging.debug("Initializing pages...")
@@ -126,122 +172,123 @@ class ComicBookBuilder:
 
         return srce_and_dest_pages, srce_dim, required_dim
 
-    def _create_comic_book(self) -> None:
+    def _create_comic_book(self, zip_writer: ComicZipWriter | None = None) -> None:
         logging.debug("Creating comic book...")
         self._create_dest_dirs()
-        self._process_pages()
+        self._process_pages(zip_writer)
         self._process_additional_files()
+        if zip_writer:
+            zip_writer.add_dest_dir_files()
 
-    def _process_pages(self) -> None:
+    def _process_pages(self, zip_writer: ComicZipWriter | None) -> None:
         logging.debug("Processing pages...")
-        delete_all_files_in_directory(self._comic.get_dest_dir())
-        delete_all_files_in_directory(self._comic.get_dest_image_dir())
-
-        global _process_page_error  # noqa: PLW0603
-        _process_page_error = False
-
-        if USE_CONCURRENT_PROCESSES:
-            # max_workers = min(32, (os.cpu_count() or 1) + 4)
-            max_workers = None
-            # with concurrent.futures.ProcessPoolExecutor() as executor:
-            with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
-                for srce_page, dest_page in zip(
-                    self._srce_and_dest_pages.srce_pages,
-                    self._srce_and_dest_pages.dest_pages,
-                ):
-                    executor.submit(self._process_page, srce_page, dest_page)
-        else:
-            for srce_page, dest_page in zip(
+
+        fingerprinter = PageFingerprinter(self._comic, self._required_dim)
+        all_pages = list(
+            zip(
                 self._srce_and_dest_pages.srce_pages,
                 self._srce_and_dest_pages.dest_pages,
-            ):
-                self._process_page(srce_page, dest_page)
-
-        if _process_page_error:
-            raise RuntimeError("There were errors while processing pages.")
-
-    def _process_page(
-        self,
-        srce_page: CleanPage,
-        dest_page: CleanPage,
-    ) -> None:
-        def check_srce_page_image_min_height() -> None:
-            if srce_page_image.height < MIN_HD_SRCE_HEIGHT:
-                msg = (
-                    f"Srce image error: min required height {MIN_HD_SRCE_HEIGHT}."
-                    f' Poor srce file resolution for "{srce_page.page_filename}":'
-                    f" {srce_page_image.width} x {srce_page_image.height}."
-                )
-                raise ValueError(msg)
-
-        # noinspection PyBroadException
-        try:
-            srce_page_image = open_image_for_reading(srce_page.page_filename)
-            if srce_page.page_type == PageType.BODY:
-                check_srce_page_image_min_height()
-
-            logging.info(
-                f'Convert "{get_abbrev_path(srce_page.page_filename)}"'
-                f" (page-type {srce_page.page_type.name})"
-                f' to "{get_abbrev_path(dest_page.page_filename)}"'
-                f" (page {get_page_num_str(dest_page):>2}.",
             )
-
+        )
+        fingerprints = {
+            get_page_fingerprint_key(dest_page): fingerprinter.get_fingerprint(srce_page, dest_page)
+            for srce_page, dest_page in all_pages
+        }
+
+        if self._incremental:
+            prune_stale_dest_image_files(self._comic, self._srce_and_dest_pages.dest_pages)
+            prev_page_records = read_page_fingerprints(self._comic)
+            pages = [
+                (srce_page, dest_page)
+                for srce_page, dest_page in all_pages
+                if not os.path.isfile(dest_page.page_filename)
+                or get_page_fingerprint_key(dest_page) not in prev_page_records
+                or prev_page_records[get_page_fingerprint_key(dest_page)].fingerprint
+                != fingerprints[get_page_fingerprint_key(dest_page)]
+            ]
             logging.info(
-                f'Creating dest image "{get_abbrev_path(dest_page.page_filename)}"'
-                f' from srce file "{get_abbrev_path(srce_page.page_filename)}".',
+                f"Rebuilding {len(pages)} of {len(all_pages)} pages -"
+                f" the others are unchanged since the last build."
             )
-            dest_page_image = self._image_builder.get_dest_page_image(
-                srce_page_image,
-                srce_page,
-                dest_page,
-            )
-
-            self._save_dest_image(dest_page, dest_page_image, srce_page)
-            logging.info(f'Saved changes to image "{get_abbrev_path(dest_page.page_filename)}".')
-
-            logging.info("")
-        except Exception:
-            _, _, tb = sys.exc_info()
-            tb_info = traceback.extract_tb(tb)
-            filename, line, func, text = tb_info[-1]
-            err_msg = f'Error in process page at "{filename}:{line}" for statement "{text}".'
-            logging.exception(err_msg)
-            global _process_page_error  # noqa: PLW0603
-            _process_page_error = True
-
-    def _save_dest_image(
-        self,
-        dest_page: CleanPage,
-        dest_page_image: Image,
-        srce_page: CleanPage,
-    ) -> None:
-        dest_page_image.save(
-            dest_page.page_filename,
-            optimize=True,
-            compress_level=DEST_JPG_COMPRESS_LEVEL,
-            quality=DEST_JPG_QUALITY,
-            comment="\n".join(self._get_dest_jpg_comments(srce_page, dest_page)),
-        )
+        else:
+            delete_all_files_in_directory(self._comic.get_dest_dir())
+            delete_all_files_in_directory(self._comic.get_dest_image_dir())
+            prev_page_records = {}
+            pages = all_pages
+
+        page_outputs = PageOutputs(self._write_loose_dest_images, zip_writer is not None)
+        page_results = self._render_pages(pages, page_outputs)
+        rendered_dest_files = {dest_page.page_filename for _, dest_page in pages}
+
+        # Zip entries are added in page order, each as soon as its page is done.
+        page_errors = []
+        page_records = {}
+        for _, dest_page in all_pages:
+            page_key = get_page_fingerprint_key(dest_page)
+
+            if dest_page.page_filename not in rendered_dest_files:
+                zip_crc = prev_page_records[page_key].zip_crc
+                if zip_writer:
+                    zip_crc = zip_writer.add_unchanged_file(dest_page.page_filename, zip_crc)
+                page_records[page_key] = PageRecord(fingerprints[page_key], zip_crc)
+                continue
+
+            page_result = next(page_results)
+            if page_result.error:
+                # Failed pages get no record, so the next incremental build retries them.
+                page_errors.append(page_result.error)
+                continue
+            if zip_writer:
+                zip_writer.add_bytes(dest_page.page_filename, page_result.jpg_bytes)
+            page_records[page_key] = PageRecord(fingerprints[page_key], page_result.jpg_crc)
+
+        write_page_fingerprints(self._comic, page_records)
+
+        if page_errors:
+            for page_error in page_errors:
+                logging.error(
+                    f'Page error for "{get_abbrev_path(page_error.srce_file)}":'
+                    f" {page_error.message}"
+                )
+            msg = f"There were errors while processing {len(page_errors)} pages."
+            raise RuntimeError(msg)
 
-    @staticmethod
-    def _get_dest_jpg_comments(srce_page: CleanPage, dest_page: CleanPage) -> list[str]:
-        now_str = datetime.now().astimezone().strftime("%Y-%m-%d %H:%M:%S.%f")
-
-        prefix = METADATA_PROPERTY_GROUP
-        indent = "      "
-        return [
-            indent,
-            f'{indent}{prefix}:Srce file: "{get_clean_path(srce_page.page_filename)}"',
-            f'{indent}{prefix}:Dest file: "{get_clean_path(dest_page.page_filename)}"',
-            f"{indent}{prefix}:Dest created: {now_str}",
-            f"{indent}{prefix}:Srce page num: {srce_page.page_num}",
-            f"{indent}{prefix}:Srce page type: {srce_page.page_type.name}",
-            f"{indent}{prefix}:Srce panels bbox:"
-            f" {dest_page.panels_bbox.x_min}, {dest_page.panels_bbox.y_min},"
-            f" {dest_page.panels_bbox.x_max}, {dest_page.panels_bbox.y_max}",
-            f"{indent}{prefix}:Dest page num: {dest_page.page_num}",
-        ]
+    def _render_pages(
+        self, pages: list[tuple[CleanPage, CleanPage]], page_outputs: PageOutputs
+    ) -> Iterator[PageResult]:
+        """Render the pages, and yield their results in page order."""
+        if self._page_executor:
+            for page_result, page_log_records in self._page_executor.map(
+                _process_shared_pool_page,
+                [self._comic] * len(pages),
+                [self._required_dim] * len(pages),
+                [srce_page for srce_page, _ in pages],
+                [dest_page for _, dest_page in pages],
+                [page_outputs] * len(pages),
+            ):
+                replay_logs(page_log_records)
+                yield page_result
+        elif not USE_CONCURRENT_PROCESSES:
+            for srce_page, dest_page in pages:
+                yield _process_page(self._image_builder, srce_page, dest_page, page_outputs)
+        elif USE_PROCESS_POOL:
+            # Only the page descriptors go to the workers - each worker has its own
+            # image builder, and reads and writes the page images itself.
+            with concurrent.futures.ProcessPoolExecutor(
+                initializer=_init_page_worker,
+                initargs=(self._comic, self._required_dim, page_outputs),
+            ) as executor:
+                yield from executor.map(
+                    _process_worker_page,
+                    [srce_page for srce_page, _ in pages],
+                    [dest_page for _, dest_page in pages],
+                )
+        else:
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                yield from executor.map(
+                    lambda page: _process_page(self._image_builder, *page, page_outputs),
+                    pages,
+                )
 
     def _process_additional_files(self) -> None:
         shutil.copy2(self._comic.ini_file, self._comic.get_dest_dir())
@@ -318,3 +365,171 @@ class ComicBookBuilder:
         logging.info(f'Dest year symlink:    "{get_abbrev_path(self._comic.get_dest_year_comic_zip_symlink())}".')
         logging.info("")
         # fmt: on
+
+
+@dataclass
+class PageError:
+    srce_file: str
+    dest_file: str
+    message: str
+
+
+@dataclass(frozen=True)
+class PageOutputs:
+    write_dest_file: bool
+    get_jpg_bytes: bool
+
+
+@dataclass
+class PageResult:
+    error: PageError | None = None
+    # The saved jpeg, if it is wanted for the comic zip.
+    jpg_bytes: bytes | None = None
+    jpg_crc: int | None = None
+
+
+# Each process pool worker renders pages with its own image builder, so fonts and
+# the empty page image are loaded once per worker, not once per page.
+_worker_image_builder: ComicBookImageBuilder | None = None
+_worker_page_outputs: PageOutputs | None = None
+
+
+def _init_page_worker(
+    comic: ComicBook, required_dim: RequiredDimensions, page_outputs: PageOutputs
+) -> None:
+    global _worker_image_builder, _worker_page_outputs  # noqa: PLW0603
+    _worker_image_builder = ComicBookImageBuilder(comic, EMPTY_IMAGE_FILEPATH)
+    _worker_image_builder.set_required_dim(required_dim)
+    _worker_page_outputs = page_outputs
+
+
+def _process_worker_page(srce_page: CleanPage, dest_page: CleanPage) -> PageResult:
+    return _process_page(_worker_image_builder, srce_page, dest_page, _worker_page_outputs)
+
+
+# A shared pool worker renders pages of several comics, so it keeps the image builders
+# of the last few comics it has seen.
+MAX_SHARED_POOL_IMAGE_BUILDERS = 4
+_shared_pool_image_builders: dict[str, ComicBookImageBuilder] = {}
+
+
+def _process_shared_pool_page(
+    comic: ComicBook,
+    required_dim: RequiredDimensions,
+    srce_page: CleanPage,
+    dest_page: CleanPage,
+    page_outputs: PageOutputs,
+) -> tuple[PageResult, list[logging.LogRecord]]:
+    image_builder = _shared_pool_image_builders.pop(comic.ini_file, None)
+    if image_builder is None:
+        image_builder = ComicBookImageBuilder(comic, EMPTY_IMAGE_FILEPATH)
+        if len(_shared_pool_image_builders) >= MAX_SHARED_POOL_IMAGE_BUILDERS:
+            del _shared_pool_image_builders[next(iter(_shared_pool_image_builders))]
+    _shared_pool_image_builders[comic.ini_file] = image_builder
+    image_builder.set_required_dim(required_dim)
+
+    with capture_logs() as log_records:
+        page_result = _process_page(image_builder, srce_page, dest_page, page_outputs)
+
+    return page_result, log_records
+
+
+def _process_page(
+    image_builder: ComicBookImageBuilder,
+    srce_page: CleanPage,
+    dest_page: CleanPage,
+    page_outputs: PageOutputs,
+) -> PageResult:
+    def check_srce_page_image_min_height() -> None:
+        if srce_page_image.height < MIN_HD_SRCE_HEIGHT:
+            msg = (
+                f"Srce image error: min required height {MIN_HD_SRCE_HEIGHT}."
+                f' Poor srce file resolution for "{srce_page.page_filename}":'
+                f" {srce_page_image.width} x {srce_page_image.height}."
+            )
+            raise ValueError(msg)
+
+    # noinspection PyBroadException
+    try:
+        srce_page_image = open_image_for_reading(srce_page.page_filename)
+        if srce_page.page_type == PageType.BODY:
+            check_srce_page_image_min_height()
+
+        logging.info(
+            f'Convert "{get_abbrev_path(srce_page.page_filename)}"'
+            f" (page-type {srce_page.page_type.name})"
+            f' to "{get_abbrev_path(dest_page.page_filename)}"'
+            f" (page {get_page_num_str(dest_page):>2}.",
+        )
+
+        logging.info(
+            f'Creating dest image "{get_abbrev_path(dest_page.page_filename)}"'
+            f' from srce file "{get_abbrev_path(srce_page.page_filename)}".',
+        )
+        dest_page_image = image_builder.get_dest_page_image(
+            srce_page_image,
+            srce_page,
+            dest_page,
+        )
+
+        jpg_bytes, jpg_crc = _save_dest_image(dest_page, dest_page_image, srce_page, page_outputs)
+        logging.info(f'Saved changes to image "{get_abbrev_path(dest_page.page_filename)}".')
+
+        logging.info("")
+    except Exception as e:
+        _, _, tb = sys.exc_info()
+        tb_info = traceback.extract_tb(tb)
+        filename, line, func, text = tb_info[-1]
+        err_msg = f'Error in process page at "{filename}:{line}" for statement "{text}".'
+        logging.exception(err_msg)
+        return PageResult(
+            error=PageError(srce_page.page_filename, dest_page.page_filename, f"{err_msg} {e}")
+        )
+
+    return PageResult(jpg_bytes=jpg_bytes, jpg_crc=jpg_crc)
+
+
+def _save_dest_image(
+    dest_page: CleanPage,
+    dest_page_image: Image,
+    srce_page: CleanPage,
+    page_outputs: PageOutputs,
+) -> tuple[bytes | None, int]:
+    # Encoded once, for both the dest file and the comic zip.
+    jpg_buffer = io.BytesIO()
+    dest_page_image.save(
+        jpg_buffer,
+        format="JPEG",
+        optimize=True,
+        compress_level=DEST_JPG_COMPRESS_LEVEL,
+        quality=DEST_JPG_QUALITY,
+        comment="\n".join(_get_dest_jpg_comments(srce_page, dest_page)),
+    )
+    jpg_bytes = jpg_buffer.getvalue()
+
+    if page_outputs.write_dest_file:
+        with open(dest_page.page_filename, "wb") as f:
+            f.write(jpg_bytes)
+
+    jpg_crc = zlib.crc32(jpg_bytes)
+
+    return (jpg_bytes if page_outputs.get_jpg_bytes else None), jpg_crc
+
+
+def _get_dest_jpg_comments(srce_page: CleanPage, dest_page: CleanPage) -> list[str]:
+    now_str = datetime.now().astimezone().strftime("%Y-%m-%d %H:%M:%S.%f")
+
+    prefix = METADATA_PROPERTY_GROUP
+    indent = "      "
+    return [
+        indent,
+        f'{indent}{prefix}:Srce file: "{get_clean_path(srce_page.page_filename)}"',
+        f'{indent}{prefix}:Dest file: "{get_clean_path(dest_page.page_filename)}"',
+        f"{indent}{prefix}:Dest created: {now_str}",
+        f"{indent}{prefix}:Srce page num: {srce_page.page_num}",
+        f"{indent}{prefix}:Srce page type: {srce_page.page_type.name}",
+        f"{indent}{prefix}:Srce panels bbox:"
+        f" {dest_page.panels_bbox.x_min}, {dest_page.panels_bbox.y_min},"
+        f" {dest_page.panels_bbox.x_max}, {dest_page.panels_bbox.y_max}",
+        f"{indent}{prefix}:Dest page num: {dest_page.page_num}",
+    ]
@@ -6,6 +6,7 @@ MIN_HD_SRCE_HEIGHT = 3000
 
 DEST_SRCE_MAP_FILENAME = "srce-dest-map.json"
 DEST_PANELS_BBOXES_FILENAME = "dest-panels-bboxes.json"
+PAGE_FINGERPRINTS_FILENAME = "page-fingerprints.json"
 
 README_FILENAME = "readme.txt"
 SUMMARY_FILENAME = "clean_summary.txt"
@@ -21,6 +22,7 @@ DEST_NON_IMAGE_FILES = {
     METADATA_FILENAME,
     README_FILENAME,
     DEST_SRCE_MAP_FILENAME,
+    PAGE_FINGERPRINTS_FILENAME,
 }
 
 FOOTNOTE_CHAR = "*"
@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import logging
+import threading
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+_capture = threading.local()
+
+
+class _CaptureFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        records = getattr(_capture, "records", None)
+        if records is None:
+            return True
+
+        records.append(_get_picklable_record(record))
+        return False
+
+
+_capture_filter = _CaptureFilter()
+
+
+@contextmanager
+def capture_logs() -> Iterator[list[logging.LogRecord]]:
+    """Hold back the root logger records of this thread, instead of handling them.
+
+    The held back records can then be sent to another process, or handled later
+    with 'replay_logs', so that the logs of concurrent jobs don't interleave.
+    """
+    root_logger = logging.getLogger()
+    if _capture_filter not in root_logger.filters:
+        root_logger.addFilter(_capture_filter)
+
+    prev_records = getattr(_capture, "records", None)
+    _capture.records = []
+    try:
+        yield _capture.records
+    finally:
+        _capture.records = prev_records
+
+
+def set_root_log_level(level: int) -> None:
+    """Process pool initializer - spawned and forkserver workers don't inherit the level."""
+    logging.getLogger().setLevel(level)
+
+
+def replay_logs(records: list[logging.LogRecord]) -> None:
+    # If this thread is capturing too, the records are held back again.
+    root_logger = logging.getLogger()
+    for record in records:
+        root_logger.handle(record)
+
+
+def _get_picklable_record(record: logging.LogRecord) -> logging.LogRecord:
+    picklable_record = logging.makeLogRecord(record.__dict__)
+    picklable_record.msg = record.getMessage()
+    picklable_record.args = None
+    if record.exc_info:
+        picklable_record.exc_text = logging.Formatter().formatException(record.exc_info)
+    picklable_record.exc_info = None
+
+    return picklable_record
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+from dataclasses import asdict, dataclass
+from typing import TYPE_CHECKING
+
+from barks_fantagraphics.comic_book import get_page_str
+from barks_fantagraphics.comics_consts import (
+    INTRO_TEXT_FONT_FILE,
+    PAGE_NUM_FONT_FILE,
+    get_font_path,
+)
+from barks_fantagraphics.comics_utils import get_abbrev_path
+from consts import DEST_JPG_COMPRESS_LEVEL, DEST_JPG_QUALITY, PAGE_FINGERPRINTS_FILENAME
+
+if TYPE_CHECKING:
+    from barks_fantagraphics.comic_book import ComicBook
+    from barks_fantagraphics.page_classes import CleanPage, RequiredDimensions
+
+# Bump this when a change to the page rendering code should rebuild every page.
+PAGE_RENDER_VERSION = 1
+
+
+def get_page_fingerprints_file(comic: ComicBook) -> str:
+    return os.path.join(comic.get_dest_dir(), PAGE_FINGERPRINTS_FILENAME)
+
+
+@dataclass
+class PageRecord:
+    fingerprint: str
+    # CRC of the page's jpeg as last zipped, so an old comic zip entry can be checked
+    # before it is reused.
+    zip_crc: int | None = None
+
+
+def read_page_fingerprints(comic: ComicBook) -> dict[str, PageRecord]:
+    fingerprints_file = get_page_fingerprints_file(comic)
+    if not os.path.isfile(fingerprints_file):
+        return {}
+
+    try:
+        with open(fingerprints_file) as f:
+            return {key: PageRecord(**record) for key, record in json.load(f).items()}
+    except (OSError, ValueError, TypeError) as e:
+        logging.warning(f'Ignoring bad page fingerprints file "{fingerprints_file}": {e}')
+        return {}
+
+
+def write_page_fingerprints(comic: ComicBook, page_records: dict[str, PageRecord]) -> None:
+    fingerprints_file = get_page_fingerprints_file(comic)
+    temp_fingerprints_file = f"{fingerprints_file}.tmp-{os.getpid()}"
+
+    with open(temp_fingerprints_file, "w") as f:
+        json.dump({key: asdict(record) for key, record in page_records.items()}, f, indent=4)
+    os.replace(temp_fingerprints_file, fingerprints_file)
+
+
+def get_page_fingerprint_key(dest_page: CleanPage) -> str:
+    return os.path.basename(dest_page.page_filename)
+
+
+class PageFingerprinter:
+    """Make the fingerprints that decide whether a dest page must be rebuilt.
+
+    A page's fingerprint covers its srce file, its panels segments file, the comic's ini
+    file, and the render parameters: required dimensions, fonts, the comic's title and
+    publication texts, and jpeg settings.
+    Files are fingerprinted by size and modification time, which is enough to see a
+    fixed or restored srce file, without reading every page of the comic.
+    """
+
+    def __init__(self, comic: ComicBook, required_dim: RequiredDimensions) -> None:
+        self._comic = comic
+
+        common_params = {
+            "version": PAGE_RENDER_VERSION,
+            "ini_file": _get_file_stat(comic.ini_file),
+            "required_dim": vars(required_dim),
+            "title": comic.get_comic_title(),
+            "ini_title": comic.get_ini_title(),
+            # The fanta info fields the title rendering depends on.
+            "fanta_info": [
+                comic.fanta_info.comic_book_info.is_barks_title,
+                comic.fanta_info.comic_book_info.issue_name,
+            ],
+            "publication_text": comic.publication_text,
+            "title_font": [
+                _get_file_stat(get_font_path(comic.title_font_file)),
+                comic.title_font_size,
+                comic.author_font_size,
+            ],
+            "page_num_font": _get_file_stat(get_font_path(PAGE_NUM_FONT_FILE)),
+            "intro_text_font": _get_file_stat(get_font_path(INTRO_TEXT_FONT_FILE)),
+            "intro_inset_file": _get_file_stat(comic.intro_inset_file),
+            "jpg_quality": DEST_JPG_QUALITY,
+            "jpg_compress_level": DEST_JPG_COMPRESS_LEVEL,
+        }
+        self._common_params_str = json.dumps(common_params, sort_keys=True, default=str)
+
+    def get_fingerprint(self, srce_page: CleanPage, dest_page: CleanPage) -> str:
+        panel_segments_file = self._comic.get_srce_panel_segments_file(
+            get_page_str(srce_page.page_num)
+        )
+
+        page_params = {
+            "srce_file": _get_file_stat(srce_page.page_filename),
+            "srce_page_type": srce_page.page_type.name,
+            "panel_segments_file": _get_file_stat(panel_segments_file),
+            "dest_page_num": dest_page.page_num,
+            "dest_page_type": dest_page.page_type.name,
+            "dest_panels_bbox": dest_page.panels_bbox.get_box(),
+        }
+        page_params_str = json.dumps(page_params, sort_keys=True, default=str)
+
+        return hashlib.sha256((self._common_params_str + page_params_str).encode()).hexdigest()
+
+
+def _get_file_stat(file: str) -> tuple[int, int] | None:
+    try:
+        stat = os.stat(file)
+    except (OSError, TypeError):
+        return None
+
+    return stat.st_size, stat.st_mtime_ns
+
+
+def prune_stale_dest_image_files(comic: ComicBook, dest_pages: list[CleanPage]) -> None:
+    dest_image_dir = comic.get_dest_image_dir()
+    wanted_files = {os.path.basename(dest_page.page_filename) for dest_page in dest_pages}
+
+    for file in os.listdir(dest_image_dir):
+        if file in wanted_files:
+            continue
+        stale_file = os.path.join(dest_image_dir, file)
+        if not os.path.isfile(stale_file):
+            continue
+        logging.info(f'Removing stale dest file "{get_abbrev_path(stale_file)}".')
+        os.remove(stale_file)
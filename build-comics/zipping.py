@@ -1,16 +1,26 @@
 from __future__ import annotations
 
+import copy
 import logging
 import os
 import shutil
+import struct
+import zipfile
 from pathlib import Path
 from typing import TYPE_CHECKING
 
 from barks_fantagraphics.comics_utils import get_relpath
+from consts import DEST_NON_IMAGE_FILES, PAGE_FINGERPRINTS_FILENAME, SUMMARY_FILENAME
 
 if TYPE_CHECKING:
+    from types import TracebackType
+
     from barks_fantagraphics.comic_book import ComicBook
 
+# Jpegs are already compressed, so deflating them only costs time.
+STORED_FILE_EXTS = {".jpg", ".jpeg", ".png"}
+_ZIP_DATA_DESCRIPTOR_FLAG = 0x08
+
 
 def zip_comic_book(comic: ComicBook) -> None:
     logging.info(
@@ -32,6 +42,164 @@ def zip_comic_book(comic: ComicBook) -> None:
         raise RuntimeError(msg)
 
 
+class ComicZipWriter:
+    """Write a comic zip entry by entry, as its pages are rendered.
+
+    Entries are named relative to the comic's dest dir, as with 'zip_comic_book', but
+    pages can come straight from the page renderers, so the comic does not need to
+    be read back from the dest dir. Unchanged pages can be copied, still compressed,
+    from the previous comic zip. The zip is built under a temp name and only
+    replaces the final comic zip if it is complete.
+    """
+
+    def __init__(self, comic: ComicBook) -> None:
+        self._comic = comic
+        self._temp_zip_file = comic.get_dest_dir() + ".zip"
+        self._zip: zipfile.ZipFile | None = None
+        self._old_zip: zipfile.ZipFile | None = None
+        self._dir_entries: set[str] = set()
+        self._num_copied_entries = 0
+
+    def __enter__(self) -> ComicZipWriter:
+        logging.info(f'Writing comic zip "{get_relpath(self._comic.get_dest_comic_zip())}".')
+
+        os.makedirs(self._comic.get_dest_zip_root_dir(), exist_ok=True)
+        if os.path.isfile(self._comic.get_dest_comic_zip()):
+            try:
+                self._old_zip = zipfile.ZipFile(self._comic.get_dest_comic_zip())
+            except zipfile.BadZipFile:
+                logging.warning(
+                    f'Not copying from bad comic zip "{self._comic.get_dest_comic_zip()}".'
+                )
+        self._zip = zipfile.ZipFile(self._temp_zip_file, "w")
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self._zip.close()
+        if self._old_zip:
+            self._old_zip.close()
+
+        if exc_type is not None:
+            os.remove(self._temp_zip_file)
+            return
+
+        os.replace(self._temp_zip_file, self._comic.get_dest_comic_zip())
+        if not os.path.isfile(self._comic.get_dest_comic_zip()):
+            msg = f'Could not create final comic zip "{self._comic.get_dest_comic_zip()}".'
+            raise RuntimeError(msg)
+
+        if self._num_copied_entries > 0:
+            logging.info(
+                f"Copied {self._num_copied_entries} unchanged entries from the old comic zip."
+            )
+
+    def add_bytes(self, dest_file: str, data: bytes) -> None:
+        """Add the bytes of 'dest_file', which need not have been written to disk."""
+        arcname = self._get_arcname(dest_file)
+        self._add_dir_entries(arcname)
+
+        self._zip.writestr(arcname, data, compress_type=_get_compress_type(dest_file))
+
+    def add_file(self, dest_file: str) -> None:
+        arcname = self._get_arcname(dest_file)
+        self._add_dir_entries(arcname)
+
+        self._zip.write(dest_file, arcname, compress_type=_get_compress_type(dest_file))
+
+    def add_unchanged_file(self, dest_file: str, crc: int | None) -> int:
+        """Add 'dest_file', which has not changed since it was zipped with CRC 'crc'.
+
+        If the old comic zip has the same entry, its compressed bytes are copied as is.
+        Otherwise, 'dest_file' is added from disk. Return the entry's CRC.
+        """
+        arcname = self._get_arcname(dest_file)
+        self._add_dir_entries(arcname)
+
+        old_info = self._get_old_entry(arcname)
+        if old_info and crc is not None and old_info.CRC == crc:
+            self._copy_old_entry(old_info)
+            return crc
+
+        self._zip.write(dest_file, arcname, compress_type=_get_compress_type(dest_file))
+        return self._zip.getinfo(arcname).CRC
+
+    def add_dest_dir_files(self) -> None:
+        """Add the known files directly in the dest dir, such as the metadata files.
+
+        The build summary and the page fingerprints are build records, not part of the
+        comic, so they are left out of the zip, as are any stray files.
+        """
+        zip_files = (DEST_NON_IMAGE_FILES - {SUMMARY_FILENAME, PAGE_FINGERPRINTS_FILENAME}) | {
+            os.path.basename(self._comic.ini_file)
+        }
+        dest_dir = self._comic.get_dest_dir()
+        for file in sorted(os.listdir(dest_dir)):
+            if file not in zip_files:
+                continue
+            dest_file = os.path.join(dest_dir, file)
+            if os.path.isfile(dest_file):
+                self.add_file(dest_file)
+
+    def _get_old_entry(self, arcname: str) -> zipfile.ZipInfo | None:
+        if not self._old_zip:
+            return None
+        try:
+            return self._old_zip.getinfo(arcname)
+        except KeyError:
+            return None
+
+    def _copy_old_entry(self, old_info: zipfile.ZipInfo) -> None:
+        # zipfile has no raw entry copy, so the local header is skipped here, and a
+        # new one written from the entry's central directory info.
+        old_fp = self._old_zip.fp
+        old_fp.seek(old_info.header_offset)
+        file_header = struct.unpack(zipfile.structFileHeader, old_fp.read(zipfile.sizeFileHeader))
+        old_fp.seek(
+            file_header[zipfile._FH_FILENAME_LENGTH]  # noqa: SLF001
+            + file_header[zipfile._FH_EXTRA_FIELD_LENGTH],  # noqa: SLF001
+            os.SEEK_CUR,
+        )
+        compressed_data = old_fp.read(old_info.compress_size)
+
+        info = copy.copy(old_info)
+        # The sizes and CRC are known, so they go in the local header.
+        info.flag_bits &= ~_ZIP_DATA_DESCRIPTOR_FLAG
+
+        with self._zip._lock:  # noqa: SLF001
+            self._zip.fp.seek(self._zip.start_dir)
+            info.header_offset = self._zip.start_dir
+            self._zip.fp.write(info.FileHeader())
+            self._zip.fp.write(compressed_data)
+            self._zip.start_dir = self._zip.fp.tell()
+            self._zip.filelist.append(info)
+            self._zip.NameToInfo[info.filename] = info
+            self._zip._didModify = True  # noqa: SLF001
+
+        self._num_copied_entries += 1
+
+    def _get_arcname(self, dest_file: str) -> str:
+        return os.path.relpath(dest_file, self._comic.get_dest_dir()).replace(os.sep, "/")
+
+    def _add_dir_entries(self, arcname: str) -> None:
+        parts = arcname.split("/")[:-1]
+        for i in range(len(parts)):
+            dir_entry = "/".join(parts[: i + 1]) + "/"
+            if dir_entry not in self._dir_entries:
+                self._zip.writestr(dir_entry, b"")
+                self._dir_entries.add(dir_entry)
+
+
+def _get_compress_type(file: str) -> int:
+    if Path(file).suffix.lower() in STORED_FILE_EXTS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
 def create_symlinks_to_comic_zip(comic: ComicBook) -> None:
     if not os.path.exists(comic.get_dest_comic_zip()):
         msg = f'Could not find comic zip file "{comic.get_dest_comic_zip()}".'